@@ -1,6 +1,9 @@
 import argparse
+import os
+import pickle
 
 import simulations
+import simulations.utils.price_series
 
 if __name__ == "__main__":
 
@@ -8,28 +11,381 @@ if __name__ == "__main__":
 
     parser.add_argument("--seed", type=int, default=101, help="Random seed")
     parser.add_argument(
-        "--n_borrow_agents", type=int, default=10, help="Number of borrowing agents"
+        "--n_seeds",
+        type=int,
+        default=1,
+        help="Number of seeds derived from --seed for a sweep",
+    )
+    parser.add_argument(
+        "--n_borrow_agents",
+        type=int,
+        nargs="+",
+        default=[10],
+        help="Number(s) of borrowing agents",
+    )
+    parser.add_argument(
+        "--sigma", type=float, nargs="+", default=[0.3], help="price volatility"
+    )
+    parser.add_argument(
+        "--lltv", type=float, nargs="+", default=[0.9], help="LLTV(s) of the market"
     )
-    parser.add_argument("--sigma", type=float, default=0.3, help="price volatility")
 
     parser.add_argument(
         "--n_steps", type=int, default=100, help="Number of steps of the simulation"
     )
+    parser.add_argument(
+        "--n_workers",
+        type=int,
+        default=None,
+        help="Number of worker processes of a sweep (defaults to the number of CPUs)",
+    )
+    parser.add_argument(
+        "--inject_state",
+        action="store_true",
+        help="Fund the agents by writing into contract storage instead of transactions",
+    )
+    parser.add_argument(
+        "--open_positions",
+        action="store_true",
+        help="Borrowers start the simulation with their positions opened",
+    )
+    parser.add_argument(
+        "--population",
+        action="store_true",
+        help="Simulate the borrowers with a single array-backed agent",
+    )
+    parser.add_argument(
+        "--multi_market",
+        action="store_true",
+        help="Simulate all the LLTVs as markets of the same run",
+    )
+    parser.add_argument(
+        "--pregenerate_path",
+        action="store_true",
+        help="Pre-generate the external market price path (shared across LLTVs)",
+    )
+    parser.add_argument(
+        "--antithetic",
+        action="store_true",
+        help="Also run the antithetic path of each pre-generated path",
+    )
+    parser.add_argument(
+        "--independent_seeds",
+        action="store_true",
+        help="Derive independent seeds for each LLTV instead of sharing them",
+    )
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="Allocate the --n_seeds replicates per LLTV adaptively against --target",
+    )
+    parser.add_argument(
+        "--search",
+        action="store_true",
+        help="Search the highest LLTV between the two --lltv meeting --target",
+    )
+    parser.add_argument(
+        "--resolution",
+        type=float,
+        default=0.005,
+        help="Spacing of the LLTVs searched (with --search)",
+    )
+    parser.add_argument(
+        "--target",
+        type=float,
+        default=None,
+        help="Maximum expected risk statistic of a safe LLTV",
+    )
+    parser.add_argument(
+        "--statistic",
+        type=str,
+        default="bad_debt",
+        choices=sorted(simulations.morpho_blue.sampling.STATISTICS),
+        help="Risk statistic of a run estimated over the seeds",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=4,
+        help="Number of replicates run at once for an LLTV (with --adaptive)",
+    )
+    parser.add_argument(
+        "--min_replicates",
+        type=int,
+        default=8,
+        help="Number of replicates before an LLTV can be decided (with --adaptive)",
+    )
+    parser.add_argument(
+        "--confidence",
+        type=float,
+        default=0.95,
+        help="Confidence level of the decisions (with --adaptive)",
+    )
+    parser.add_argument(
+        "--price_series",
+        type=str,
+        default=None,
+        help="Historical price series (.npy) replayed by the external market",
+    )
+    parser.add_argument(
+        "--price_every",
+        type=int,
+        default=1,
+        help="Resampling factor of the replayed price series",
+    )
+    parser.add_argument(
+        "--price_start",
+        type=int,
+        default=0,
+        help="Index of the first replayed price",
+    )
+    parser.add_argument(
+        "--price_end",
+        type=int,
+        default=None,
+        help="Index after the last replayed price",
+    )
+    parser.add_argument(
+        "--summary",
+        action="store_true",
+        help="Runs of a sweep only return the summary of their risk metrics",
+    )
+    parser.add_argument(
+        "--store",
+        type=str,
+        nargs="?",
+        default=None,
+        const=str(simulations.morpho_blue.store.DEFAULT_PATH),
+        help="Result store of the runs, runs already stored are not run again",
+    )
+    parser.add_argument(
+        "--records_path",
+        type=str,
+        default=None,
+        help="Directory where agent records are written as columns during the run",
+    )
+    parser.add_argument(
+        "--record_every",
+        type=int,
+        default=1,
+        help="Number of steps between agent records (with --records_path)",
+    )
+    parser.add_argument(
+        "--record_max_hf",
+        type=float,
+        default=None,
+        help="Only record borrowers below this health factor (with --records_path)",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        type=str,
+        default=None,
+        help="File the checkpoints of a single run are written to",
+    )
+    parser.add_argument(
+        "--checkpoint_every",
+        type=int,
+        default=simulations.morpho_blue.checkpoint.DEFAULT_EVERY,
+        help=(
+            "Number of steps between checkpoints (with --checkpoint), where the run "
+            "continues on a reseeded environment"
+        ),
+    )
+    parser.add_argument(
+        "--checkpoint_minutes",
+        type=float,
+        default=None,
+        help="Minimum time between written checkpoints (with --checkpoint)",
+    )
+    parser.add_argument(
+        "--resume",
+        type=str,
+        default=None,
+        help="Continue the run of this checkpoint file, other options are ignored",
+    )
     args = parser.parse_args()
 
-    assert (
-        0 < args.n_borrow_agents < 100
-    ), "Number of borrow agents must be between 0 and 100"
+    assert all(
+        0 < n for n in args.n_borrow_agents
+    ), "Number of borrow agents must be positive"
 
-    lltv = 9 * 10**17
-    results = simulations.morpho_blue.sim.run_from_cache(
-        seed=args.seed,
-        n_steps=args.n_steps,
+    lltvs = [int(round(lltv * 10**18)) for lltv in args.lltv]
+    seeds = (
+        [args.seed]
+        if args.n_seeds == 1
+        else simulations.morpho_blue.sweep.derive_seeds(args.seed, args.n_seeds)
+    )
+    if args.price_series is None:
+        price_windows = None
+    else:
+        # The series is split into windows of n_steps simulated in parallel
+        price_windows = simulations.utils.price_series.replay_windows(
+            len(simulations.utils.price_series.load_prices(args.price_series)),
+            n_steps=args.n_steps,
+            every=args.price_every,
+            start=args.price_start,
+            end=args.price_end,
+        )
+    jobs = simulations.morpho_blue.sweep.make_grid(
+        seeds=seeds,
+        sigmas=args.sigma,
+        lltvs=lltvs,
         n_borrow_agents=args.n_borrow_agents,
-        sigma=args.sigma,
-        lltv=lltv,
+        n_steps=args.n_steps,
+        inject_state=args.inject_state,
+        open_positions=args.open_positions,
+        population=args.population,
+        pregenerate_path=args.pregenerate_path,
+        price_series=args.price_series,
+        price_windows=price_windows,
+        price_every=args.price_every,
+        multi_market=args.multi_market,
+        common_random_numbers=not args.independent_seeds,
+        antithetic=args.antithetic,
+        summary=args.summary,
     )
 
-    simulations.morpho_blue.plotting.plot_results_borrowers(
-        records=results, lltv=lltv / 10**18, n_borrow_agents=args.n_borrow_agents
+    record_policies = simulations.morpho_blue.sim.record_policies(
+        every=args.record_every, max_health_factor=args.record_max_hf
     )
+
+    store = (
+        None
+        if args.store is None
+        else simulations.morpho_blue.store.ResultStore(args.store)
+    )
+
+    single_run = len(jobs) == 1 and not (
+        args.multi_market or args.summary or args.store or args.search or args.adaptive
+    )
+    assert args.checkpoint is None or (
+        args.resume is None and single_run
+    ), "Checkpoints are only written by single runs"
+    assert (
+        args.checkpoint is None or args.records_path is not None
+    ), "Checkpointed runs write their records to columns with --records_path"
+
+    statistic = simulations.morpho_blue.sampling.STATISTICS[args.statistic]
+    if args.resume is not None or single_run:
+        if args.resume is not None:
+            params, results = simulations.morpho_blue.checkpoint.resume(args.resume)
+            lltv = params["lltv"]
+            n_borrow_agents = params["n_borrow_agents"]
+            records_path = params["records_path"]
+        else:
+            job = jobs[0]
+            run_kwargs = dict(
+                seed=job.seed,
+                n_steps=job.n_steps,
+                n_borrow_agents=job.n_borrow_agents,
+                sigma=job.sigma,
+                lltv=job.lltv,
+                inject_state=job.inject_state,
+                open_positions=job.open_positions,
+                population=job.population,
+                price_path=simulations.morpho_blue.sweep.job_price_path(job),
+                records_path=args.records_path,
+                record_policies=record_policies,
+            )
+            if args.checkpoint is None:
+                results = simulations.morpho_blue.sim.run_from_cache(**run_kwargs)
+            else:
+                results = simulations.morpho_blue.checkpoint.run_checkpointed(
+                    args.checkpoint,
+                    every=args.checkpoint_every,
+                    minutes=args.checkpoint_minutes,
+                    **run_kwargs,
+                )
+            lltv = job.lltv
+            n_borrow_agents = job.n_borrow_agents
+            records_path = args.records_path
+
+        if records_path is None:
+            simulations.morpho_blue.plotting.plot_results_borrowers(
+                records=results,
+                lltv=lltv / 10**18,
+                n_borrow_agents=n_borrow_agents,
+            )
+        else:
+            simulations.morpho_blue.plotting.plot_records_borrowers(
+                records=results, lltv=lltv / 10**18
+            )
+    elif args.search:
+        assert args.target is not None, "--search requires a --target"
+        assert (
+            len(lltvs) == 2 and len(args.sigma) == 1 and len(args.n_borrow_agents) == 1
+        ), "--search requires the lowest and highest LLTVs of the search"
+        result = simulations.morpho_blue.optimizer.search_lltv(
+            target=args.target,
+            seed=args.seed,
+            sigma=args.sigma[0],
+            n_borrow_agents=args.n_borrow_agents[0],
+            n_steps=args.n_steps,
+            low=min(lltvs),
+            high=max(lltvs),
+            resolution=int(round(args.resolution * 10**18)),
+            max_replicates=args.n_seeds,
+            batch_size=args.batch_size,
+            min_replicates=args.min_replicates,
+            confidence=args.confidence,
+            statistic=statistic,
+            n_workers=args.n_workers,
+            store=store,
+            inject_state=args.inject_state,
+            open_positions=args.open_positions,
+            population=args.population,
+            pregenerate_path=args.pregenerate_path,
+            antithetic=args.antithetic,
+            summary=args.summary,
+        )
+        print(simulations.morpho_blue.optimizer.format_result(result))
+    elif args.adaptive:
+        assert args.target is not None, "--adaptive requires a --target"
+        assert (
+            len(args.sigma) == 1 and len(args.n_borrow_agents) == 1
+        ), "--adaptive only searches over the LLTVs"
+        result = simulations.morpho_blue.adaptive.run_adaptive(
+            lltvs=lltvs,
+            target=args.target,
+            seed=args.seed,
+            sigma=args.sigma[0],
+            n_borrow_agents=args.n_borrow_agents[0],
+            n_steps=args.n_steps,
+            budget=args.n_seeds * len(lltvs),
+            batch_size=args.batch_size,
+            min_replicates=args.min_replicates,
+            confidence=args.confidence,
+            statistic=statistic,
+            n_workers=args.n_workers,
+            store=store,
+            inject_state=args.inject_state,
+            open_positions=args.open_positions,
+            population=args.population,
+            pregenerate_path=args.pregenerate_path,
+            antithetic=args.antithetic,
+            summary=args.summary,
+        )
+        print(simulations.morpho_blue.adaptive.format_result(result))
+    else:
+        results = simulations.morpho_blue.sweep.run_sweep(
+            jobs,
+            n_workers=args.n_workers,
+            records_path=args.records_path,
+            record_policies=record_policies,
+            store=store,
+        )
+
+        dirname = os.path.join(simulations.morpho_blue.sim.PATH, "results")
+        os.makedirs(dirname, exist_ok=True)
+        with open(os.path.join(dirname, "sweep.pkl"), "wb") as f:
+            pickle.dump(results, f)
+
+        if len(seeds) > 1:
+            samples = simulations.morpho_blue.sampling.samples(results, statistic)
+            print(f"Estimates of {args.statistic}")
+            print(
+                simulations.morpho_blue.sampling.format_report(
+                    simulations.morpho_blue.sampling.estimate(samples),
+                    simulations.morpho_blue.sampling.compare_lltvs(samples),
+                )
+            )
@@ -1 +1,16 @@
-from simulations import abi, agents, morpho_blue
+import importlib
+
+# Subpackages, imported on first access so that running a module of the
+# package (e.g. ``python -m simulations.utils.cache``) or importing a
+# single module only imports what it uses
+SUBPACKAGES = ("abi", "agents", "morpho_blue", "utils")
+
+
+def __getattr__(name: str):
+    if name not in SUBPACKAGES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return importlib.import_module(f"{__name__}.{name}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(SUBPACKAGES))
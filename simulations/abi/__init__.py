@@ -1,16 +1,37 @@
+"""
+ABIs of the simulated contracts
+
+ABIs are loaded from their files on first access (e.g.
+``simulations.abi.morpho_blue``) and then cached as attributes of the
+module, so importing the simulation does not parse the ABIs it does
+not use.
+"""
 from pathlib import Path
 
 import verbs
 
 PATH = Path(__file__).parent
 
-dai = verbs.abi.load_abi(f"{PATH}/dai.abi")
-weth_erc20 = verbs.abi.load_abi(f"{PATH}/WETHMintableERC20.abi")
+# ABI files, by attribute name
+ABI_FILES = dict(
+    dai="dai.abi",
+    weth_erc20="WETHMintableERC20.abi",
+    morpho_blue="MorphoBlue.abi",
+    uniswap_aggregator="UniswapAggregator.abi",
+    morpho_blue_snippets="MorphoBlueSnippets.abi",
+    swap_router="SwapRouter.abi",
+    uniswap_pool="UniswapV3Pool.abi",
+    quoter="Quoter_v2.abi",
+)
+
+
+def __getattr__(name: str):
+    if name not in ABI_FILES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    loaded = verbs.abi.load_abi(f"{PATH}/{ABI_FILES[name]}")
+    globals()[name] = loaded
+    return loaded
 
-morpho_blue = verbs.abi.load_abi(f"{PATH}/MorphoBlue.abi")
-uniswap_aggregator = verbs.abi.load_abi(f"{PATH}/UniswapAggregator.abi")
-morpho_blue_snippets = verbs.abi.load_abi(f"{PATH}/MorphoBlueSnippets.abi")
 
-swap_router = verbs.abi.load_abi(f"{PATH}/SwapRouter.abi")
-uniswap_pool = verbs.abi.load_abi(f"{PATH}/UniswapV3Pool.abi")
-quoter = verbs.abi.load_abi(f"{PATH}/Quoter_v2.abi")
+def __dir__():
+    return sorted(set(globals()) | set(ABI_FILES))
@@ -1,10 +1,25 @@
-from typing import Tuple
+from typing import Optional, Sequence, Tuple
 
 import numpy as np
 import verbs
 
+from simulations.utils.calldata import UINT, CalldataTemplate
+
 
 class BorrowAgent:
+    # names and types of the values returned by record
+    record_fields = (
+        ("step", np.int64),
+        ("health_factor", np.float64),
+        ("debt_assets", np.float64),
+        ("collateral_assets", np.float64),
+        ("price_collateral", np.float64),
+    )
+    # number of view calls made to record each field
+    record_view_calls = dict(
+        step=0, health_factor=1, debt_assets=1, collateral_assets=1, price_collateral=1
+    )
+
     def __init__(
         self,
         env,
@@ -22,6 +37,9 @@ class BorrowAgent:
         lltv: int,
         activation_rate: float,
         initial_ltv: float,
+        collateral_amount: int = 10,
+        has_position: bool = False,
+        position_reader=None,
     ):
         self.address = verbs.utils.int_to_address(i)
         env.create_account(self.address, int(1e30))
@@ -63,8 +81,37 @@ class BorrowAgent:
             env, self.address, self.token_b_address, []
         )[0][0]
 
-        self.has_borrowed = False
-        self.has_supplied = False
+        # calldata of the transactions and view calls of the agent
+        self.supply_collateral_template = CalldataTemplate(
+            morpho_blue_abi.supplyCollateral,
+            [self.market_params, UINT, self.address, b""],
+        )
+        self.borrow_template = CalldataTemplate(
+            morpho_blue_abi.borrow,
+            [self.market_params, UINT, 0, self.address, self.address],
+        )
+        self.health_factor_template = CalldataTemplate(
+            morpho_blue_snippets_abi.userHealthFactor,
+            [self.market_params, self.id_market, self.address],
+        )
+        self.debt_assets_template = CalldataTemplate(
+            morpho_blue_snippets_abi.borrowAssetsUser,
+            [self.market_params, self.address],
+        )
+        self.collateral_assets_template = CalldataTemplate(
+            morpho_blue_snippets_abi.collateralAssetsUser,
+            [self.id_market, self.address],
+        )
+        self.price_template = CalldataTemplate(oracle_abi.price, [])
+
+        # amount of collateral supplied (in tokens)
+        self.collateral_amount = collateral_amount
+        # whether the position was already opened before the simulation
+        self.has_borrowed = has_position
+        self.has_supplied = has_position
+        # optional reader of positions (e.g. a market mirror) used
+        # instead of the snippets to record the position
+        self.position_reader = position_reader
 
         assert (
             0 < activation_rate and activation_rate < 1
@@ -76,92 +123,97 @@ class BorrowAgent:
     def update(self, rng: np.random.Generator, env):
         self.step += 1
         tx = []
-        collateral_amount = 10
+        collateral_amount = self.collateral_amount
         if rng.random() < self.activation_rate:
             if not self.has_supplied:
-                supply_tx = self.morpho_blue_abi.supplyCollateral.transaction(
+                supply_tx = self.supply_collateral_template.transaction(
                     self.address,
                     self.morpho_blue_address,
-                    [
-                        self.market_params,
-                        collateral_amount
-                        * 10**self.decimals_token_a,  # supply 100 tokens of
-                        self.address,
-                        b"",
-                    ],
+                    collateral_amount * 10**self.decimals_token_a,
                 )
                 self.has_supplied = True
                 tx.append(supply_tx)
             elif not self.has_borrowed:
                 # borrow
-                price_collateral = (
-                    self.oracle_abi.price.call(
-                        env,
-                        self.address,
-                        self.oracle_address,
-                        [],
-                    )[0][0]
-                    / 10**36
-                )  # MB oracle returns the price with 36 decimals
+                price_collateral = self.get_price_collateral(env)
                 u = rng.uniform(low=0.9, high=1.0)
                 borrow_amount = (
                     u * price_collateral * collateral_amount * self.initial_ltv
                 )
-                borrow_tx = self.morpho_blue_abi.borrow.transaction(
+                borrow_tx = self.borrow_template.transaction(
                     self.address,
                     self.morpho_blue_address,
-                    [
-                        self.market_params,
-                        int(borrow_amount * 10**self.decimals_token_b),
-                        0,
-                        self.address,
-                        self.address,
-                    ],
+                    int(borrow_amount * 10**self.decimals_token_b),
                 )
                 self.has_borrowed = True
                 tx.append(borrow_tx)
         return tx
 
-    def record(self, env) -> Tuple[int, float, float, float, float]:
-        """Record the state of the agent"""
-        health_factor = (
-            self.morpho_blue_snippets_abi.userHealthFactor.call(
-                env,
-                self.address,
-                self.morpho_blue_snippets_address,
-                [self.market_params, self.id_market, self.address],
+    def get_health_factor(self, env) -> float:
+        return (
+            self.health_factor_template.call(
+                env, self.address, self.morpho_blue_snippets_address
             )[0][0]
             / 10**18
         )
-        debt_assets = (
-            self.morpho_blue_snippets_abi.borrowAssetsUser.call(
-                env,
-                self.address,
-                self.morpho_blue_snippets_address,
-                [self.market_params, self.address],
+
+    def get_debt_assets(self, env) -> float:
+        return (
+            self.debt_assets_template.call(
+                env, self.address, self.morpho_blue_snippets_address
             )[0][0]
             / 10**self.decimals_token_b
         )
-        collateral_assets = (
-            self.morpho_blue_snippets_abi.collateralAssetsUser.call(
-                env,
-                self.address,
-                self.morpho_blue_snippets_address,
-                [self.id_market, self.address],
+
+    def get_collateral_assets(self, env) -> float:
+        return (
+            self.collateral_assets_template.call(
+                env, self.address, self.morpho_blue_snippets_address
             )[0][0]
             / 10**self.decimals_token_a
         )
-        price_collateral = (
-            self.oracle_abi.price.call(env, self.address, self.oracle_address, [],)[
-                0
-            ][0]
+
+    def get_price_collateral(self, env) -> float:
+        return (
+            self.price_template.call(env, self.address, self.oracle_address)[0][0]
             / 10**36
         )  # MB oracle returns the price with 36 decimals
 
-        return (
-            self.step,
-            health_factor,
-            debt_assets,
-            collateral_assets,
-            price_collateral,
+    def record(self, env, fields: Optional[Sequence[str]] = None) -> Tuple:
+        """
+        Record the state of the agent
+
+        Parameters
+        ----------
+        env
+            Simulation environment.
+        fields: Sequence[str], optional
+            Names of the recorded fields, by default all the
+            ``record_fields`` in order. Only the view calls required by
+            these fields are made.
+        """
+        getters = dict(
+            step=lambda env: self.step,
+            health_factor=self.get_health_factor,
+            debt_assets=self.get_debt_assets,
+            collateral_assets=self.get_collateral_assets,
+            price_collateral=self.get_price_collateral,
         )
+        if fields is None:
+            fields = [field for field, _ in self.record_fields]
+        if self.position_reader is not None and {
+            "health_factor",
+            "debt_assets",
+            "collateral_assets",
+        }.intersection(fields):
+            positions = self.position_reader.read(env, self.address, [self.address])
+            getters.update(
+                health_factor=lambda env: float(positions.health_factor[0]),
+                debt_assets=lambda env: (
+                    positions.debt_assets[0] / 10**self.decimals_token_b
+                ),
+                collateral_assets=lambda env: (
+                    positions.collateral[0] / 10**self.decimals_token_a
+                ),
+            )
+        return tuple(getters[field](env) for field in fields)
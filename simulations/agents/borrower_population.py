@@ -0,0 +1,251 @@
+from typing import Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from simulations.agents.borrow_agent import BorrowAgent
+from simulations.utils.calldata import ADDRESS, UINT, CalldataTemplate
+from simulations.utils.position_reader import (
+    PositionReader,
+    Positions,
+    to_float,
+)
+
+
+class BorrowerPopulation:
+    """
+    Population of borrowers stored in arrays
+
+    Follows the behaviour of :py:class:`BorrowAgent` for a whole
+    population of borrowers: at each step every borrower is activated
+    with probability ``activation_rate``, and when activated supplies its
+    collateral, or borrows if it already supplied it. Activations and
+    borrowed amounts of all the borrowers are drawn at once, and the
+    market parameters, token decimals and oracle price are shared.
+    Positions of all the recorded borrowers are read at once.
+
+    Parameters
+    ----------
+    env
+        Simulation environment.
+    addresses: Sequence[bytes]
+        Addresses of the borrowers.
+    morpho_blue_abi
+        Morpho Blue ABI.
+    mintable_erc20_abi
+        ERC20 ABI.
+    oracle_abi
+        Oracle ABI.
+    morpho_blue_snippets_abi
+        Morpho Blue snippets ABI.
+    morpho_blue_address: bytes
+        Address of Morpho Blue.
+    morpho_blue_snippets_address: bytes
+        Address of the snippets contract.
+    token_a_address: bytes
+        Address of the collateral asset.
+    token_b_address: bytes
+        Address of the debt asset.
+    oracle_address: bytes
+        Address of the oracle of the market.
+    irm_address: bytes
+        Address of the interest rate model of the market.
+    lltv: int
+        LLTV of the market.
+    activation_rate: float
+        Probability of a borrower being activated at each step.
+    initial_ltv: float | np.ndarray
+        Target LTV of the borrowers when borrowing.
+    collateral_amount: int | np.ndarray, optional
+        Collateral supplied by the borrowers (in tokens).
+    has_position: bool, optional
+        Whether the positions were already opened before the simulation.
+    position_reader: PositionReader, optional
+        Reader of the positions (e.g. a
+        :py:class:`simulations.utils.market_mirror.MarketMirror`), by
+        default a reader of the positions in the EVM.
+    """
+
+    record_fields = BorrowAgent.record_fields
+    record_view_calls = BorrowAgent.record_view_calls
+
+    def __init__(
+        self,
+        env,
+        addresses: Sequence[bytes],
+        morpho_blue_abi,
+        mintable_erc20_abi,
+        oracle_abi,
+        morpho_blue_snippets_abi,
+        morpho_blue_address: bytes,
+        morpho_blue_snippets_address: bytes,
+        token_a_address: bytes,
+        token_b_address: bytes,
+        oracle_address: bytes,
+        irm_address: bytes,
+        lltv: int,
+        activation_rate: float,
+        initial_ltv: Union[float, np.ndarray],
+        collateral_amount: Union[int, np.ndarray] = 10,
+        has_position: bool = False,
+        position_reader: Optional[PositionReader] = None,
+    ):
+        self.addresses = list(addresses)
+        self.size = len(self.addresses)
+        for address in self.addresses:
+            env.create_account(address, int(1e30))
+        # Sender of the view calls of the population
+        self.address = self.addresses[0]
+
+        self.morpho_blue_abi = morpho_blue_abi
+        self.oracle_abi = oracle_abi
+        self.morpho_blue_snippets_abi = morpho_blue_snippets_abi
+        self.morpho_blue_address = morpho_blue_address
+        self.morpho_blue_snippets_address = morpho_blue_snippets_address
+        self.oracle_address = oracle_address
+
+        self.market_params = (
+            token_b_address,
+            token_a_address,
+            oracle_address,
+            irm_address,
+            lltv,
+        )
+        if position_reader is None:
+            position_reader = PositionReader(
+                morpho_blue_abi=morpho_blue_abi,
+                morpho_blue_snippets_abi=morpho_blue_snippets_abi,
+                oracle_abi=oracle_abi,
+                morpho_blue_address=morpho_blue_address,
+                morpho_blue_snippets_address=morpho_blue_snippets_address,
+                market_params=self.market_params,
+            )
+        self.position_reader = position_reader
+        self.decimals_token_a = mintable_erc20_abi.decimals.call(
+            env, self.address, token_a_address, []
+        )[0][0]
+        self.decimals_token_b = mintable_erc20_abi.decimals.call(
+            env, self.address, token_b_address, []
+        )[0][0]
+
+        # calldata of the transactions and view calls of the borrowers
+        self.supply_collateral_template = CalldataTemplate(
+            morpho_blue_abi.supplyCollateral, [self.market_params, UINT, ADDRESS, b""]
+        )
+        self.borrow_template = CalldataTemplate(
+            morpho_blue_abi.borrow, [self.market_params, UINT, 0, ADDRESS, ADDRESS]
+        )
+        self.price_template = CalldataTemplate(oracle_abi.price, [])
+
+        self.initial_ltv = np.broadcast_to(
+            np.asarray(initial_ltv, dtype=np.float64), (self.size,)
+        )
+        self.collateral_amount = np.broadcast_to(
+            np.asarray(collateral_amount, dtype=np.int64), (self.size,)
+        )
+        self.has_supplied = np.full(self.size, has_position)
+        self.has_borrowed = np.full(self.size, has_position)
+
+        assert (
+            0 < activation_rate and activation_rate < 1
+        ), "activation_rate has to be between 0 and 1"
+        self.activation_rate = activation_rate
+
+        self.step = 0
+
+    def update(self, rng: np.random.Generator, env):
+        self.step += 1
+        active = rng.random(self.size) < self.activation_rate
+        supply = np.flatnonzero(active & ~self.has_supplied)
+        borrow = np.flatnonzero(active & self.has_supplied & ~self.has_borrowed)
+
+        tx = [
+            self.supply_collateral_template.transaction(
+                self.addresses[i],
+                self.morpho_blue_address,
+                int(self.collateral_amount[i]) * 10**self.decimals_token_a,
+                self.addresses[i],
+            )
+            for i in supply
+        ]
+
+        if len(borrow) > 0:
+            price_collateral = self.get_price_collateral(env)
+            u = rng.uniform(low=0.9, high=1.0, size=len(borrow))
+            borrow_amount = (
+                u
+                * price_collateral
+                * self.collateral_amount[borrow]
+                * self.initial_ltv[borrow]
+            )
+            tx.extend(
+                self.borrow_template.transaction(
+                    self.addresses[i],
+                    self.morpho_blue_address,
+                    int(amount * 10**self.decimals_token_b),
+                    self.addresses[i],
+                    self.addresses[i],
+                )
+                for i, amount in zip(borrow, borrow_amount)
+            )
+
+        self.has_supplied[supply] = True
+        self.has_borrowed[borrow] = True
+        return tx
+
+    def get_positions(self, env, index: np.ndarray) -> Positions:
+        """Positions of the borrowers, read in a single batch"""
+        return self.position_reader.read(
+            env, self.address, [self.addresses[i] for i in index]
+        )
+
+    def get_price_collateral(self, env) -> float:
+        return (
+            self.price_template.call(env, self.address, self.oracle_address)[0][0]
+            / 10**36
+        )  # MB oracle returns the price with 36 decimals
+
+    def record(
+        self,
+        env,
+        fields: Optional[Sequence[str]] = None,
+        index: Optional[np.ndarray] = None,
+    ) -> Tuple[np.ndarray, ...]:
+        """
+        Record the state of the borrowers
+
+        Parameters
+        ----------
+        env
+            Simulation environment.
+        fields: Sequence[str], optional
+            Names of the recorded fields, by default all the
+            ``record_fields`` in order.
+        index: np.ndarray, optional
+            Indices of the recorded borrowers, by default all of them.
+
+        Returns
+        -------
+        Tuple[np.ndarray, ...]
+            Values of each field for the recorded borrowers.
+        """
+        if index is None:
+            index = np.arange(self.size)
+        if fields is None:
+            fields = [field for field, _ in self.record_fields]
+
+        if {"health_factor", "debt_assets", "collateral_assets"}.intersection(fields):
+            positions = self.get_positions(env, index)
+        getters = dict(
+            step=lambda: np.full(len(index), self.step),
+            health_factor=lambda: positions.health_factor,
+            debt_assets=lambda: to_float(
+                positions.debt_assets, 10**self.decimals_token_b
+            ),
+            collateral_assets=lambda: to_float(
+                positions.collateral, 10**self.decimals_token_a
+            ),
+            price_collateral=lambda: np.full(
+                len(index), self.get_price_collateral(env)
+            ),
+        )
+        return tuple(getters[field]() for field in fields)
@@ -1,11 +1,24 @@
-from typing import List, Tuple
+from typing import List, Optional, Sequence, Tuple
 
-import eth_abi
 import numpy as np
 import verbs
 
+from simulations.utils import morpho
+from simulations.utils.calldata import ADDRESS, UINT, CalldataTemplate
+from simulations.utils.liquidation_index import LiquidationPriceIndex
+from simulations.utils.market_mirror import MarketMirror
+from simulations.utils.position_reader import PositionReader, Positions
+
 
 class LiquidationAgent:
+    # names and types of the values returned by record
+    record_fields = (
+        ("balance_debt_asset", np.float64),
+        ("balance_collateral_asset", np.float64),
+    )
+    # number of view calls made to record each field
+    record_view_calls = dict(balance_debt_asset=1, balance_collateral_asset=1)
+
     def __init__(
         self,
         env,
@@ -30,6 +43,7 @@ class LiquidationAgent:
         swap_router_address: bytes,
         uniswap_fee: int,
         hf_threshold: float,
+        position_reader: Optional[PositionReader] = None,
     ):
 
         self.address = verbs.utils.int_to_address(i)
@@ -73,6 +87,17 @@ class LiquidationAgent:
         )[0][0]
 
         self.borrow_address = borrow_address
+        # reads the positions of all the borrowers at once
+        if position_reader is None:
+            position_reader = PositionReader(
+                morpho_blue_abi=morpho_blue_abi,
+                morpho_blue_snippets_abi=morpho_blue_snippets_abi,
+                oracle_abi=oracle_abi,
+                morpho_blue_address=morpho_blue_address,
+                morpho_blue_snippets_address=morpho_blue_snippets_address,
+                market_params=self.market_params,
+            )
+        self.position_reader = position_reader
         self.step = 0
 
         # Uniswap variables
@@ -84,6 +109,33 @@ class LiquidationAgent:
         self.swap_router_address = swap_router_address
         self.uniswap_fee = uniswap_fee
 
+        # calldata of the transactions and view calls of the agent
+        self.balance_template = CalldataTemplate(
+            mintable_erc20_abi.balanceOf, [self.address]
+        )
+        self.quote_template = CalldataTemplate(
+            quoter_abi.quoteExactOutputSingle,
+            [(self.token_a_address, self.token_b_address, UINT, self.uniswap_fee, 0)],
+        )
+        self.liquidate_template = CalldataTemplate(
+            morpho_blue_abi.liquidate, [self.market_params, ADDRESS, UINT, 0, b""]
+        )
+        self.swap_template = CalldataTemplate(
+            swap_router_abi.exactOutputSingle,
+            [
+                (
+                    self.token_a_address,
+                    self.token_b_address,
+                    self.uniswap_fee,
+                    self.address,
+                    10**32,
+                    UINT,
+                    UINT,
+                    0,
+                )
+            ],
+        )
+
         # balance of token a and token b
         self.balance_collateral_asset = []
         self.balance_debt_asset = []
@@ -91,116 +143,91 @@ class LiquidationAgent:
         # HF threshold to look for liquidations
         self.hf_threshold = hf_threshold
 
+        # positions of mirrored borrowers are only read once the oracle
+        # price crosses their liquidation price
+        self.liquidation_index = None
+        if isinstance(position_reader, MarketMirror) and all(
+            address in position_reader.index for address in borrow_address
+        ):
+            self.liquidation_index = LiquidationPriceIndex(
+                position_reader, hf_threshold
+            )
+            self.borrow_index = {address: i for i, address in enumerate(borrow_address)}
+
     def accountability(
         self,
         env,
-        liquidation_address: bytes,
-    ) -> bool:
+        positions: Positions,
+        balance_debt_asset: int,
+    ) -> np.ndarray:
         """
-        Makes the accountability of a liquidation and returns a bool indicating
-        whether a liquidation is profitable or not
+        Makes the accountability of the liquidation of half of the collateral of
+        positions and returns a bool array indicating whether each liquidation
+        is profitable or not
+
+        Repaid assets are computed with the liquidation math of Morpho Blue for
+        all the positions at once, only the liquidations that would go through
+        are quoted on Uniswap.
         """
-        _debt_shares, collateral_assets = self.morpho_blue_abi.position.call(
-            env,
-            self.address,
-            self.morpho_blue_address,
-            [self.id_market, liquidation_address],
-        )[0][1:]
-        seized_assets = collateral_assets // 2
-        liquidation_call_event = self.morpho_blue_abi.liquidate.call(
-            env,
-            self.address,
-            self.morpho_blue_address,
-            [self.market_params, liquidation_address, seized_assets, 0, b""],
-        )[1]
-        try:
-            decoded_liquidation_call_event = self.morpho_blue_abi.Liquidate.decode(
-                liquidation_call_event[2][1]
-            )  # Liquidate event is the third event emitted
-        except eth_abi.exceptions.InsufficientDataBytes:
-            # The liquidation did not go through because the position was actually healthy
-            # Morpho Blue Snippets sometimes returns a Health Factor that does not
-            # correspond to the output of the function `_is_Healthy`
-            # in https://github.com/morpho-org/morpho-blue/blob/ \
-            # 129f8f9c0f65bc797fab93a6ba8e7046ca4490d3/src/Morpho.sol#L527
-            return False
-        debt_to_cover = decoded_liquidation_call_event[0]
-        liquidated_collateral_amount = decoded_liquidation_call_event[2]
-
-        quote = self.quoter_abi.quoteExactOutputSingle.call(
-            env,
-            self.address,
-            self.quoter_address,
-            [
-                (
-                    self.token_a_address,
-                    self.token_b_address,
-                    debt_to_cover,
-                    self.uniswap_fee,
-                    0,
-                )
-            ],
-        )[0]
-        amount_collateral_from_swap = quote[0]
+        seized_assets = positions.collateral // 2
+        repaid_assets, valid = morpho.liquidate(
+            positions.borrow_shares,
+            positions.collateral,
+            seized_assets,
+            positions.total_borrow_assets,
+            positions.total_borrow_shares,
+            positions.price,
+            self.lltv,
+        )
+        # The liquidator has to hold the repaid assets
+        valid &= np.asarray(repaid_assets <= balance_debt_asset, dtype=bool)
 
-        return amount_collateral_from_swap < liquidated_collateral_amount
+        profitable = np.zeros(len(seized_assets), dtype=bool)
+        for i in np.flatnonzero(valid):
+            quote = self.quote_template.call(
+                env, self.address, self.quoter_address, int(repaid_assets[i])
+            )[0]
+            amount_collateral_from_swap = quote[0]
+            profitable[i] = amount_collateral_from_swap < seized_assets[i]
+        return profitable
 
     def update(self, rng: np.random.Generator, env) -> List:
 
-        current_balance_collateral_asset = self.mintable_erc20_abi.balanceOf.call(
-            env,
-            self.address,
-            self.token_a_address,
-            [
-                self.address,
-            ],
+        current_balance_collateral_asset = self.balance_template.call(
+            env, self.address, self.token_a_address
         )[0][0]
-        current_balance_debt_asset = self.mintable_erc20_abi.balanceOf.call(
-            env,
-            self.address,
-            self.token_b_address,
-            [
-                self.address,
-            ],
+        current_balance_debt_asset = self.balance_template.call(
+            env, self.address, self.token_b_address
         )[0][0]
 
-        borrowers_data = []
-        for borrower in self.borrow_address:
-            health_factor = (
-                self.morpho_blue_snippets_abi.userHealthFactor.call(
-                    env,
-                    self.address,
-                    self.morpho_blue_snippets_address,
-                    [self.market_params, self.id_market, borrower],
-                )[0][0]
-                / 10**18
-            )
-            borrowers_data.append((borrower, health_factor))
-
         # filter risky positions
-        risky_positions = filter(lambda x: x[1] < self.hf_threshold, borrowers_data)
+        candidates = self.get_candidates(env)
+        positions = self.position_reader.read(
+            env, self.address, [self.borrow_address[i] for i in candidates]
+        )
+        risky = positions.health_factor < self.hf_threshold
+        risky_positions = positions.take(risky)
 
         # filter those positions for which liquidating is profitable
-        liquidatable_positions = filter(
-            lambda x: self.accountability(
-                env,
-                x[0],
-            ),
-            risky_positions,
+        profitable = self.accountability(
+            env, risky_positions, current_balance_debt_asset
         )
+        liquidatable_positions = [
+            (self.borrow_address[i], int(collateral))
+            for i, collateral in zip(
+                candidates[risky][profitable], risky_positions.collateral[profitable]
+            )
+        ]
 
         # create transaction
         tx = []
-        for borrower, health_factor in liquidatable_positions:
-            _debt_shares, collateral_assets = self.morpho_blue_abi.position.call(
-                env, self.address, self.morpho_blue_address, [self.id_market, borrower]
-            )[0][1:]
-
+        for borrower, collateral in liquidatable_positions:
             tx.append(
-                self.morpho_blue_abi.liquidate.transaction(
+                self.liquidate_template.transaction(
                     self.address,
                     self.morpho_blue_address,
-                    [self.market_params, borrower, collateral_assets // 2, 0, b""],
+                    borrower,
+                    collateral // 2,
                     checked=False,  # sim does not crash if revert
                 )
             )
@@ -209,21 +236,11 @@ class LiquidationAgent:
             # check if liquidator has open short position in the debt asset
             if self.balance_debt_asset[-1] > current_balance_debt_asset:
                 debt = self.balance_debt_asset[-1] - current_balance_debt_asset
-                swap_tx = self.swap_router_abi.exactOutputSingle.transaction(
+                swap_tx = self.swap_template.transaction(
                     self.address,
                     self.swap_router_address,
-                    [
-                        (
-                            self.token_a_address,
-                            self.token_b_address,
-                            self.uniswap_fee,
-                            self.address,
-                            10**32,
-                            debt,
-                            current_balance_collateral_asset,
-                            0,
-                        )
-                    ],
+                    debt,
+                    current_balance_collateral_asset,
                 )
                 tx.append(swap_tx)
 
@@ -234,20 +251,55 @@ class LiquidationAgent:
         self.step += 1
         return tx
 
-    def record(self, env) -> Tuple[float, float]:
+    def get_candidates(self, env) -> np.ndarray:
+        """
+        Indices of the borrowers whose health factor may be below the
+        threshold, all of them if the positions are not indexed
+        """
+        if self.liquidation_index is None:
+            return np.arange(len(self.borrow_address))
+        total_borrow_assets, price = self.position_reader.market_state(
+            env, self.address
+        )
+        self.liquidation_index.update(total_borrow_assets)
+        mirrored = self.position_reader.borrowers
+        return np.array(
+            sorted(
+                self.borrow_index[mirrored[j]]
+                for j in self.liquidation_index.crossed(price)
+                if mirrored[j] in self.borrow_index
+            ),
+            dtype=np.int64,
+        )
 
-        balance_debt_asset = (
-            self.mintable_erc20_abi.balanceOf.call(
-                env, self.address, self.token_b_address, [self.address]
-            )[0][0]
+    def get_balance_debt_asset(self, env) -> float:
+        return (
+            self.balance_template.call(env, self.address, self.token_b_address)[0][0]
             / 10**self.decimals_token_b
         )
 
-        balance_collateral_asset = (
-            self.mintable_erc20_abi.balanceOf.call(
-                env, self.address, self.token_a_address, [self.address]
-            )[0][0]
+    def get_balance_collateral_asset(self, env) -> float:
+        return (
+            self.balance_template.call(env, self.address, self.token_a_address)[0][0]
             / 10**self.decimals_token_a
         )
 
-        return balance_debt_asset, balance_collateral_asset
+    def record(self, env, fields: Optional[Sequence[str]] = None) -> Tuple:
+        """
+        Record the state of the agent
+
+        Parameters
+        ----------
+        env
+            Simulation environment.
+        fields: Sequence[str], optional
+            Names of the recorded fields, by default all the
+            ``record_fields`` in order.
+        """
+        getters = dict(
+            balance_debt_asset=self.get_balance_debt_asset,
+            balance_collateral_asset=self.get_balance_collateral_asset,
+        )
+        if fields is None:
+            fields = [field for field, _ in self.record_fields]
+        return tuple(getters[field](env) for field in fields)
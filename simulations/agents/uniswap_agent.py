@@ -1,10 +1,13 @@
+import abc
 import math
 import typing
 
 import eth_abi
 import numpy as np
 import verbs
-from scipy.optimize import root_scalar
+
+from simulations.agents.uniswap_v3 import TickTable
+from simulations.utils.calldata import UINT, CalldataTemplate
 
 TICK_SPACING = {100: 1, 500: 10, 3000: 60, 10000: 200}
 
@@ -34,7 +37,37 @@ def price_from_tick(tick: int) -> int:
     return sqrt_price_x96
 
 
-class Gbm:
+class ExternalMarket(abc.ABC):
+    """
+    External market quoting the prices of tokens A and B in USD.
+    Token B is assumed to be some stablecoin, so its price remains constant.
+
+    Subclasses implement :py:meth:`update`, moving the price of token A
+    by one simulation step.
+    """
+
+    def __init__(self, token_a_price: float, token_b_price: float):
+        self.token_a_price = token_a_price
+        self.token_b_price = token_b_price
+        self.token_a_price_with_impact = token_a_price
+
+    @abc.abstractmethod
+    def update(self, rng: np.random.Generator, price_impact: float):
+        """Move the price of token A by one step"""
+
+    def get_sqrt_price_token_a_x96(self):
+        price = self.token_a_price_with_impact / self.token_b_price
+        return np.sqrt(price) * 2**96
+
+    def get_sqrt_price_token_b_x96(self):
+        price = self.token_b_price / self.token_a_price_with_impact
+        return np.sqrt(price) * 2**96
+
+    def get_price_token_a(self):
+        return self.token_a_price_with_impact / self.token_b_price
+
+
+class Gbm(ExternalMarket):
     """
     Geometric brownian motion modelling the price of tokens A and B in USD.
     We assume that token B is some stablecoin so its price remains constant.
@@ -43,11 +76,9 @@ class Gbm:
     def __init__(
         self, mu: float, sigma: float, token_a_price: int, token_b_price: int, dt: float
     ):
+        super().__init__(token_a_price=token_a_price, token_b_price=token_b_price)
         self.mu = mu
         self.sigma = sigma
-        self.token_a_price = token_a_price
-        self.token_b_price = token_b_price
-        self.token_a_price_with_impact = token_a_price
         self.dt = dt
 
     def update(self, rng: np.random.Generator, price_impact: float):
@@ -68,16 +99,87 @@ class Gbm:
         self.token_a_price = new_price_a
         self.token_a_price_with_impact = new_price_a_w_impact
 
-    def get_sqrt_price_token_a_x96(self):
-        price = self.token_a_price_with_impact / self.token_b_price
-        return np.sqrt(price) * 2**96
 
-    def get_sqrt_price_token_b_x96(self):
-        price = self.token_b_price / self.token_a_price_with_impact
-        return np.sqrt(price) * 2**96
+def gbm_paths(
+    rng: np.random.Generator,
+    mu: typing.Union[float, np.ndarray],
+    sigma: typing.Union[float, np.ndarray],
+    dt: float,
+    n_steps: int,
+    n_paths: int = 1,
+    antithetic: bool = False,
+) -> np.ndarray:
+    """
+    Generate geometric brownian motion paths
+
+    All the increments are drawn and accumulated at once. The drift and
+    volatility can change over time, e.g. to switch the drift of the
+    market halfway through a simulation.
+
+    Parameters
+    ----------
+    rng: np.random.Generator
+        Random generator.
+    mu: float | np.ndarray
+        Drift, or drift at each step (array of shape ``(n_steps,)``).
+    sigma: float | np.ndarray
+        Volatility, or volatility at each step.
+    dt: float
+        Time step.
+    n_steps: int
+        Number of steps of the paths.
+    n_paths: int, optional
+        Number of paths.
+    antithetic: bool, optional
+        If ``True`` the opposite of the normal draws are used, i.e. the
+        paths are the antithetic paths of those drawn with the same
+        generator state.
+
+    Returns
+    -------
+    np.ndarray
+        Prices relative to the initial price, of shape
+        ``(n_paths, n_steps)``, i.e. ``P_{t+1} / P_0`` for each step.
+    """
+    mu = np.broadcast_to(np.asarray(mu, dtype=np.float64), (n_steps,))
+    sigma = np.broadcast_to(np.asarray(sigma, dtype=np.float64), (n_steps,))
+    z = rng.standard_normal((n_paths, n_steps))
+    if antithetic:
+        z = -z
+    log_returns = (mu - 0.5 * sigma**2) * dt + sigma * np.sqrt(dt) * z
+    return np.exp(np.cumsum(log_returns, axis=1))
 
-    def get_price_token_a(self):
-        return self.token_a_price_with_impact / self.token_b_price
+
+class PricePath(ExternalMarket):
+    """
+    External market following a pre-generated price path
+
+    The price of token A at each step is read from the path (e.g.
+    generated with :py:func:`gbm_paths`), with the price impact of the
+    trades added on top, as for :py:class:`Gbm`. The path is not
+    copied, so paths can be shared between simulations.
+
+    Parameters
+    ----------
+    path: np.ndarray
+        Price of token A relative to its initial price at each step.
+    token_a_price: float
+        Initial price of token A.
+    token_b_price: float
+        Price of token B.
+    """
+
+    def __init__(self, path: np.ndarray, token_a_price: float, token_b_price: float):
+        super().__init__(token_a_price=token_a_price, token_b_price=token_b_price)
+        self.path = path
+        self.initial_token_a_price = token_a_price
+        self.step = 0
+
+    def update(self, rng: np.random.Generator, price_impact: float):
+        """Move to the next price of the path"""
+        self.token_a_price = self.initial_token_a_price * self.path[self.step]
+        self.token_a_price_with_impact = self.token_a_price + price_impact
+        self.step += 1
 
 
 class BaseUniswapAgent:
@@ -96,6 +198,8 @@ class BaseUniswapAgent:
         token_a_address: bytes,
         # token B is considered to be less risky / stablecoin
         token_b_address: bytes,
+        swap_math: bool = True,
+        verify_swaps: bool = False,
     ):
         self.address = verbs.utils.int_to_address(i)
         env.create_account(self.address, int(1e25))
@@ -119,14 +223,106 @@ class BaseUniswapAgent:
         )[0][0]
         self.fee = fee
 
+        # calldata of the transactions and view calls of the agent
+        self.slot0_template = CalldataTemplate(uniswap_pool_abi.slot0, [])
+        self.liquidity_template = CalldataTemplate(uniswap_pool_abi.liquidity, [])
+        self.quote_input_template = CalldataTemplate(
+            quoter_abi.quoteExactInputSingle,
+            [(self.token1_address, self.token0_address, UINT, fee, 0)],
+        )
+        self.quote_output_template = CalldataTemplate(
+            quoter_abi.quoteExactOutputSingle,
+            [(self.token0_address, self.token1_address, UINT, fee, 0)],
+        )
+        self.swap_input_template = CalldataTemplate(
+            swap_router_abi.exactInputSingle,
+            [
+                (
+                    self.token1_address,
+                    self.token0_address,
+                    fee,
+                    self.address,
+                    10**32,
+                    UINT,
+                    0,
+                    0,
+                )
+            ],
+        )
+        self.swap_output_template = CalldataTemplate(
+            swap_router_abi.exactOutputSingle,
+            [
+                (
+                    self.token0_address,
+                    self.token1_address,
+                    fee,
+                    self.address,
+                    10**32,
+                    UINT,
+                    10**32,
+                    0,
+                )
+            ],
+        )
+
+        # Ticks of the pool used to compute swap sizes without the quoter.
+        # The net liquidity of the ticks does not change during the simulation
+        if swap_math:
+            self.tick_table = TickTable.from_snapshot(
+                env.export_snapshot(),
+                self.uniswap_pool_address,
+                tick_spacing=TICK_SPACING[fee],
+                fee=fee,
+            )
+        else:
+            self.tick_table = None
+        # Check swap sizes against the quoter
+        self.verify_swaps = verify_swaps
+
+    def get_swap_size_from_ticks(
+        self, env, sqrt_target_price_x96: int, liquidity: int, quote_price
+    ) -> int:
+        """
+        Amount of token1 to swap so that the Uniswap price matches the
+        target price, computed from the ticks of the pool.
+
+        The amount is sold if the target price is above the current
+        price and bought otherwise. Raises a ``ValueError`` if the swap
+        crosses ticks missing from the simulation state, as the swap would
+        then fail in the EVM.
+        """
+        slot0, _, _ = self.slot0_template.call(
+            env, self.address, self.uniswap_pool_address
+        )
+        try:
+            amount, sqrt_price_after_x96 = self.tick_table.swap_to_price(
+                sqrt_price_x96=slot0[0],
+                tick=slot0[1],
+                liquidity=liquidity,
+                sqrt_target_price_x96=int(sqrt_target_price_x96),
+            )
+        except ValueError as e:
+            raise ValueError(
+                f"Arbitrage swap to sqrt price {int(sqrt_target_price_x96)} "
+                f"crosses ticks missing from the simulation state: {e}"
+            ) from e
+
+        if self.verify_swaps and amount > 0:
+            quoted_price = quote_price(amount)
+            assert (
+                quoted_price == sqrt_price_after_x96
+            ), f"Quoted price {quoted_price} differs from {sqrt_price_after_x96}"
+
+        return amount
+
     def get_sqrt_price_x96_uniswap(self, env) -> int:
         """get sqrt price from uniswap pool.
         Uniswap returns price of token0 in terms of token1
         """
 
-        slot0 = self.uniswap_pool_abi.slot0.call(
-            env, self.address, self.uniswap_pool_address, []
-        )[0]
+        slot0, _, _ = self.slot0_template.call(
+            env, self.address, self.uniswap_pool_address
+        )
         sqrt_price_uniswap_x96 = slot0[0]
         return sqrt_price_uniswap_x96
 
@@ -154,27 +350,25 @@ class BaseUniswapAgent:
             return None
 
         def _quote_price(change_token_1):
-            quote = self.quoter_abi.quoteExactInputSingle.call(
-                env,
-                self.address,
-                self.quoter_address,
-                [
-                    (
-                        self.token1_address,
-                        self.token0_address,
-                        int(change_token_1),
-                        self.fee,
-                        0,
-                    )
-                ],
+            quote = self.quote_input_template.call(
+                env, self.address, self.quoter_address, int(change_token_1)
             )[0]
             quoted_price = quote[1]
             return quoted_price
 
-        if exact:
+        if exact and self.tick_table is not None:
+            change_token_1 = self.get_swap_size_from_ticks(
+                env, sqrt_target_price_x96, liquidity, _quote_price
+            )
+            if not change_token_1:
+                return None
+        elif exact:
             # calculate the exact trade to match prices
             # this calculation will take into account
             # different liquidities in different tick ranges
+            # SciPy is only imported when the exact trade is solved for
+            from scipy.optimize import root_scalar
+
             try:
                 sol = root_scalar(
                     lambda x: _quote_price(x) - sqrt_target_price_x96,
@@ -186,21 +380,8 @@ class BaseUniswapAgent:
             except eth_abi.exceptions.ValueOutOfBounds:
                 return None
 
-        swap = self.swap_router_abi.exactInputSingle.transaction(
-            self.address,
-            self.swap_router_address,
-            [
-                (
-                    self.token1_address,
-                    self.token0_address,
-                    self.fee,
-                    self.address,
-                    10**32,
-                    int(change_token_1),
-                    0,
-                    0,
-                )
-            ],
+        swap = self.swap_input_template.transaction(
+            self.address, self.swap_router_address, int(change_token_1)
         )
         return swap
 
@@ -227,27 +408,25 @@ class BaseUniswapAgent:
             return None
 
         def _quote_price(change_token_1):
-            quote = self.quoter_abi.quoteExactOutputSingle.call(
-                env,
-                self.address,
-                self.quoter_address,
-                [
-                    (
-                        self.token0_address,
-                        self.token1_address,
-                        int(change_token_1),
-                        self.fee,
-                        0,
-                    )
-                ],
+            quote = self.quote_output_template.call(
+                env, self.address, self.quoter_address, int(change_token_1)
             )[0]
             quoted_price = quote[1]
             return quoted_price
 
-        if exact:
+        if exact and self.tick_table is not None:
+            change_token_1 = self.get_swap_size_from_ticks(
+                env, sqrt_target_price_x96, liquidity, _quote_price
+            )
+            if not change_token_1:
+                return None
+        elif exact:
             # calculate the exact trade to match prices
             # this calculation will take into account
             # different liquidities in different tick ranges
+            # SciPy is only imported when the exact trade is solved for
+            from scipy.optimize import root_scalar
+
             try:
                 sol = root_scalar(
                     lambda x: _quote_price(x) - sqrt_target_price_x96,
@@ -259,21 +438,8 @@ class BaseUniswapAgent:
             except eth_abi.exceptions.ValueOutOfBounds:
                 return None
 
-        swap = self.swap_router_abi.exactOutputSingle.transaction(
-            self.address,
-            self.swap_router_address,
-            [
-                (
-                    self.token0_address,
-                    self.token1_address,
-                    self.fee,
-                    self.address,
-                    10**32,
-                    int(change_token_1),
-                    10**32,
-                    0,
-                )
-            ],
+        swap = self.swap_output_template.transaction(
+            self.address, self.swap_router_address, int(change_token_1)
         )
         return swap
 
@@ -282,8 +448,19 @@ class UniswapAgent(BaseUniswapAgent):
     """
     Agent that makes trades in Uniswap and the external market in order
     to make arbitrage.
+
+    The external market price follows a :py:class:`Gbm`, or
+    ``price_path`` if provided (see :py:class:`PricePath`).
     """
 
+    # names and types of the values returned by record
+    record_fields = (
+        ("price_uniswap", np.float64),
+        ("price_external_market", np.float64),
+    )
+    # number of view calls made to record each field
+    record_view_calls = dict(price_uniswap=1, price_external_market=0)
+
     def __init__(
         self,
         env,
@@ -302,6 +479,9 @@ class UniswapAgent(BaseUniswapAgent):
         mu: float,
         sigma: float,
         dt: float,
+        swap_math: bool = True,
+        verify_swaps: bool = False,
+        price_path: typing.Optional[np.ndarray] = None,
     ):
         super().__init__(
             env=env,
@@ -315,6 +495,8 @@ class UniswapAgent(BaseUniswapAgent):
             fee=fee,
             token_a_address=token_a_address,
             token_b_address=token_b_address,
+            swap_math=swap_math,
+            verify_swaps=verify_swaps,
         )
 
         # external market model.
@@ -329,13 +511,21 @@ class UniswapAgent(BaseUniswapAgent):
             token_a_price = (2**96 / sqrt_price_uniswap_x96) ** 2
             token_b_price = 1
 
-        self.external_market = Gbm(
-            mu=mu,
-            sigma=sigma,
-            token_a_price=token_a_price,
-            token_b_price=token_b_price,
-            dt=dt,
-        )
+        # a pre-generated price path replaces the Gbm if provided
+        if price_path is None:
+            self.external_market = Gbm(
+                mu=mu,
+                sigma=sigma,
+                token_a_price=token_a_price,
+                token_b_price=token_b_price,
+                dt=dt,
+            )
+        else:
+            self.external_market = PricePath(
+                path=price_path,
+                token_a_price=token_a_price,
+                token_b_price=token_b_price,
+            )
         # Variables to calculate price impact of Uniswap on the external exchange
         self.dt = dt
         self.beta = 2.0
@@ -359,8 +549,8 @@ class UniswapAgent(BaseUniswapAgent):
             )
 
         # get liquidity from uniswap pool
-        liquidity = self.uniswap_pool_abi.liquidity.call(
-            env, self.address, self.uniswap_pool_address, []
+        liquidity = self.liquidity_template.call(
+            env, self.address, self.uniswap_pool_address
         )[0][0]
 
         # external market update
@@ -404,11 +594,13 @@ class UniswapAgent(BaseUniswapAgent):
         else:
             return []
 
-    def record(self, env):
+    def get_price_uniswap(self, env) -> float:
         # Get sqrt price from uniswap pool. Uniswap returns price of
         # token0 in terms of token1
-        sqrt_price_uniswap_x96 = self.get_sqrt_price_x96_uniswap(env)
+        sqrt_price_uniswap = self.get_sqrt_price_x96_uniswap(env) / 2**96
+        return sqrt_price_uniswap**2
 
+    def get_price_external_market(self, env) -> float:
         if self.token_b == self.token1_address:
             sqrt_price_external_market_x96 = (
                 self.external_market.get_sqrt_price_token_a_x96()
@@ -417,11 +609,30 @@ class UniswapAgent(BaseUniswapAgent):
             sqrt_price_external_market_x96 = (
                 self.external_market.get_sqrt_price_token_b_x96()
             )
-
-        sqrt_price_uniswap = sqrt_price_uniswap_x96 / 2**96
         sqrt_price_external_market = sqrt_price_external_market_x96 / (2**96)
+        return sqrt_price_external_market**2
 
-        return (sqrt_price_uniswap**2, sqrt_price_external_market**2)
+    def record(
+        self, env, fields: typing.Optional[typing.Sequence[str]] = None
+    ) -> typing.Tuple:
+        """
+        Record the state of the agent
+
+        Parameters
+        ----------
+        env
+            Simulation environment.
+        fields: typing.Sequence[str], optional
+            Names of the recorded fields, by default all the
+            ``record_fields`` in order.
+        """
+        getters = dict(
+            price_uniswap=self.get_price_uniswap,
+            price_external_market=self.get_price_external_market,
+        )
+        if fields is None:
+            fields = [field for field, _ in self.record_fields]
+        return tuple(getters[field](env) for field in fields)
 
     def get_price_impact_in_external_market(self, env) -> float:
         """
@@ -481,6 +692,8 @@ class DummyUniswapAgent(UniswapAgent):
             mu=0.1,
             sigma=0.6,
             dt=dt,
+            # the quoter is used to fetch the storage of the crossed ticks
+            swap_math=False,
         )
         self.sim_n_steps = sim_n_steps
 
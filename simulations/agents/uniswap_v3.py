@@ -0,0 +1,308 @@
+"""
+Uniswap V3 swap math
+
+Integer implementation of the Uniswap V3 swap loop (``TickMath``,
+``SqrtPriceMath``, ``SwapMath`` and ``TickBitmap`` libraries), used to
+compute the size of the swap moving the pool price to a target price
+without calling the quoter contract. Rounding follows the contracts, so
+the price after the computed swap is known exactly.
+
+Ref: https://github.com/Uniswap/v3-core/tree/main/contracts/libraries
+"""
+import typing
+
+from simulations.utils.storage import mapping_slot
+
+MIN_TICK = -887272
+MAX_TICK = 887272
+Q96 = 2**96
+FEE_DENOMINATOR = 10**6
+
+# Storage slots of the UniswapV3Pool contract
+POOL_SLOT0_SLOT = 0
+POOL_LIQUIDITY_SLOT = 4
+POOL_TICKS_SLOT = 5
+POOL_TICK_BITMAP_SLOT = 6
+
+# Constants of TickMath.getSqrtRatioAtTick, multipliers of the bits of |tick|
+_SQRT_RATIO_FACTORS = (
+    0xFFF97272373D413259A46990580E213A,
+    0xFFF2E50F5F656932EF12357CF3C7FDCC,
+    0xFFE5CACA7E10E4E61C3624EAA0941CD0,
+    0xFFCB9843D60F6159C9DB58835C926644,
+    0xFF973B41FA98C081472E6896DFB254C0,
+    0xFF2EA16466C96A3843EC78B326B52861,
+    0xFE5DEE046A99A2A811C461F1969C3053,
+    0xFCBE86C7900A88AEDCFFC83B479AA3A4,
+    0xF987A7253AC413176F2B074CF7815E54,
+    0xF3392B0822B70005940C7A398E4B70F3,
+    0xE7159475A2C29B7443B29C7FA6E889D9,
+    0xD097F3BDFD2022B8845AD8F792AA5825,
+    0xA9F746462D870FDF8A65DC1F90E061E5,
+    0x70D869A156D2A1B890BB3DF62BAF32F7,
+    0x31BE135F97D08FD981231505542FCFA6,
+    0x9AA508B5B7A84E1C677DE54F3E99BC9,
+    0x5D6AF8DEDB81196699C329225EE604,
+    0x2216E584F5FA1EA926041BEDFE98,
+    0x48A170391F7DC42444E8FA2,
+)
+
+
+def get_sqrt_ratio_at_tick(tick: int) -> int:
+    """Square root of ``1.0001**tick`` as a Q64.96 (``TickMath.getSqrtRatioAtTick``)"""
+    abs_tick = abs(tick)
+    assert abs_tick <= MAX_TICK, "Tick out of range"
+
+    ratio = 0xFFFCB933BD6FAD37AA2D162D1A594001 if abs_tick & 0x1 else 2**128
+    for i, factor in enumerate(_SQRT_RATIO_FACTORS):
+        if abs_tick & (0x2 << i):
+            ratio = (ratio * factor) >> 128
+    if tick > 0:
+        ratio = (2**256 - 1) // ratio
+
+    # Round up from Q128.128 to Q64.96
+    return (ratio >> 32) + (ratio % (1 << 32) != 0)
+
+
+def _mul_div_rounding_up(a: int, b: int, denominator: int) -> int:
+    return -((-a * b) // denominator)
+
+
+def get_amount1_delta(
+    sqrt_ratio_a_x96: int, sqrt_ratio_b_x96: int, liquidity: int, round_up: bool
+) -> int:
+    """Amount of token1 between two prices (``SqrtPriceMath.getAmount1Delta``)"""
+    if sqrt_ratio_a_x96 > sqrt_ratio_b_x96:
+        sqrt_ratio_a_x96, sqrt_ratio_b_x96 = sqrt_ratio_b_x96, sqrt_ratio_a_x96
+    if round_up:
+        return _mul_div_rounding_up(liquidity, sqrt_ratio_b_x96 - sqrt_ratio_a_x96, Q96)
+    return liquidity * (sqrt_ratio_b_x96 - sqrt_ratio_a_x96) // Q96
+
+
+class TickTable:
+    """
+    Initialised ticks of a Uniswap V3 pool
+
+    Holds the tick bitmap and the net liquidity of the initialised
+    ticks, which only change when liquidity is added or removed, and
+    computes the swaps moving the pool price to a target price.
+
+    Parameters
+    ----------
+    tick_spacing: int
+        Tick spacing of the pool.
+    fee: int
+        Fee of the pool, in hundredths of basis points.
+    tick_bitmap: typing.Dict[int, int]
+        Words of the tick bitmap, indexed by word position.
+    liquidity_net: typing.Dict[int, int]
+        Net liquidity of the initialised ticks.
+    """
+
+    def __init__(
+        self,
+        tick_spacing: int,
+        fee: int,
+        tick_bitmap: typing.Dict[int, int],
+        liquidity_net: typing.Dict[int, int],
+    ):
+        self.tick_spacing = tick_spacing
+        self.fee = fee
+        self.tick_bitmap = tick_bitmap
+        self.liquidity_net = liquidity_net
+
+    @classmethod
+    def from_snapshot(
+        cls, snapshot: typing.Tuple, pool_address: bytes, tick_spacing: int, fee: int
+    ) -> "TickTable":
+        """
+        Load the ticks of a pool from an environment snapshot
+
+        Only the bitmap words and ticks stored in the snapshot (e.g.
+        fetched when generating the fork cache) are loaded, swaps
+        crossing other ticks cannot be computed.
+
+        Parameters
+        ----------
+        snapshot: typing.Tuple
+            Snapshot exported with ``env.export_snapshot()``.
+        pool_address: bytes
+            Address of the pool.
+        tick_spacing: int
+            Tick spacing of the pool.
+        fee: int
+            Fee of the pool.
+
+        Returns
+        -------
+        TickTable
+            Tick table of the pool.
+        """
+        storage = next(
+            dict(account_storage)
+            for address, (_, _, account_storage) in snapshot[1]
+            if address == pool_address
+        )
+
+        def get_slot(key: int, slot: int) -> typing.Optional[int]:
+            # Keys of the pool mappings are signed integers
+            slot = mapping_slot(key.to_bytes(32, "big", signed=True), slot)
+            value = storage.get(slot.to_bytes(32, "little"))
+            return None if value is None else int.from_bytes(value, "little")
+
+        tick_bitmap = dict()
+        compressed_min = MIN_TICK // tick_spacing
+        compressed_max = MAX_TICK // tick_spacing
+        for word_pos in range(compressed_min >> 8, (compressed_max >> 8) + 1):
+            word = get_slot(word_pos, POOL_TICK_BITMAP_SLOT)
+            if word is not None:
+                tick_bitmap[word_pos] = word
+
+        liquidity_net = dict()
+        for word_pos, word in tick_bitmap.items():
+            for bit_pos in range(256):
+                if not word >> bit_pos & 1:
+                    continue
+                tick = ((word_pos << 8) + bit_pos) * tick_spacing
+                info = get_slot(tick, POOL_TICKS_SLOT)
+                if info is not None:
+                    net = info >> 128
+                    liquidity_net[tick] = net - 2**128 if net >= 2**127 else net
+
+        return cls(tick_spacing, fee, tick_bitmap, liquidity_net)
+
+    def next_initialized_tick_within_one_word(
+        self, tick: int, lte: bool
+    ) -> typing.Tuple[int, bool]:
+        """
+        Next tick initialised, or at the boundary of the bitmap word
+        (``TickBitmap.nextInitializedTickWithinOneWord``)
+        """
+        # Solidity division rounds towards zero
+        compressed = int(tick / self.tick_spacing)
+        if tick < 0 and tick % self.tick_spacing != 0:
+            compressed -= 1
+
+        if lte:
+            word_pos, bit_pos = compressed >> 8, compressed & 0xFF
+            masked = self._word(word_pos) & ((1 << bit_pos) - 1 + (1 << bit_pos))
+            if masked != 0:
+                return (
+                    compressed - (bit_pos - (masked.bit_length() - 1))
+                ) * self.tick_spacing, True
+            return (compressed - bit_pos) * self.tick_spacing, False
+
+        word_pos, bit_pos = (compressed + 1) >> 8, (compressed + 1) & 0xFF
+        masked = self._word(word_pos) & ~((1 << bit_pos) - 1)
+        if masked != 0:
+            lsb = (masked & -masked).bit_length() - 1
+            return (compressed + 1 + (lsb - bit_pos)) * self.tick_spacing, True
+        return (compressed + 1 + (255 - bit_pos)) * self.tick_spacing, False
+
+    def _word(self, word_pos: int) -> int:
+        try:
+            return self.tick_bitmap[word_pos]
+        except KeyError:
+            raise ValueError(f"Tick bitmap word {word_pos} is not loaded")
+
+    def _liquidity_net(self, tick: int) -> int:
+        try:
+            return self.liquidity_net[tick]
+        except KeyError:
+            raise ValueError(f"Tick {tick} is not loaded")
+
+    def swap_to_price(
+        self,
+        sqrt_price_x96: int,
+        tick: int,
+        liquidity: int,
+        sqrt_target_price_x96: int,
+    ) -> typing.Tuple[int, int]:
+        """
+        Size of the swap moving the pool price to a target price
+
+        Follows the swap loop of ``UniswapV3Pool.swap``, crossing the
+        initialised ticks between the current and target prices. To
+        increase the price token1 is sold with an exact input swap,
+        to decrease it token1 is bought with an exact output swap.
+
+        The price can only move by discrete increments (of about
+        ``2**96 / liquidity``), the swap moves the price as close as
+        possible to the target without going past it.
+
+        Parameters
+        ----------
+        sqrt_price_x96: int
+            Current square root price of the pool (Q64.96).
+        tick: int
+            Current tick of the pool.
+        liquidity: int
+            Current in range liquidity of the pool.
+        sqrt_target_price_x96: int
+            Square root of the target price (Q64.96).
+
+        Returns
+        -------
+        typing.Tuple[int, int]
+            Amount of token1 sold (fees included) if the price increases,
+            or bought if it decreases, and square root of the pool price
+            after the swap.
+
+        Raises
+        ------
+        ValueError
+            If the swap crosses ticks that are not loaded.
+        """
+        zero_for_one = sqrt_target_price_x96 < sqrt_price_x96
+        amount = 0
+
+        while sqrt_price_x96 != sqrt_target_price_x96:
+            tick_next, initialized = self.next_initialized_tick_within_one_word(
+                tick, lte=zero_for_one
+            )
+            tick_next = min(max(tick_next, MIN_TICK), MAX_TICK)
+            sqrt_price_next_x96 = get_sqrt_ratio_at_tick(tick_next)
+
+            if zero_for_one and sqrt_target_price_x96 > sqrt_price_next_x96:
+                # Last step, the output moves the price by
+                # SqrtPriceMath.getNextSqrtPriceFromAmount1RoundingDown
+                step_amount = (
+                    (sqrt_price_x96 - sqrt_target_price_x96) * liquidity // Q96
+                )
+                amount += step_amount
+                sqrt_price_x96 -= _mul_div_rounding_up(step_amount, Q96, liquidity)
+                break
+            if not zero_for_one and sqrt_target_price_x96 < sqrt_price_next_x96:
+                # Last step, the input net of fees moves the price by
+                # SqrtPriceMath.getNextSqrtPriceFromAmount1RoundingDown
+                step_amount = (
+                    (sqrt_target_price_x96 - sqrt_price_x96) * liquidity // Q96
+                )
+                amount += _mul_div_rounding_up(
+                    step_amount, FEE_DENOMINATOR, FEE_DENOMINATOR - self.fee
+                )
+                sqrt_price_x96 += step_amount * Q96 // liquidity
+                break
+
+            # The step reaches the next tick (SwapMath.computeSwapStep)
+            if zero_for_one:
+                amount += get_amount1_delta(
+                    sqrt_price_next_x96, sqrt_price_x96, liquidity, False
+                )
+            else:
+                step_amount = get_amount1_delta(
+                    sqrt_price_x96, sqrt_price_next_x96, liquidity, True
+                )
+                amount += step_amount + _mul_div_rounding_up(
+                    step_amount, self.fee, FEE_DENOMINATOR - self.fee
+                )
+            sqrt_price_x96 = sqrt_price_next_x96
+
+            if initialized:
+                liquidity_net = self._liquidity_net(tick_next)
+                if zero_for_one:
+                    liquidity_net = -liquidity_net
+                liquidity += liquidity_net
+            tick = tick_next - 1 if zero_for_one else tick_next
+
+        return amount, sqrt_price_x96
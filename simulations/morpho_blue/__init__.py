@@ -1 +1,28 @@
-from simulations.morpho_blue import plotting, sim
+import importlib
+
+# Modules, imported on first access so that the simulation path (e.g.
+# ``simulations.morpho_blue.sweep`` in worker processes) does not import
+# the plotting and analysis modules
+MODULES = (
+    "adaptive",
+    "branching",
+    "checkpoint",
+    "metrics",
+    "optimizer",
+    "plotting",
+    "recorder",
+    "sampling",
+    "sim",
+    "store",
+    "sweep",
+)
+
+
+def __getattr__(name: str):
+    if name not in MODULES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return importlib.import_module(f"{__name__}.{name}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(MODULES))
@@ -0,0 +1,317 @@
+"""
+Adaptive allocation of replicates across LLTV candidates
+
+Instead of running the same number of seeds for each LLTV, replicates
+are run in batches. After each batch the confidence interval of the
+risk statistic of each candidate (see
+:py:mod:`simulations.morpho_blue.sampling`) is compared to the target:
+candidates whose interval is entirely below (safe) or above (unsafe)
+the target stop being sampled, and the remaining budget goes to the
+undecided candidates, the ones closest to the target first.
+
+Intervals are checked after each batch, so their confidence level is
+corrected for the number of checks (Bonferroni), and the decisions hold
+jointly at the requested level for each candidate.
+
+All the candidates use the same seeds, in the same order, so their
+replicates share their random numbers.
+"""
+import math
+import statistics
+import typing
+
+import numpy as np
+
+from simulations.morpho_blue import sampling, sweep
+from simulations.morpho_blue.store import ResultStore
+
+SAFE = "safe"
+UNSAFE = "unsafe"
+UNDECIDED = "undecided"
+
+
+class CandidateResult(typing.NamedTuple):
+    """Estimate of the risk statistic of an LLTV candidate"""
+
+    lltv: int
+    estimate: sampling.Estimate
+    # Confidence interval of the expectation of the statistic
+    lower: float
+    upper: float
+    decision: str
+
+
+class AdaptiveResult(typing.NamedTuple):
+    """Outcome of :py:func:`run_adaptive`"""
+
+    candidates: typing.List[CandidateResult]
+    # Highest LLTV decided safe, if any
+    recommended: typing.Optional[int]
+    # Number of simulations run, and of the fixed design with the budget
+    # spread evenly over the candidates
+    n_runs: int
+    max_runs: int
+
+
+def critical_value(confidence: float, n_checks: int) -> float:
+    """
+    Half-width in standard errors of confidence intervals checked
+    ``n_checks`` times, Bonferroni-corrected
+    """
+    return statistics.NormalDist().inv_cdf(1 - (1 - confidence) / (2 * n_checks))
+
+
+def decide(
+    lltv: int,
+    lltv_samples: typing.Sequence[sampling.Sample],
+    target: float,
+    z: float,
+    min_replicates: int,
+) -> CandidateResult:
+    """
+    Compare the confidence interval of the statistic of a candidate to
+    the target
+
+    Parameters
+    ----------
+    lltv: int
+        LLTV of the candidate.
+    lltv_samples: typing.Sequence[sampling.Sample]
+        Samples of the runs of the candidate.
+    target: float
+        Maximum expectation of the statistic of a safe LLTV.
+    z: float
+        Half-width of the interval in standard errors, see
+        :py:func:`critical_value`.
+    min_replicates: int
+        Number of replicates before the candidate can be decided.
+    """
+    estimate = sampling.estimate_group(lltv_samples)
+    lower = estimate.mean - z * estimate.std_error
+    upper = estimate.mean + z * estimate.std_error
+    decision = UNDECIDED
+    if len({sample.seed for sample in lltv_samples}) >= min_replicates:
+        if upper < target:
+            decision = SAFE
+        elif lower > target:
+            decision = UNSAFE
+    return CandidateResult(lltv, estimate, lower, upper, decision)
+
+
+def run_replicates(
+    lltv_samples: typing.Dict[int, typing.List[sampling.Sample]],
+    sizes: typing.Dict[int, int],
+    seed: int,
+    sigma: float,
+    n_borrow_agents: int,
+    n_steps: int,
+    statistic: typing.Callable[[typing.Dict[str, np.ndarray]], float],
+    n_workers: typing.Optional[int] = None,
+    store: typing.Optional[ResultStore] = None,
+    **grid_kwargs,
+):
+    """
+    Run the next replicates of LLTV candidates in a single sweep
+
+    The ``k``-th replicate of every candidate uses the ``k``-th seed
+    derived from ``seed``.
+
+    Parameters
+    ----------
+    lltv_samples: typing.Dict[int, typing.List[sampling.Sample]]
+        Samples of the runs of each candidate so far, extended with the
+        samples of the new runs.
+    sizes: typing.Dict[int, int]
+        Number of new replicates of each candidate.
+    seed: int
+        Base seed.
+    sigma: float
+        Volatility of the external market.
+    n_borrow_agents: int
+        Number of borrowers.
+    n_steps: int
+        Number of steps of the simulations.
+    statistic: typing.Callable
+        Statistic of a run, function of its borrower columns.
+    n_workers: int, optional
+        Number of worker processes.
+    store: simulations.morpho_blue.store.ResultStore, optional
+        Store of results, replicates already stored are not run again.
+    **grid_kwargs
+        Other parameters of the runs, see
+        :py:func:`simulations.morpho_blue.sweep.make_grid`.
+    """
+    jobs = list()
+    for lltv, size in sizes.items():
+        n_done = len({sample.seed for sample in lltv_samples.setdefault(lltv, list())})
+        jobs.extend(
+            sweep.make_grid(
+                seeds=sweep.derive_seeds(seed, n_done + size)[n_done:],
+                sigmas=[sigma],
+                lltvs=[lltv],
+                n_borrow_agents=[n_borrow_agents],
+                n_steps=n_steps,
+                **grid_kwargs,
+            )
+        )
+    if not jobs:
+        return
+    results = sweep.run_sweep(jobs, n_workers=n_workers, store=store)
+    for sample in sampling.samples(results, statistic):
+        lltv_samples[sample.lltv].append(sample)
+
+
+def _borderline(candidate: CandidateResult, target: float) -> float:
+    # Distance to the target in standard errors, unknown distances first
+    std_error = candidate.estimate.std_error
+    if not std_error > 0:
+        return 0.0 if math.isnan(std_error) else math.inf
+    return abs(candidate.estimate.mean - target) / std_error
+
+
+def run_adaptive(
+    lltvs: typing.Sequence[int],
+    target: float,
+    seed: int,
+    sigma: float,
+    n_borrow_agents: int,
+    n_steps: int,
+    budget: int,
+    batch_size: int = 4,
+    min_replicates: int = 8,
+    confidence: float = 0.95,
+    statistic: typing.Callable[
+        [typing.Dict[str, np.ndarray]], float
+    ] = sampling.bad_debt,
+    n_workers: typing.Optional[int] = None,
+    store: typing.Optional[ResultStore] = None,
+    **grid_kwargs,
+) -> AdaptiveResult:
+    """
+    Decide which LLTV candidates keep the expected risk below a target
+
+    Parameters
+    ----------
+    lltvs: typing.Sequence[int]
+        LLTV candidates.
+    target: float
+        Maximum expectation of the statistic of a safe LLTV.
+    seed: int
+        Base seed the seeds of the replicates are derived from.
+    sigma: float
+        Volatility of the external market.
+    n_borrow_agents: int
+        Number of borrowers.
+    n_steps: int
+        Number of steps of the simulations.
+    budget: int
+        Maximum number of replicates (seeds) over all the candidates.
+    batch_size: int, optional
+        Number of replicates given to an undecided candidate at once.
+    min_replicates: int, optional
+        Number of replicates of a candidate before it can be decided.
+    confidence: float, optional
+        Confidence level of the decision of each candidate.
+    statistic: typing.Callable, optional
+        Risk statistic of a run, function of its borrower columns.
+    n_workers: int, optional
+        Number of worker processes, see
+        :py:func:`simulations.morpho_blue.sweep.run_sweep`.
+    store: simulations.morpho_blue.store.ResultStore, optional
+        Store of results, replicates already stored are not run again.
+    **grid_kwargs
+        Other parameters of the runs, passed to
+        :py:func:`simulations.morpho_blue.sweep.make_grid` (e.g.
+        ``pregenerate_path`` or ``antithetic``).
+
+    Returns
+    -------
+    AdaptiveResult
+        Decision and estimate of each candidate, and recommended LLTV.
+    """
+    assert batch_size > 0, "Batch size has to be positive"
+    assert "multi_market" not in grid_kwargs, "Candidates are run separately"
+    lltvs = sorted(lltvs)
+    runs_per_replicate = 2 if grid_kwargs.get("antithetic", False) else 1
+    # Number of intervals checked for a candidate at most
+    n_checks = max(1, math.ceil(budget / batch_size))
+    z = critical_value(confidence, n_checks)
+
+    lltv_samples = {lltv: list() for lltv in lltvs}
+    candidates = {
+        lltv: CandidateResult(lltv, None, -math.inf, math.inf, UNDECIDED)
+        for lltv in lltvs
+    }
+    n_replicates = 0
+    while n_replicates < budget:
+        undecided = sorted(
+            (c for c in candidates.values() if c.decision == UNDECIDED),
+            key=lambda c: (
+                0.0 if c.estimate is None else _borderline(c, target),
+                -c.lltv,
+            ),
+        )
+        if not undecided:
+            break
+
+        sizes = dict()
+        for candidate in undecided:
+            size = min(batch_size, budget - n_replicates)
+            if size == 0:
+                break
+            sizes[candidate.lltv] = size
+            n_replicates += size
+
+        run_replicates(
+            lltv_samples,
+            sizes,
+            seed=seed,
+            sigma=sigma,
+            n_borrow_agents=n_borrow_agents,
+            n_steps=n_steps,
+            statistic=statistic,
+            n_workers=n_workers,
+            store=store,
+            **grid_kwargs,
+        )
+        for lltv in sizes:
+            candidates[lltv] = decide(
+                lltv, lltv_samples[lltv], target, z, min_replicates
+            )
+
+    safe = [c.lltv for c in candidates.values() if c.decision == SAFE]
+    return AdaptiveResult(
+        candidates=list(candidates.values()),
+        recommended=max(safe) if safe else None,
+        n_runs=sum(len(s) for s in lltv_samples.values()),
+        max_runs=budget * runs_per_replicate,
+    )
+
+
+def format_candidates(candidates: typing.Sequence[CandidateResult]) -> typing.List[str]:
+    """Rows of a table of the estimates and decisions of candidates"""
+    lines = [
+        f"{'lltv':>8} {'runs':>5} {'mean':>12} {'lower':>12} {'upper':>12} "
+        f"{'decision':>10}"
+    ]
+    for c in candidates:
+        n_runs = 0 if c.estimate is None else c.estimate.n_runs
+        mean = math.nan if c.estimate is None else c.estimate.mean
+        lines.append(
+            f"{c.lltv / 1e18:>8.4g} {n_runs:>5d} {mean:>12.6g} {c.lower:>12.6g} "
+            f"{c.upper:>12.6g} {c.decision:>10}"
+        )
+    return lines
+
+
+def format_result(result: AdaptiveResult) -> str:
+    """Table of the decisions of :py:func:`run_adaptive`"""
+    lines = format_candidates(result.candidates)
+    recommended = (
+        "none" if result.recommended is None else f"{result.recommended / 1e18:.4g}"
+    )
+    lines.append(
+        f"Recommended LLTV: {recommended} "
+        f"({result.n_runs} simulations, {result.max_runs} with a fixed design)"
+    )
+    return "\n".join(lines)
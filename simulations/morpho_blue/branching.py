@@ -0,0 +1,304 @@
+"""
+Branching Monte Carlo simulations
+
+Many continuations of the same market history: a shared prefix is
+simulated once, the state of the simulation is saved at chosen steps
+and continued by several branches with independent random streams,
+which can themselves branch at a later step. Results are stored as a
+tree, the records of each segment of the simulation being computed and
+stored once.
+
+The saved state is the EVM snapshot and a copy of the agents, which
+hold the rest of the simulation state (e.g. the price of the external
+market and its transient impact, the balance history of the liquidator,
+the flags of the borrowers, the market mirrors).
+"""
+import copy
+import multiprocessing
+import typing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+import verbs
+
+from simulations.morpho_blue import sim
+from simulations.utils.call_cache import CachedEnv
+from simulations.utils.market_mirror import MirroredEnv
+
+# State continued by the branches run in worker processes, inherited
+# by the workers as agents cannot be pickled
+_BRANCH_STATE = None
+
+
+class SimState(typing.NamedTuple):
+    """State of a simulation between two steps"""
+
+    snapshot: typing.Tuple
+    agents: typing.List
+    # Market mirrors followed by the environment, shared with the agents
+    mirrors: typing.Optional[typing.List]
+    cache_calls: bool
+
+
+class Node:
+    """
+    Segment of a branching simulation
+
+    Parameters
+    ----------
+    start: int
+        Step the segment starts from.
+    records: typing.List[typing.List]
+        Records of each step of the segment, as returned by
+        ``verbs.sim.Sim.run``.
+    children: typing.List[Node], optional
+        Branches continuing the segment.
+    """
+
+    def __init__(
+        self,
+        start: int,
+        records: typing.List[typing.List],
+        children: typing.Optional[typing.List["Node"]] = None,
+    ):
+        self.start = start
+        self.records = records
+        self.children = list() if children is None else children
+
+    @property
+    def stop(self) -> int:
+        """Step the segment ends at"""
+        return self.start + len(self.records)
+
+    def paths(self) -> typing.Iterator[typing.List[typing.List]]:
+        """
+        Records of each complete path of the tree
+
+        Yields the records of the steps of each path from the segment to
+        a leaf of the tree, starting with the records of the segment, in
+        depth-first order.
+        """
+        if not self.children:
+            yield self.records
+        for child in self.children:
+            for path in child.paths():
+                yield self.records + path
+
+    def n_paths(self) -> int:
+        """Number of complete paths, i.e. leaves, of the tree"""
+        if not self.children:
+            return 1
+        return sum(child.n_paths() for child in self.children)
+
+
+def save_state(runner: verbs.sim.Sim) -> SimState:
+    """
+    Save the state of a simulation between two steps
+
+    Parameters
+    ----------
+    runner: verbs.sim.Sim
+        Simulation, initialised with
+        :py:func:`simulations.morpho_blue.sim.init_sim`.
+
+    Returns
+    -------
+    SimState
+        EVM snapshot and copy of the agents and market mirrors.
+    """
+    env = runner.env
+    mirrors = None
+    if isinstance(env, MirroredEnv):
+        mirrors = env.mirrors
+        env = env.env
+    cache_calls = isinstance(env, CachedEnv)
+    if cache_calls:
+        env = env.env
+    agents, mirrors = copy.deepcopy((runner.agents, mirrors))
+    return SimState(env.export_snapshot(), agents, mirrors, cache_calls)
+
+
+def restore_state(state: SimState, seed: np.random.SeedSequence) -> verbs.sim.Sim:
+    """
+    Simulation continuing a saved state
+
+    Parameters
+    ----------
+    state: SimState
+        State saved with :py:func:`save_state`, left unchanged.
+    seed: np.random.SeedSequence
+        Seed of the random streams of the continuation (of the agents
+        and of the ordering of the transactions by the EVM).
+
+    Returns
+    -------
+    verbs.sim.Sim
+        Simulation with a copy of the agents, on a new environment.
+    """
+    agents, mirrors = copy.deepcopy((state.agents, state.mirrors))
+    env = verbs.envs.EmptyEnv(int(seed.generate_state(1)[0]), snapshot=state.snapshot)
+    if state.cache_calls:
+        env = CachedEnv(env, permanent_selectors=sim.PERMANENT_SELECTORS)
+    if mirrors is not None:
+        env = MirroredEnv(env, mirrors)
+    runner = verbs.sim.Sim(0, env, agents)
+    runner.rng = np.random.default_rng(seed)
+    return runner
+
+
+def _run_branch(
+    state: SimState,
+    seed: np.random.SeedSequence,
+    bounds: typing.Sequence[int],
+    n_branches: typing.Sequence[int],
+    level: int,
+) -> Node:
+    # Run the segment between two branching steps, and its branches
+    runner = restore_state(state, seed)
+    node = Node(bounds[level], runner.run(bounds[level + 1] - bounds[level]))
+    if level + 1 < len(n_branches):
+        branch_state = save_state(runner)
+        node.children = [
+            _run_branch(branch_state, branch_seed, bounds, n_branches, level + 1)
+            for branch_seed in seed.spawn(n_branches[level + 1])
+        ]
+    return node
+
+
+def _run_worker_branch(
+    seed: np.random.SeedSequence,
+    bounds: typing.Sequence[int],
+    n_branches: typing.Sequence[int],
+) -> Node:
+    return _run_branch(_BRANCH_STATE, seed, bounds, n_branches, 1)
+
+
+def run_branching(
+    seed: int,
+    n_steps: int,
+    n_borrow_agents: int,
+    sigma: float,
+    lltv: typing.Union[int, typing.Sequence[int]],
+    branch_steps: typing.Sequence[int],
+    n_branches: typing.Union[int, typing.Sequence[int]],
+    n_workers: int = 1,
+    cache: typing.Optional[verbs.types.Cache] = None,
+    inject_state: bool = False,
+    open_positions: bool = False,
+    price_path: typing.Optional[np.ndarray] = None,
+    population: bool = False,
+) -> Node:
+    """
+    Run a branching simulation
+
+    The simulation runs from the setup snapshot until the first
+    branching step, then each saved state is continued by
+    ``n_branches`` branches until the next branching step, and so on
+    until ``n_steps``. The prefix is identical to a simulation run with
+    :py:func:`simulations.morpho_blue.sim.run_from_cache` with the same
+    seed (not to a checkpointed run, which is reseeded at its checkpoint
+    steps), the random streams of the branches are derived from the seed.
+
+    Parameters
+    ----------
+    seed: int
+        Simulation seed.
+    n_steps: int
+        Total number of steps of the simulation.
+    n_borrow_agents: int
+        Number of borrowers (per market).
+    sigma: float
+        Volatility of the external market.
+    lltv: int | typing.Sequence[int]
+        LLTV of the market, or LLTVs of the markets.
+    branch_steps: typing.Sequence[int]
+        Increasing steps at which the simulation branches.
+    n_branches: int | typing.Sequence[int]
+        Number of branches at each branching step.
+    n_workers: int, optional
+        Number of worker processes running the branches of the first
+        branching step (and all their sub-branches), with a single
+        worker branches are run in the current process.
+    cache: verbs.types.Cache, optional
+        Fork cache, loaded from disk by default.
+    inject_state: bool, optional
+        Set up the agents by writing into storage.
+    open_positions: bool, optional
+        Borrowers start with their positions opened.
+    price_path: np.ndarray, optional
+        Price path of the external market, followed by all the branches,
+        which then only differ by the decisions of the agents.
+    population: bool, optional
+        Simulate the borrowers with a single population agent.
+
+    Returns
+    -------
+    Node
+        Root of the tree of the simulation, see
+        :py:meth:`Node.paths` to get the records of complete paths.
+    """
+    global _BRANCH_STATE
+
+    bounds = [0] + list(branch_steps) + [n_steps]
+    assert all(
+        a < b for a, b in zip(bounds[:-1], bounds[1:])
+    ), "Branching steps have to be increasing and between 0 and n_steps"
+    if isinstance(n_branches, int):
+        n_branches = [n_branches] * len(branch_steps)
+    assert len(n_branches) == len(
+        branch_steps
+    ), "A number of branches is required for each branching step"
+    # The prefix is the single branch of the root
+    n_branches = [1] + list(n_branches)
+
+    if cache is None:
+        cache = sim.load_cache()
+    snapshot, deployment = sim.load_snapshot(
+        cache,
+        n_borrow_agents=n_borrow_agents,
+        lltv=lltv,
+        inject_state=inject_state,
+        open_positions=open_positions,
+    )
+    runner, _ = sim.init_sim(
+        verbs.envs.EmptyEnv(seed, snapshot=snapshot),
+        seed,
+        n_steps,
+        n_borrow_agents,
+        sigma,
+        lltv,
+        deployment=deployment,
+        open_positions=open_positions,
+        price_path=price_path,
+        population=population,
+    )
+    root = Node(0, runner.run(n_steps=bounds[1]))
+    if len(n_branches) == 1:
+        return root
+
+    state = save_state(runner)
+    seeds = np.random.SeedSequence(seed).spawn(n_branches[1])
+    if n_workers == 1:
+        root.children = [
+            _run_branch(state, branch_seed, bounds, n_branches, 1)
+            for branch_seed in seeds
+        ]
+    else:
+        _BRANCH_STATE = state
+        try:
+            with ProcessPoolExecutor(
+                max_workers=n_workers, mp_context=multiprocessing.get_context("fork")
+            ) as executor:
+                root.children = list(
+                    executor.map(
+                        partial(
+                            _run_worker_branch, bounds=bounds, n_branches=n_branches
+                        ),
+                        seeds,
+                    )
+                )
+        finally:
+            _BRANCH_STATE = None
+
+    return root
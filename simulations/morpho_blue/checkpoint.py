@@ -0,0 +1,409 @@
+"""
+Checkpoints of long-running simulations
+
+A simulation run with :py:func:`run_checkpointed` saves its state at
+checkpoint steps (every ``every`` steps), so that an interrupted run can
+be continued with :py:func:`resume` from its last checkpoint instead of
+being run again from the start.
+
+The saved state is the EVM snapshot, the agents, which hold the rest of
+the simulation state (e.g. the price of the external market and its
+transient impact, the balance history of the liquidator, the flags and
+step counters of the borrowers), the market mirrors, the recorders of
+the results and the state of the random generator of the simulation.
+
+The ordering of the transactions by the EVM cannot be saved, so at each
+checkpoint step the simulation continues on a new environment,
+initialised from the snapshot of the EVM with a seed derived from the
+simulation seed and the step (see
+:py:class:`simulations.morpho_blue.sim.EnvReseeder`). A checkpointed run
+is then its own reproducible random stream, given by its seed and its
+checkpoint steps: resumed runs are identical to the uninterrupted
+checkpointed run, which differs from the run of the same seed without
+checkpoints after the first checkpoint step.
+
+Records are written to columns on disk (see
+:py:class:`simulations.morpho_blue.recorder.ColumnarRecorder`) or
+summarised, the recorders are flushed at each checkpoint and only their
+position in the columns and last recorded values are saved, so that the
+cost of a checkpoint does not grow with the number of steps.
+
+Checkpoints are written to a single file, replaced at each checkpoint.
+The EVM snapshot is serialised and written by a background thread while
+the simulation runs, a checkpoint only waits for the previous one to be
+written. With ``minutes``, checkpoints are only written at the first
+checkpoint step after ``minutes`` have elapsed since the last one.
+"""
+import io
+import os
+import pickle
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import verbs
+
+from simulations import abi
+from simulations.morpho_blue import recorder, sim
+from simulations.utils.call_cache import CachedEnv
+from simulations.utils.market_mirror import MirroredEnv
+
+# Default number of steps between checkpoint steps
+DEFAULT_EVERY = 100
+
+
+class Checkpoint(typing.NamedTuple):
+    """State of a simulation saved at a checkpoint step"""
+
+    step: int
+    # Parameters of the run, see run_checkpointed
+    params: typing.Dict
+    snapshot: typing.Tuple
+    # Agents, market mirrors, recorders and state of the random
+    # generator, see dumps
+    state: bytes
+    cache_calls: bool
+
+
+class _Pickler(pickle.Pickler):
+    # ABI classes are created when loading the ABIs and cannot be
+    # pickled, they are saved by name and loaded from simulations.abi
+    def __init__(self, file):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.abi_names = {
+            id(value): name
+            for name, value in vars(abi).items()
+            if name in abi.ABI_FILES
+        }
+
+    def persistent_id(self, obj):
+        if isinstance(obj, type):
+            return self.abi_names.get(id(obj))
+        return None
+
+
+class _Unpickler(pickle.Unpickler):
+    def persistent_load(self, pid):
+        return getattr(abi, pid)
+
+
+def dumps(obj) -> bytes:
+    """Pickle simulation objects (e.g. agents) referencing ABIs"""
+    buffer = io.BytesIO()
+    _Pickler(buffer).dump(obj)
+    return buffer.getvalue()
+
+
+def loads(data: bytes):
+    """Unpickle objects pickled with :py:func:`dumps`"""
+    return _Unpickler(io.BytesIO(data)).load()
+
+
+class Checkpointer:
+    """
+    Save the state of a running simulation at checkpoint steps
+
+    Updated by :py:func:`simulations.morpho_blue.recorder.run` at the
+    checkpoint steps, where the simulation is reseeded.
+
+    Parameters
+    ----------
+    path: str
+        File the checkpoints are written to.
+    params: typing.Dict
+        Parameters of the run, saved with the checkpoints, including the
+        ``seed`` of the simulation.
+    every: int, optional
+        Number of steps between checkpoint steps.
+    minutes: float, optional
+        Minimum time between written checkpoints, by default a
+        checkpoint is written at every checkpoint step.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        params: typing.Dict,
+        every: int = DEFAULT_EVERY,
+        minutes: typing.Optional[float] = None,
+    ):
+        assert every > 0, "Checkpoints have to be at least one step apart"
+        self.path = path
+        self.params = params
+        self.every = every
+        self.minutes = minutes
+        self.last_written = time.monotonic()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.future = None
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def update(
+        self,
+        runner: verbs.sim.Sim,
+        step: int,
+        snapshot: typing.Tuple,
+        recorders: typing.List,
+    ):
+        """
+        Save the state of the simulation if ``step`` is a checkpoint
+        step
+
+        Parameters
+        ----------
+        runner: verbs.sim.Sim
+            Simulation, initialised with
+            :py:func:`simulations.morpho_blue.sim.init_sim`.
+        step: int
+            Number of steps run, a checkpoint step.
+        snapshot: typing.Tuple
+            Snapshot of the EVM the simulation was reseeded from.
+        recorders: typing.List
+            Recorders of the simulation, columnar recorders or risk
+            aggregators.
+        """
+        if step % self.every != 0:
+            return
+
+        now = time.monotonic()
+        if self.minutes is None or now - self.last_written >= 60 * self.minutes:
+            for columnar_recorder in recorders:
+                if isinstance(columnar_recorder, recorder.ColumnarRecorder):
+                    columnar_recorder.flush()
+            mirrors = None
+            if isinstance(runner.env, MirroredEnv):
+                mirrors = runner.env.mirrors
+            # Simulation objects are serialised now, the snapshot is not
+            # shared with the simulation and is serialised when written
+            state = dumps(
+                (runner.agents, mirrors, recorders, runner.rng.bit_generator.state)
+            )
+            holder, _ = sim.evm_env(runner)
+            checkpoint = Checkpoint(
+                step, self.params, snapshot, state, isinstance(holder, CachedEnv)
+            )
+            self.wait()
+            self.future = self.executor.submit(self._write, checkpoint)
+            self.last_written = now
+
+    def _write(self, checkpoint: Checkpoint):
+        # Write to a temporary file first so an interrupted write never
+        # replaces the last checkpoint
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(checkpoint, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+
+    def wait(self):
+        """Wait for the last checkpoint to be written"""
+        if self.future is not None:
+            self.future.result()
+            self.future = None
+
+    def close(self):
+        """Wait for the last checkpoint and stop the writer thread"""
+        self.wait()
+        self.executor.shutdown()
+
+
+def load(path: str) -> Checkpoint:
+    """Load a checkpoint written by a :py:class:`Checkpointer`"""
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def restore(checkpoint: Checkpoint) -> typing.Tuple[verbs.sim.Sim, typing.List]:
+    """
+    Simulation and recorders continuing a checkpoint
+
+    Parameters
+    ----------
+    checkpoint: Checkpoint
+        Checkpoint written by a :py:class:`Checkpointer`.
+
+    Returns
+    -------
+    typing.Tuple[verbs.sim.Sim, typing.List]
+        Simulation, on a new environment, and its recorders.
+    """
+    agents, mirrors, recorders, rng_state = loads(checkpoint.state)
+    env = verbs.envs.EmptyEnv(
+        sim.env_seed(checkpoint.params["seed"], checkpoint.step),
+        snapshot=checkpoint.snapshot,
+    )
+    if checkpoint.cache_calls:
+        env = CachedEnv(env, permanent_selectors=sim.PERMANENT_SELECTORS)
+    if mirrors is not None:
+        env = MirroredEnv(env, mirrors)
+    runner = verbs.sim.Sim(0, env, agents)
+    runner.rng.bit_generator.state = rng_state
+    return runner, recorders
+
+
+def _run(
+    runner: verbs.sim.Sim,
+    recorders: typing.List,
+    checkpointer: Checkpointer,
+    start: int,
+):
+    params = checkpointer.params
+    recorder.run(
+        runner,
+        n_steps=params["n_steps"],
+        recorder=recorders,
+        start=start,
+        reseeder=sim.EnvReseeder(params["seed"], params["n_steps"], params["every"]),
+        checkpointer=checkpointer,
+    )
+    return sim.collect_results(
+        recorders,
+        params["deployment"],
+        params["lltv"],
+        records_path=params["records_path"],
+        summary=params["summary"],
+    )
+
+
+def run_checkpointed(
+    path: str,
+    seed: int,
+    n_steps: int,
+    n_borrow_agents: int,
+    sigma: float,
+    lltv: typing.Union[int, typing.Sequence[int]],
+    every: int = DEFAULT_EVERY,
+    minutes: typing.Optional[float] = None,
+    cache: typing.Optional[verbs.types.Cache] = None,
+    inject_state: bool = False,
+    open_positions: bool = False,
+    records_path: typing.Optional[str] = None,
+    record_policies: typing.Optional[typing.Dict[str, recorder.RecordPolicy]] = None,
+    price_path: typing.Optional[np.ndarray] = None,
+    population: bool = False,
+    summary: bool = False,
+):
+    """
+    Run a simulation from the setup snapshot, writing checkpoints
+
+    Parameters
+    ----------
+    path: str
+        File the checkpoints are written to.
+    seed: int
+        Simulation seed.
+    n_steps: int
+        Number of steps of the simulation.
+    n_borrow_agents: int
+        Number of borrowers (per market).
+    sigma: float
+        Volatility of the external market.
+    lltv: int | typing.Sequence[int]
+        LLTV of the market, or LLTVs of the markets.
+    every: int, optional
+        Number of steps between checkpoint steps, where the simulation
+        continues on a reseeded environment.
+    minutes: float, optional
+        Minimum time between written checkpoints.
+    cache: verbs.types.Cache, optional
+        Fork cache, loaded from disk by default.
+    inject_state: bool, optional
+        Set up the agents by writing into storage.
+    open_positions: bool, optional
+        Borrowers start with their positions opened.
+    records_path: str, optional
+        Directory the columns of the records are written to, required
+        unless ``summary`` is set.
+    record_policies: typing.Dict[str, recorder.RecordPolicy], optional
+        Record policies of the groups of agents (with ``records_path``).
+    price_path: np.ndarray, optional
+        Price path of the external market.
+    population: bool, optional
+        Simulate the borrowers with a single population agent.
+    summary: bool, optional
+        Return the summary of the risk metrics instead of the records.
+
+    Returns
+    -------
+    Results of the simulation, as returned by
+    :py:func:`simulations.morpho_blue.sim.run_from_cache`.
+    """
+    assert records_path is not None or summary, (
+        "Checkpointed runs write their records to columns (records_path) or "
+        "summarise them, list records would be pickled again at each checkpoint"
+    )
+    if cache is None:
+        cache = sim.load_cache()
+    snapshot, deployment = sim.load_snapshot(
+        cache,
+        n_borrow_agents=n_borrow_agents,
+        lltv=lltv,
+        inject_state=inject_state,
+        open_positions=open_positions,
+    )
+    runner, _ = sim.init_sim(
+        verbs.envs.EmptyEnv(seed, snapshot=snapshot),
+        seed,
+        n_steps,
+        n_borrow_agents,
+        sigma,
+        lltv,
+        deployment=deployment,
+        open_positions=open_positions,
+        price_path=price_path,
+        population=population,
+    )
+    recorders = sim.init_recorders(
+        runner,
+        deployment,
+        lltv,
+        n_steps,
+        records_path=records_path,
+        record_policies=record_policies,
+        summary=summary,
+    )
+    params = dict(
+        seed=seed,
+        n_steps=n_steps,
+        n_borrow_agents=n_borrow_agents,
+        sigma=sigma,
+        lltv=lltv,
+        inject_state=inject_state,
+        open_positions=open_positions,
+        population=population,
+        records_path=records_path,
+        summary=summary,
+        deployment=deployment,
+        every=every,
+        minutes=minutes,
+    )
+    checkpointer = Checkpointer(path, params, every=every, minutes=minutes)
+    return _run(runner, recorders, checkpointer, 0)
+
+
+def resume(path: str) -> typing.Tuple[typing.Dict, typing.Any]:
+    """
+    Continue a simulation from its last checkpoint
+
+    The simulation keeps writing checkpoints to the same file, at the
+    same checkpoint steps.
+
+    Parameters
+    ----------
+    path: str
+        Checkpoint file of the simulation, see :py:func:`run_checkpointed`.
+
+    Returns
+    -------
+    typing.Tuple[typing.Dict, typing.Any]
+        Parameters of the run, and its results, identical to the results
+        of the uninterrupted checkpointed run.
+    """
+    checkpoint = load(path)
+    runner, recorders = restore(checkpoint)
+    params = checkpoint.params
+    checkpointer = Checkpointer(
+        path, params, every=params["every"], minutes=params["minutes"]
+    )
+    return params, _run(runner, recorders, checkpointer, checkpoint.step)
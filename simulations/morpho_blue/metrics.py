@@ -0,0 +1,314 @@
+"""
+Streaming risk metrics of a simulation
+
+Instead of keeping the records of every agent at every step, risk
+metrics of a market are aggregated after each block into running sums,
+maxima, fixed histograms and quantile sketches, so a run only returns a
+small summary and its memory use does not grow with the number of
+steps.
+
+Metrics are computed from the positions of all the borrowers (read at
+once, see :py:class:`simulations.utils.position_reader.PositionReader`),
+the ``Liquidate`` events of Morpho Blue, the balances of the liquidator
+and the price of the external market without the impact of the Uniswap
+trades (i.e. the ``Gbm`` price).
+
+Events do not expose their indexed topics (market id, borrower), so in
+runs of several markets a ``Liquidate`` event is attributed to a market
+by its seized collateral and removed borrow shares, which equal the
+collateral and borrow shares lost by one of the borrowers of the market
+during the block (borrowers only lose collateral and shares to
+liquidations).
+"""
+import math
+import typing
+
+import numpy as np
+
+from simulations.utils.calldata import StaticDecoder
+from simulations.utils.morpho import ORACLE_PRICE_SCALE
+from simulations.utils.position_reader import to_float
+
+# Edges of the histograms of the health factors of the positions with
+# debt at each step, and of the discount of the liquidations
+HEALTH_FACTOR_BINS = np.array(
+    [0.0, 0.5, 0.8, 0.9, 0.95, 0.99, 1.0, 1.01, 1.05, 1.1, 1.2, 1.5, 2.0, 5.0]
+)
+LIQUIDATION_DISCOUNT_BINS = np.linspace(-0.2, 0.2, 21)
+
+
+class QuantileSketch:
+    """
+    Quantile sketch of non-negative values with a relative accuracy
+
+    Values are counted in logarithmic buckets (as in DDSketch), so the
+    memory used only depends on the range of the values, and any
+    quantile is estimated within ``relative_accuracy`` of a value of
+    the sample.
+
+    Parameters
+    ----------
+    relative_accuracy: float, optional
+        Relative accuracy of the quantiles.
+    """
+
+    def __init__(self, relative_accuracy: float = 0.01):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.counts = dict()
+        self.n_zeros = 0
+        self.n = 0
+
+    def add(self, values: np.ndarray):
+        """Add finite non-negative values to the sketch"""
+        values = np.asarray(values, dtype=np.float64)
+        positive = values[values > 0]
+        keys, counts = np.unique(
+            np.ceil(np.log(positive) / self.log_gamma).astype(np.int64),
+            return_counts=True,
+        )
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            self.counts[key] = self.counts.get(key, 0) + count
+        self.n_zeros += len(values) - len(positive)
+        self.n += len(values)
+
+    def quantile(self, q: float) -> float:
+        """Estimate of the ``q``-quantile of the values added"""
+        if self.n == 0:
+            return math.nan
+        rank = q * (self.n - 1)
+        count = self.n_zeros
+        if rank < count:
+            return 0.0
+        for key in sorted(self.counts):
+            count += self.counts[key]
+            if rank < count:
+                return 2 * self.gamma**key / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.counts) / (self.gamma + 1)
+
+
+class RiskAggregator:
+    """
+    Aggregate the risk metrics of a market as the simulation runs
+
+    Can be passed to :py:func:`simulations.morpho_blue.recorder.run` in
+    place of a columnar recorder, the metrics are returned by
+    :py:meth:`summary`.
+
+    Parameters
+    ----------
+    env
+        Simulation environment.
+    liquidator
+        Liquidation agent of the market, whose position reader and
+        borrowers are used to read the positions.
+    uniswap_agent
+        Uniswap agent, holding the external market.
+    morpho_blue_abi
+        Morpho Blue ABI.
+    """
+
+    def __init__(self, env, liquidator, uniswap_agent, morpho_blue_abi):
+        self.liquidator = liquidator
+        self.uniswap_agent = uniswap_agent
+        self.position_reader = liquidator.position_reader
+        self.borrowers = list(liquidator.borrow_address)
+        self.morpho_blue_address = liquidator.morpho_blue_address
+        self.liquidate_selector = morpho_blue_abi.liquidate.selector
+        self.liquidate_event = StaticDecoder(morpho_blue_abi.Liquidate.inputs)
+        self.debt_scale = 10**liquidator.decimals_token_b
+        self.collateral_scale = 10**liquidator.decimals_token_a
+
+        n_borrowers = len(self.borrowers)
+        positions = self.read_positions(env)
+        self.collateral = positions.collateral
+        self.borrow_shares = positions.borrow_shares
+        self.initial_balances = self.liquidator_balances(env)
+
+        self.n_steps = 0
+        # Steps each borrower spent with a health factor below one
+        self.unhealthy_steps = np.zeros(n_borrowers, dtype=np.int64)
+        self.min_health_factor = math.inf
+        self.max_bad_debt = 0.0
+        self.last = dict(bad_debt=0.0, unhealthy_debt=0.0, underwater_fraction=0.0)
+        self.health_factors = QuantileSketch()
+        self.health_factor_histogram = np.zeros(
+            len(HEALTH_FACTOR_BINS) + 1, dtype=np.int64
+        )
+
+        self.n_liquidations = 0
+        self.repaid_assets = 0
+        self.seized_assets = 0
+        self.realised_bad_debt = 0
+        # Sum of the discounts of the liquidations (one minus the repaid
+        # assets over the Gbm value of the seized collateral, mostly the
+        # liquidation incentive) weighted by the seized value, and the sum
+        # of the seized values
+        self.discount_value = 0.0
+        self.seized_value = 0.0
+        self.min_liquidation_discount = math.inf
+        self.max_liquidation_discount = -math.inf
+        self.liquidation_discount_histogram = np.zeros(
+            len(LIQUIDATION_DISCOUNT_BINS) + 1, dtype=np.int64
+        )
+
+        self.liquidator_pnl = 0.0
+        self.min_liquidator_pnl = 0.0
+
+    def read_positions(self, env):
+        return self.position_reader.read(env, self.liquidator.address, self.borrowers)
+
+    def gbm_price(self) -> float:
+        """Price of the collateral in debt tokens on the external market"""
+        market = self.uniswap_agent.external_market
+        return (
+            market.token_a_price
+            / market.token_b_price
+            * self.collateral_scale
+            / self.debt_scale
+        )
+
+    def liquidator_balances(self, env) -> typing.Tuple[float, float]:
+        """Debt and collateral token balances of the liquidator"""
+        return (
+            self.liquidator.get_balance_debt_asset(env),
+            self.liquidator.get_balance_collateral_asset(env),
+        )
+
+    def _liquidations(
+        self, env, lost: typing.Dict[typing.Tuple[int, int], int]
+    ) -> typing.List:
+        # Decoded Liquidate events of the block matching the collateral
+        # and shares lost by the borrowers, the Liquidate log is the last
+        # log of Morpho Blue (after AccrueInterest), before the transfers
+        liquidations = list()
+        for event in env.get_last_events():
+            if event[0] != self.liquidate_selector:
+                continue
+            logs = [
+                log for address, log in event[1] if address == self.morpho_blue_address
+            ]
+            if not logs:
+                continue
+            decoded = self.liquidate_event.decode(logs[-1])
+            key = (decoded[2], decoded[1] + decoded[4])
+            if lost.get(key, 0) > 0:
+                lost[key] -= 1
+                liquidations.append(decoded)
+        return liquidations
+
+    def record(self, env, submitted: typing.Optional[typing.Set[bytes]] = None):
+        """
+        Update the metrics after a block was processed
+
+        Parameters
+        ----------
+        env
+            Simulation environment.
+        submitted: typing.Set[bytes], optional
+            Unused, for compatibility with the columnar recorder.
+        """
+        self.n_steps += 1
+        positions = self.read_positions(env)
+
+        lost_collateral = self.collateral - positions.collateral
+        lost_shares = self.borrow_shares - positions.borrow_shares
+        lost = dict()
+        for key in zip(
+            lost_collateral[lost_collateral > 0].tolist(),
+            lost_shares[lost_collateral > 0].tolist(),
+        ):
+            lost[key] = lost.get(key, 0) + 1
+        self.collateral = positions.collateral
+        self.borrow_shares = positions.borrow_shares
+        gbm_price = self.gbm_price()
+        for repaid, _, seized_assets, bad_debt, _ in self._liquidations(env, lost):
+            self.n_liquidations += 1
+            self.repaid_assets += repaid
+            self.seized_assets += seized_assets
+            self.realised_bad_debt += bad_debt
+            value = seized_assets / self.collateral_scale * gbm_price
+            discount = 1 - repaid / self.debt_scale / value
+            self.discount_value += discount * value
+            self.seized_value += value
+            self.min_liquidation_discount = min(self.min_liquidation_discount, discount)
+            self.max_liquidation_discount = max(self.max_liquidation_discount, discount)
+            self.liquidation_discount_histogram[
+                np.searchsorted(LIQUIDATION_DISCOUNT_BINS, discount)
+            ] += 1
+
+        debt = to_float(positions.debt_assets, self.debt_scale)
+        collateral_value = to_float(
+            positions.collateral * positions.price // ORACLE_PRICE_SCALE,
+            self.debt_scale,
+        )
+        has_debt = positions.debt_assets > 0
+        health_factor = positions.health_factor[has_debt]
+        unhealthy = positions.health_factor < 1
+        self.unhealthy_steps += unhealthy
+        shortfall = np.maximum(debt - collateral_value, 0).sum()
+        self.max_bad_debt = max(self.max_bad_debt, shortfall)
+        self.last = dict(
+            bad_debt=float(shortfall),
+            unhealthy_debt=float(debt[unhealthy].sum()),
+            underwater_fraction=float(np.mean(debt > collateral_value)),
+        )
+        if len(health_factor):
+            self.min_health_factor = min(self.min_health_factor, health_factor.min())
+            self.health_factors.add(health_factor)
+            self.health_factor_histogram += np.bincount(
+                np.searchsorted(HEALTH_FACTOR_BINS, health_factor),
+                minlength=len(self.health_factor_histogram),
+            )
+
+        # Change of the balances since the start, at the current Gbm price
+        debt_change, collateral_change = (
+            balance - initial
+            for balance, initial in zip(
+                self.liquidator_balances(env), self.initial_balances
+            )
+        )
+        self.liquidator_pnl = debt_change + collateral_change * gbm_price
+        self.min_liquidator_pnl = min(self.min_liquidator_pnl, self.liquidator_pnl)
+
+    def close(self):
+        """Nothing to release, for compatibility with the columnar recorder"""
+
+    def summary(self) -> typing.Dict[str, typing.Union[float, np.ndarray]]:
+        """
+        Risk metrics of the simulation so far
+
+        Amounts are in tokens, the final bad debt, unhealthy debt and
+        fraction of underwater positions are named as the statistics of
+        :py:mod:`simulations.morpho_blue.sampling` computed from full
+        records.
+        """
+        n_borrowers = len(self.borrowers)
+        mean_liquidation_discount = math.nan
+        if self.seized_value > 0:
+            mean_liquidation_discount = self.discount_value / self.seized_value
+        return dict(
+            n_steps=self.n_steps,
+            **self.last,
+            max_bad_debt=float(self.max_bad_debt),
+            realised_bad_debt=self.realised_bad_debt / self.debt_scale,
+            unhealthy_time=float(
+                self.unhealthy_steps.sum() / max(1, n_borrowers * self.n_steps)
+            ),
+            max_unhealthy_steps=int(self.unhealthy_steps.max(initial=0)),
+            n_unhealthy_borrowers=int((self.unhealthy_steps > 0).sum()),
+            min_health_factor=float(self.min_health_factor),
+            health_factor_q01=self.health_factors.quantile(0.01),
+            health_factor_q05=self.health_factors.quantile(0.05),
+            health_factor_q50=self.health_factors.quantile(0.5),
+            health_factor_histogram=self.health_factor_histogram.copy(),
+            n_liquidations=self.n_liquidations,
+            repaid_assets=self.repaid_assets / self.debt_scale,
+            seized_assets=self.seized_assets / self.collateral_scale,
+            mean_liquidation_discount=mean_liquidation_discount,
+            min_liquidation_discount=float(self.min_liquidation_discount),
+            max_liquidation_discount=float(self.max_liquidation_discount),
+            liquidation_discount_histogram=self.liquidation_discount_histogram.copy(),
+            liquidator_pnl=float(self.liquidator_pnl),
+            min_liquidator_pnl=float(self.min_liquidator_pnl),
+        )
@@ -0,0 +1,201 @@
+"""
+Search of the highest LLTV meeting a risk tolerance
+
+Noisy bisection over a grid of LLTVs: the risk statistic (see
+:py:mod:`simulations.morpho_blue.sampling`) is assumed to increase with
+the LLTV, and each evaluated LLTV is decided safe or unsafe against the
+target with the sequential test of
+:py:func:`simulations.morpho_blue.adaptive.decide`, running replicates
+in batches until the confidence interval of the statistic is decisive
+(or a maximum number of replicates is reached, the LLTV then being
+decided from its estimate).
+
+LLTVs are snapped to the grid so their setup snapshots are reused
+between searches, and the runs of each LLTV are kept and extended if
+it is evaluated again. All the LLTVs use the same seeds, in the same
+order.
+"""
+import math
+import typing
+
+import numpy as np
+
+from simulations.morpho_blue import adaptive, sampling
+from simulations.morpho_blue.store import ResultStore
+
+
+class SearchResult(typing.NamedTuple):
+    """Outcome of :py:func:`search_lltv`"""
+
+    # Highest LLTV found meeting the target, if any
+    recommended: typing.Optional[int]
+    # The highest LLTV meeting the target is between the highest LLTV
+    # found safe and the lowest LLTV found unsafe (if any)
+    bracket: typing.Tuple[typing.Optional[int], typing.Optional[int]]
+    # Whether all the evaluations were decided at the confidence level
+    decisive: bool
+    # Evaluated LLTVs, in the order of the search
+    evaluations: typing.List[adaptive.CandidateResult]
+    # Number of simulations run, and of a dense grid with as many
+    # replicates per LLTV as the maximum of the search
+    n_runs: int
+    grid_runs: int
+
+
+def search_lltv(
+    target: float,
+    seed: int,
+    sigma: float,
+    n_borrow_agents: int,
+    n_steps: int,
+    low: int = int(0.8e18),
+    high: int = int(0.98e18),
+    resolution: int = int(5e15),
+    max_replicates: int = 32,
+    batch_size: int = 4,
+    min_replicates: int = 8,
+    confidence: float = 0.95,
+    statistic: typing.Callable[
+        [typing.Dict[str, np.ndarray]], float
+    ] = sampling.bad_debt,
+    n_workers: typing.Optional[int] = None,
+    store: typing.Optional[ResultStore] = None,
+    **grid_kwargs,
+) -> SearchResult:
+    """
+    Find the highest LLTV whose expected risk is below a target
+
+    Parameters
+    ----------
+    target: float
+        Maximum expectation of the statistic, e.g. of the bad debt or of
+        the fraction of positions only liquidated with a loss.
+    seed: int
+        Base seed the seeds of the replicates are derived from.
+    sigma: float
+        Volatility of the external market.
+    n_borrow_agents: int
+        Number of borrowers.
+    n_steps: int
+        Number of steps of the simulations.
+    low: int, optional
+        Lowest LLTV of the search.
+    high: int, optional
+        Highest LLTV of the search.
+    resolution: int, optional
+        Spacing of the grid of LLTVs searched.
+    max_replicates: int, optional
+        Maximum number of replicates of an LLTV.
+    batch_size: int, optional
+        Number of replicates of an LLTV run at once.
+    min_replicates: int, optional
+        Number of replicates of an LLTV before it can be decided.
+    confidence: float, optional
+        Confidence level of each decision.
+    statistic: typing.Callable, optional
+        Risk statistic of a run, function of its borrower columns.
+    n_workers: int, optional
+        Number of worker processes running the replicates of a batch.
+    store: simulations.morpho_blue.store.ResultStore, optional
+        Store of results, replicates already stored (e.g. by a previous
+        search) are not run again.
+    **grid_kwargs
+        Other parameters of the runs, passed to
+        :py:func:`simulations.morpho_blue.sweep.make_grid` (e.g.
+        ``pregenerate_path`` or ``antithetic``).
+
+    Returns
+    -------
+    SearchResult
+        Recommended LLTV, with the bracket of the highest LLTV meeting
+        the target.
+    """
+    assert low < high, "Lowest LLTV has to be below the highest LLTV"
+    assert "multi_market" not in grid_kwargs, "LLTVs are run separately"
+    runs_per_replicate = 2 if grid_kwargs.get("antithetic", False) else 1
+    n_grid = math.ceil((high - low) / resolution)
+    # Evaluations of the bounds and of the bisection steps, each
+    # checking its interval after each batch
+    n_checks = (2 + math.ceil(math.log2(max(n_grid, 1)))) * math.ceil(
+        max_replicates / batch_size
+    )
+    z = adaptive.critical_value(confidence, n_checks)
+
+    lltv_samples = dict()
+    evaluations = list()
+
+    def grid_lltv(k: int) -> int:
+        return min(low + k * resolution, high)
+
+    def is_safe(k: int) -> bool:
+        lltv = grid_lltv(k)
+        candidate = None
+        while True:
+            n_done = len({sample.seed for sample in lltv_samples.get(lltv, list())})
+            if n_done:
+                candidate = adaptive.decide(
+                    lltv, lltv_samples[lltv], target, z, min_replicates
+                )
+                if candidate.decision != adaptive.UNDECIDED or n_done >= max_replicates:
+                    break
+            adaptive.run_replicates(
+                lltv_samples,
+                {lltv: min(batch_size, max_replicates - n_done)},
+                seed=seed,
+                sigma=sigma,
+                n_borrow_agents=n_borrow_agents,
+                n_steps=n_steps,
+                statistic=statistic,
+                n_workers=n_workers,
+                store=store,
+                **grid_kwargs,
+            )
+        evaluations.append(candidate)
+        if candidate.decision == adaptive.UNDECIDED:
+            return candidate.estimate.mean <= target
+        return candidate.decision == adaptive.SAFE
+
+    safe_k, unsafe_k = None, None
+    if is_safe(n_grid):
+        safe_k = n_grid
+    elif not is_safe(0):
+        unsafe_k = 0
+    else:
+        safe_k, unsafe_k = 0, n_grid
+        while unsafe_k - safe_k > 1:
+            k = (safe_k + unsafe_k) // 2
+            if is_safe(k):
+                safe_k = k
+            else:
+                unsafe_k = k
+
+    recommended = None if safe_k is None else grid_lltv(safe_k)
+    return SearchResult(
+        recommended=recommended,
+        bracket=(recommended, None if unsafe_k is None else grid_lltv(unsafe_k)),
+        decisive=all(c.decision != adaptive.UNDECIDED for c in evaluations),
+        evaluations=evaluations,
+        n_runs=sum(len(s) for s in lltv_samples.values()),
+        grid_runs=(n_grid + 1) * max_replicates * runs_per_replicate,
+    )
+
+
+def format_result(result: SearchResult) -> str:
+    """Table of the evaluations of :py:func:`search_lltv`"""
+    lines = adaptive.format_candidates(result.evaluations)
+    if result.recommended is None:
+        lines.append("No LLTV of the search meets the target")
+    else:
+        lower, upper = result.bracket
+        upper = "-" if upper is None else f"{upper / 1e18:.4g}"
+        lines.append(
+            f"Recommended LLTV: {result.recommended / 1e18:.4g} "
+            f"(highest LLTV meeting the target in [{lower / 1e18:.4g}, {upper}))"
+        )
+    if not result.decisive:
+        lines.append(
+            "Some LLTVs were decided from their estimate, "
+            "not at the confidence level"
+        )
+    lines.append(f"{result.n_runs} simulations, {result.grid_runs} with a dense grid")
+    return "\n".join(lines)
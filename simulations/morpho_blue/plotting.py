@@ -1,10 +1,12 @@
 import os
 from pathlib import Path
-from typing import List
+from typing import Dict, List
 
 import matplotlib.pyplot as plt
 import numpy as np
 
+from simulations.morpho_blue.recorder import records_to_columns
+
 PATH = Path(__file__).parent
 
 
@@ -13,19 +15,28 @@ def plot_results_borrowers(
     lltv: float,
     n_borrow_agents: int,
 ):
+    plot_records_borrowers(records_to_columns(records, n_borrow_agents), lltv=lltv)
+
+
+def plot_records_borrowers(
+    records: Dict[str, np.ndarray],
+    lltv: float,
+):
+    """
+    Plot borrower columns, e.g. loaded with
+    :py:func:`simulations.morpho_blue.recorder.load_records`
+    """
     dirname = os.path.join(PATH, "results")
     if not os.path.exists(dirname):
         os.makedirs(dirname)
 
-    n_steps = len(records)
-    records = [x[1 : 1 + n_borrow_agents] for x in records]
-    records = np.array(records).reshape(n_steps, -1, 5)
+    step = records["borrowers.step"]
+    n_borrow_agents = step.shape[1]
 
     fig, ax = plt.subplots(figsize=(6, 3))
     for i in range(n_borrow_agents):
-        hf = records[:, i, 1]
-        step = records[:, i, 0]
-        ax.plot(step[hf < 100], hf[hf < 100], label=f"Borrower {i}")
+        hf = records["borrowers.health_factor"][:, i]
+        ax.plot(step[hf < 100, i], hf[hf < 100], label=f"Borrower {i}")
     ax.set_xlabel("simulation step")
     ax.set_ylabel("health factor")
     ax.legend()
@@ -34,7 +45,9 @@ def plot_results_borrowers(
 
     fig, ax = plt.subplots(figsize=(6, 3))
     for i in range(n_borrow_agents):
-        ax.plot(records[:, i, 0], records[:, i, 2], label=f"Borrower {i}")
+        ax.plot(
+            step[:, i], records["borrowers.debt_assets"][:, i], label=f"Borrower {i}"
+        )
     ax.set_xlabel("simulation step")
     ax.set_ylabel("debt assets")
     ax.legend()
@@ -43,7 +56,11 @@ def plot_results_borrowers(
 
     fig, ax = plt.subplots(figsize=(6, 3))
     for i in range(n_borrow_agents):
-        ax.plot(records[:, i, 0], records[:, i, 3], label=f"Borrower {i}")
+        ax.plot(
+            step[:, i],
+            records["borrowers.collateral_assets"][:, i],
+            label=f"Borrower {i}",
+        )
     ax.set_xlabel("simulation step")
     ax.set_ylabel("collateral assets")
     ax.legend()
@@ -52,7 +69,9 @@ def plot_results_borrowers(
 
     fig, ax = plt.subplots(figsize=(6, 3))
     i = 0  # we just plot the price once
-    ax.plot(records[:, i, 0], records[:, i, 4], label=f"Borrower {i}")
+    ax.plot(
+        step[:, i], records["borrowers.price_collateral"][:, i], label=f"Borrower {i}"
+    )
     ax.set_xlabel("simulation step")
     ax.set_ylabel("price")
     fig.tight_layout()
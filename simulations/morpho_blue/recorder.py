@@ -0,0 +1,489 @@
+"""
+Columnar simulation recorder
+
+Records the data returned by the ``record`` method of the agents into
+preallocated typed NumPy columns, instead of the list of per-step lists
+of tuples returned by ``verbs.sim.Sim.run``. Columns are buffered in
+chunks of steps and flushed to ``.npy`` files as the simulation runs,
+so memory use does not grow with the number of steps. The files are
+read back memory-mapped with :py:func:`load_records`.
+
+What is recorded is configured for each group of agents with a
+:py:class:`RecordPolicy`: unused fields can be disabled, and agents can
+be recorded every ``k`` steps, only when their state may have changed,
+or only when their health factor is in a given band. Skipped records
+keep the last recorded values, so all columns still have one row per
+step.
+
+Agents holding a population of members in arrays (e.g.
+:py:class:`simulations.agents.borrower_population.BorrowerPopulation`)
+have an ``addresses`` attribute, and are recorded with one column per
+member.
+"""
+import json
+import os
+import typing
+
+import numpy as np
+from numpy.lib.format import open_memmap
+from tqdm import trange
+
+from simulations.agents.borrow_agent import BorrowAgent
+
+META_FILE = "meta.json"
+
+
+class RecordPolicy(typing.NamedTuple):
+    """
+    When and what to record for a group of agents
+
+    Fields that do not require any view call (e.g. the step of an
+    agent) are recorded at every step. The other fields are recorded
+    every ``every`` steps, and, if ``on_change`` or
+    ``max_health_factor`` are set, only for the agents selected by
+    either of these conditions. Agents are always recorded the first
+    time. When an agent is not recorded its last recorded values are
+    repeated.
+
+    Attributes
+    ----------
+    every: int
+        Number of steps between records.
+    fields: typing.Sequence[str], optional
+        Names of the recorded fields, by default all the
+        ``record_fields`` of the agents. No column is written for the
+        other fields.
+    on_change: bool
+        Record agents that submitted transactions during the step, and
+        all the agents of the group if the last block contains an event
+        from one of the ``change_selectors``. Changes only due to
+        prices or interest accruing are not tracked.
+    change_selectors: typing.Sequence[bytes]
+        Selectors of the functions whose events change the state of all
+        the agents of the group (e.g. a liquidation for borrowers).
+    max_health_factor: float, optional
+        Record agents whose health factor, estimated from their last
+        record and the current price of the collateral, is below this
+        value. Requires the ``health_factor`` and ``price_collateral``
+        fields, and agents with a ``get_price_collateral`` method.
+    """
+
+    every: int = 1
+    fields: typing.Optional[typing.Sequence[str]] = None
+    on_change: bool = False
+    change_selectors: typing.Sequence[bytes] = ()
+    max_health_factor: typing.Optional[float] = None
+
+
+class ColumnarRecorder:
+    """
+    Record agent data into typed columns flushed to disk
+
+    Agents are grouped (e.g. all the borrowers), each group has one
+    column per recorded field, of shape ``(n_steps, n_agents)`` and
+    stored in the file ``<group>.<field>.npy``. Population agents
+    account for one agent per member, their ``record`` method takes
+    the indices of the recorded members and returns arrays of values.
+
+    Parameters
+    ----------
+    path: str
+        Directory the columns are written to.
+    n_steps: int
+        Number of steps of the simulation.
+    groups: typing.Dict[str, typing.List]
+        Agents of each group. Agents should have a ``record_fields``
+        attribute with the names and dtypes of the values returned by
+        their ``record`` method, and can have a ``record_view_calls``
+        attribute with the number of view calls made to record each
+        field (one by default).
+    chunk_size: int, optional
+        Number of steps buffered in memory before being flushed to disk.
+    policies: typing.Dict[str, RecordPolicy], optional
+        Record policy of each group, groups without a policy record
+        all their fields at every step. Agents can be given individual
+        policies by putting them in their own group.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        n_steps: int,
+        groups: typing.Dict[str, typing.List],
+        chunk_size: int = 1024,
+        policies: typing.Optional[typing.Dict[str, RecordPolicy]] = None,
+    ):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.n_steps = n_steps
+        self.groups = groups
+        self.chunk_size = min(chunk_size, n_steps)
+        policies = dict() if policies is None else policies
+        self.policies = {group: policies.get(group, RecordPolicy()) for group in groups}
+
+        self.columns = dict()
+        self.buffers = dict()
+        # Last recorded values, repeated when agents are not recorded
+        self.last = dict()
+        # Fields recorded at every step and fields recorded by policy
+        self.free_fields = dict()
+        self.policy_fields = dict()
+        # View calls of a record of all the fields of an agent
+        self.full_cost = dict()
+        self.costs = dict()
+        self.recorded = dict()
+        # Agents of each group with their range of columns, and the
+        # addresses of the agents (or members) of each column
+        self.members = dict()
+        self.addresses = dict()
+        for group, agents in groups.items():
+            self.members[group] = list()
+            self.addresses[group] = list()
+            for agent in agents:
+                start = len(self.addresses[group])
+                if hasattr(agent, "addresses"):
+                    self.addresses[group].extend(agent.addresses)
+                else:
+                    self.addresses[group].append(agent.address)
+                self.members[group].append((agent, start, len(self.addresses[group])))
+            n_agents = len(self.addresses[group])
+
+            policy = self.policies[group]
+            record_fields = dict(agents[0].record_fields)
+            costs = getattr(agents[0], "record_view_calls", dict())
+            costs = {field: costs.get(field, 1) for field in record_fields}
+            fields = list(record_fields) if policy.fields is None else policy.fields
+
+            unknown = set(fields) - set(record_fields)
+            if unknown:
+                raise ValueError(f"Unknown fields {sorted(unknown)} for group {group}")
+            if policy.max_health_factor is not None and not {
+                "health_factor",
+                "price_collateral",
+            } <= set(fields):
+                raise ValueError(
+                    f"Group {group} needs the health_factor and price_collateral "
+                    "fields to be recorded by health factor"
+                )
+
+            self.costs[group] = costs
+            self.full_cost[group] = sum(costs.values())
+            self.free_fields[group] = [f for f in fields if costs[f] == 0]
+            self.policy_fields[group] = [f for f in fields if costs[f] > 0]
+            self.recorded[group] = np.zeros(n_agents, dtype=bool)
+
+            for field in fields:
+                dtype = record_fields[field]
+                name = f"{group}.{field}"
+                self.columns[name] = open_memmap(
+                    os.path.join(path, f"{name}.npy"),
+                    mode="w+",
+                    dtype=dtype,
+                    shape=(n_steps, n_agents),
+                )
+                self.buffers[name] = np.empty((self.chunk_size, n_agents), dtype=dtype)
+                self.last[name] = np.zeros(n_agents, dtype=dtype)
+
+        # Number of steps recorded and number flushed to disk
+        self.step = 0
+        self.flushed = 0
+        # View calls made when recording, and saved by the policies
+        self.view_calls = 0
+        self.view_calls_saved = 0
+
+    def _select(
+        self,
+        group: str,
+        env,
+        submitted: typing.Optional[typing.Set[bytes]],
+        selectors: typing.Set[bytes],
+    ) -> np.ndarray:
+        """Agents of a group recorded at the current step"""
+        policy = self.policies[group]
+        addresses = self.addresses[group]
+
+        if self.step % policy.every != 0:
+            return np.zeros(len(addresses), dtype=bool)
+        if not policy.on_change and policy.max_health_factor is None:
+            return np.ones(len(addresses), dtype=bool)
+
+        selected = ~self.recorded[group]
+        if policy.on_change:
+            if submitted is None or selectors.intersection(policy.change_selectors):
+                return np.ones(len(addresses), dtype=bool)
+            selected |= np.array([address in submitted for address in addresses])
+        if policy.max_health_factor is not None:
+            # Health factors are proportional to the price of the collateral
+            price = self.groups[group][0].get_price_collateral(env)
+            self.view_calls += 1
+            # Agents never recorded have no last values but are selected anyway
+            with np.errstate(divide="ignore", invalid="ignore"):
+                health_factor = (
+                    self.last[f"{group}.health_factor"]
+                    * price
+                    / self.last[f"{group}.price_collateral"]
+                )
+            selected |= health_factor < policy.max_health_factor
+
+        return selected
+
+    def record(self, env, submitted: typing.Optional[typing.Set[bytes]] = None):
+        """
+        Record the state of the agents at the current step
+
+        Parameters
+        ----------
+        env
+            Simulation environment.
+        submitted: typing.Set[bytes], optional
+            Addresses of the agents that submitted transactions during
+            the step, used by the ``on_change`` policies. If not
+            provided all agents are assumed to have changed.
+        """
+        row = self.step - self.flushed
+        selectors = None
+        for group in self.groups:
+            policy = self.policies[group]
+            if policy.on_change and selectors is None:
+                selectors = {event[0] for event in env.get_last_events()}
+            selected = self._select(group, env, submitted, selectors)
+            self.recorded[group] |= selected
+
+            costs = self.costs[group]
+            free_fields = self.free_fields[group]
+            policy_fields = self.policy_fields[group]
+            policy_cost = sum(costs[field] for field in policy_fields)
+            n_selected = int(selected.sum())
+            self.view_calls += policy_cost * n_selected
+            self.view_calls_saved += (
+                self.full_cost[group] * len(selected) - policy_cost * n_selected
+            )
+
+            for agent, start, stop in self.members[group]:
+                if hasattr(agent, "addresses"):
+                    if free_fields:
+                        values = agent.record(env, free_fields)
+                        for field, value in zip(free_fields, values):
+                            self.last[f"{group}.{field}"][start:stop] = value
+                    index = np.flatnonzero(selected[start:stop])
+                    if policy_fields and len(index) > 0:
+                        values = agent.record(env, policy_fields, index)
+                        for field, value in zip(policy_fields, values):
+                            self.last[f"{group}.{field}"][start + index] = value
+                    continue
+
+                fields = free_fields
+                if selected[start]:
+                    fields = fields + policy_fields
+                if not fields:
+                    continue
+                values = agent.record(env, fields)
+                for field, value in zip(fields, values):
+                    self.last[f"{group}.{field}"][start] = value
+
+            for field in self.free_fields[group] + self.policy_fields[group]:
+                name = f"{group}.{field}"
+                self.buffers[name][row] = self.last[name]
+
+        self.step += 1
+        if self.step - self.flushed == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered steps to disk"""
+        n = self.step - self.flushed
+        if n == 0:
+            return
+        for name, column in self.columns.items():
+            column[self.flushed : self.step] = self.buffers[name][:n]
+            column.flush()
+        self.flushed = self.step
+
+        with open(os.path.join(self.path, META_FILE), "w") as f:
+            json.dump(
+                dict(
+                    n_steps=self.n_steps,
+                    n_recorded=self.step,
+                    groups={
+                        group: len(addresses)
+                        for group, addresses in self.addresses.items()
+                    },
+                    view_calls=self.view_calls,
+                    view_calls_saved=self.view_calls_saved,
+                ),
+                f,
+            )
+
+    def close(self):
+        """Flush the remaining steps and release the files"""
+        self.flush()
+        self.columns = dict()
+
+    def __getstate__(self):
+        # Columns are reopened from their files, only the steps not
+        # flushed yet are kept from the buffers
+        state = self.__dict__.copy()
+        state["columns"] = list(self.columns)
+        state["buffers"] = {
+            name: buffer[: self.step - self.flushed].copy()
+            for name, buffer in self.buffers.items()
+        }
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.columns = {
+            name: open_memmap(os.path.join(self.path, f"{name}.npy"), mode="r+")
+            for name in state["columns"]
+        }
+        for name, rows in state["buffers"].items():
+            buffer = np.empty((self.chunk_size,) + rows.shape[1:], dtype=rows.dtype)
+            buffer[: len(rows)] = rows
+            self.buffers[name] = buffer
+
+
+class ListRecorder:
+    """
+    Record agent data into a list, as returned by ``verbs.sim.Sim.run``
+
+    Parameters
+    ----------
+    agents: typing.List
+        Recorded agents.
+    """
+
+    def __init__(self, agents: typing.List):
+        self.agents = agents
+        # Records of each agent at each step
+        self.records = list()
+
+    def record(self, env, submitted: typing.Optional[typing.Set[bytes]] = None):
+        """Record the state of the agents at the current step"""
+        self.records.append([agent.record(env) for agent in self.agents])
+
+    def close(self):
+        pass
+
+
+def run(
+    sim,
+    n_steps: int,
+    recorder: typing.Union[ColumnarRecorder, typing.Sequence[ColumnarRecorder]],
+    start: int = 0,
+    reseeder=None,
+    checkpointer=None,
+):
+    """
+    Run a simulation recording the agents with a columnar recorder
+
+    Follows the steps of ``verbs.sim.Sim.run``, with the agent records
+    written to ``recorder`` instead of being returned.
+
+    Parameters
+    ----------
+    sim: verbs.sim.Sim
+        Simulation to run.
+    n_steps: int
+        Number of steps of the simulation.
+    recorder: ColumnarRecorder | typing.Sequence[ColumnarRecorder]
+        Recorder of the agents data, or several recorders (e.g. one per
+        market) each recording its own agents. Any object with the
+        ``record`` and ``close`` methods of :py:class:`ColumnarRecorder`
+        can be used (e.g. a :py:class:`ListRecorder` or a
+        :py:class:`simulations.morpho_blue.metrics.RiskAggregator`).
+    start: int, optional
+        Step the simulation starts from, e.g. the step of the checkpoint
+        it was restored from.
+    reseeder: simulations.morpho_blue.sim.EnvReseeder, optional
+        Reseeder updated after each step, which continues the simulation
+        on a reseeded environment at its reseeding steps.
+    checkpointer: simulations.morpho_blue.checkpoint.Checkpointer, optional
+        Checkpointer saving the state of the simulation and of the
+        recorders, updated at the reseeding steps of ``reseeder``.
+    """
+    recorders = recorder if isinstance(recorder, (list, tuple)) else [recorder]
+    for step in trange(start, n_steps, initial=start, total=n_steps):
+
+        submitted = set()
+        for agent in sim.agents:
+            calls = agent.update(sim.rng, sim.env)
+            # Senders of the transactions, i.e. agents or population members
+            submitted.update(call[0] for call in calls)
+            sim.env.submit_transactions(calls)
+
+        sim.env.process_block()
+
+        for columnar_recorder in recorders:
+            columnar_recorder.record(sim.env, submitted=submitted)
+
+        snapshot = None
+        if reseeder is not None:
+            snapshot = reseeder.update(sim, step + 1)
+        if checkpointer is not None and snapshot is not None:
+            checkpointer.update(sim, step + 1, snapshot, recorders)
+
+    if checkpointer is not None:
+        checkpointer.close()
+    for columnar_recorder in recorders:
+        columnar_recorder.close()
+
+
+def load_meta(path: str) -> typing.Dict:
+    """
+    Load the metadata written by a :py:class:`ColumnarRecorder`, i.e.
+    the number of steps, the size of the groups and the number of view
+    calls made and saved by the record policies
+    """
+    with open(os.path.join(path, META_FILE), "r") as f:
+        return json.load(f)
+
+
+def load_records(path: str) -> typing.Dict[str, np.ndarray]:
+    """
+    Load the columns written by a :py:class:`ColumnarRecorder`
+
+    Columns are memory-mapped (not read into memory) and truncated
+    to the number of recorded steps.
+
+    Parameters
+    ----------
+    path: str
+        Directory the columns were written to.
+
+    Returns
+    -------
+    typing.Dict[str, np.ndarray]
+        Columns, with keys ``<group>.<field>``, of shape
+        ``(n_recorded_steps, n_agents)``.
+    """
+    n_recorded = load_meta(path)["n_recorded"]
+
+    return {
+        file[: -len(".npy")]: np.load(os.path.join(path, file), mmap_mode="r")[
+            :n_recorded
+        ]
+        for file in sorted(os.listdir(path))
+        if file.endswith(".npy")
+    }
+
+
+def records_to_columns(
+    records: typing.List[typing.List], n_borrow_agents: int
+) -> typing.Dict[str, np.ndarray]:
+    """
+    Convert the records returned by ``verbs.sim.Sim.run`` to the
+    borrower columns written by the columnar recorder
+
+    Records of a borrower population (tuples of arrays with one value
+    per borrower) are expanded to one record per borrower.
+    """
+    n_steps = len(records)
+    if isinstance(records[0][1][0], np.ndarray):
+        records = [np.stack(x[1], axis=-1) for x in records]
+    else:
+        records = [x[1 : 1 + n_borrow_agents] for x in records]
+    records = np.array(records).reshape(n_steps, -1, len(BorrowAgent.record_fields))
+    return {
+        f"borrowers.{field}": records[:, :, i]
+        for i, (field, _) in enumerate(BorrowAgent.record_fields)
+    }
@@ -0,0 +1,390 @@
+"""
+Variance reduction of sweep estimates
+
+Estimates of a statistic of the runs of a sweep (e.g. the bad debt of
+the market at the end of the simulation) for each LLTV, using the
+sampling of the sweep (see :py:func:`simulations.morpho_blue.sweep.make_grid`):
+
+- Antithetic runs (the Gbm path of a seed and its antithetic path) are
+  averaged into a single sample.
+- The price of the Gbm path driving the external market at the last
+  step is used as a control variate, its expectation being known. The
+  price recorded by the Uniswap agent includes the transient impact of
+  the Uniswap trades, whose expectation is unknown, so the control is
+  regenerated from the seed of pre-generated paths instead.
+- Differences between LLTVs are estimated from runs paired by seed,
+  which share their random numbers with common random numbers.
+
+Each estimate reports the variance reduction achieved, i.e. the ratio
+of the variance of the mean of the same number of independent runs to
+the variance of the estimate.
+"""
+import typing
+
+import numpy as np
+
+from simulations.morpho_blue import recorder, sim
+
+
+class Estimate(typing.NamedTuple):
+    """Estimate of the expectation of a statistic"""
+
+    mean: float
+    std_error: float
+    n_runs: int
+    # Standard error of the mean of the same number of independent runs
+    naive_std_error: float
+    # Ratio of the naive variance to the variance of the estimate
+    variance_reduction: float
+
+
+class Sample(typing.NamedTuple):
+    """Statistic of a run of a sweep"""
+
+    # Parameters of the run, other than the seed and the LLTV
+    group: typing.Tuple
+    lltv: int
+    seed: int
+    antithetic: bool
+    value: float
+    # Last price of the Gbm path of the run, if pre-generated
+    control: typing.Optional[float]
+
+
+def bad_debt(columns: typing.Dict[str, np.ndarray]) -> float:
+    """
+    Debt of the borrowers not covered by their collateral at the last step
+
+    Parameters
+    ----------
+    columns: typing.Dict[str, np.ndarray]
+        Borrower columns, see
+        :py:func:`simulations.morpho_blue.recorder.records_to_columns`.
+    """
+    debt = np.asarray(columns["borrowers.debt_assets"][-1])
+    collateral = np.asarray(columns["borrowers.collateral_assets"][-1])
+    price = np.asarray(columns["borrowers.price_collateral"][-1])
+    return float(np.maximum(debt - collateral * price, 0).sum())
+
+
+def unhealthy_debt(columns: typing.Dict[str, np.ndarray]) -> float:
+    """
+    Debt of the borrowers with a health factor below one at the last step
+
+    Parameters
+    ----------
+    columns: typing.Dict[str, np.ndarray]
+        Borrower columns, see
+        :py:func:`simulations.morpho_blue.recorder.records_to_columns`.
+    """
+    debt = np.asarray(columns["borrowers.debt_assets"][-1])
+    health_factor = np.asarray(columns["borrowers.health_factor"][-1])
+    return float(debt[health_factor < 1].sum())
+
+
+def underwater_fraction(columns: typing.Dict[str, np.ndarray]) -> float:
+    """
+    Fraction of the borrowers whose debt exceeds the value of their
+    collateral at the last step, i.e. only liquidated with a loss
+
+    Parameters
+    ----------
+    columns: typing.Dict[str, np.ndarray]
+        Borrower columns, see
+        :py:func:`simulations.morpho_blue.recorder.records_to_columns`.
+    """
+    debt = np.asarray(columns["borrowers.debt_assets"][-1])
+    collateral = np.asarray(columns["borrowers.collateral_assets"][-1])
+    price = np.asarray(columns["borrowers.price_collateral"][-1])
+    return float(np.mean(debt > collateral * price))
+
+
+# Risk statistics by name
+STATISTICS = dict(
+    bad_debt=bad_debt,
+    unhealthy_debt=unhealthy_debt,
+    underwater_fraction=underwater_fraction,
+)
+
+
+def control_variate(params: typing.Dict) -> typing.Optional[float]:
+    """
+    Last price of the Gbm path driving the external market of a run
+
+    Only available for runs following pre-generated paths, ``None``
+    otherwise. The expectation of the control is given by
+    :py:func:`control_mean`.
+    """
+    if not params["pregenerate_path"] or params["price_series"] is not None:
+        return None
+    path = sim.gbm_price_path(
+        params["seed"],
+        params["sigma"],
+        params["n_steps"],
+        antithetic=params.get("antithetic", False),
+    )
+    return float(path[-1])
+
+
+def control_mean(n_steps: int) -> float:
+    """Expectation of the control variate of runs of ``n_steps``"""
+    return float(np.exp(sim.GBM_MU * sim.GBM_DT * n_steps))
+
+
+def samples(
+    results: typing.List[typing.Dict],
+    statistic: typing.Callable[[typing.Dict[str, np.ndarray]], float] = bad_debt,
+) -> typing.List[Sample]:
+    """
+    Statistic of each run of a sweep
+
+    Parameters
+    ----------
+    results: typing.List[typing.Dict]
+        Results of :py:func:`simulations.morpho_blue.sweep.run_sweep`,
+        with records in memory or written to columns. Runs of several
+        markets give one sample per market.
+    statistic: typing.Callable, optional
+        Function of the borrower columns of a run. Runs returning the
+        summary of their risk metrics take the metric named after the
+        statistic (see :py:mod:`simulations.morpho_blue.metrics`).
+
+    Returns
+    -------
+    typing.List[Sample]
+        Samples, in the order of the runs.
+    """
+    result_samples = list()
+    for result in results:
+        params = result["params"]
+        records = result["records"]
+        if isinstance(params["lltv"], tuple):
+            if isinstance(records, str):
+                records = sim.load_market_records(records)
+            market_records = zip(params["lltv"], records.values())
+        else:
+            market_records = [(params["lltv"], records)]
+
+        group = (
+            params["sigma"],
+            params["n_borrow_agents"],
+            params["n_steps"],
+            params["price_window"],
+        )
+        control = control_variate(params)
+        for lltv, lltv_records in market_records:
+            if params.get("summary", False):
+                value = lltv_records[statistic.__name__]
+            elif isinstance(lltv_records, str):
+                value = statistic(recorder.load_records(lltv_records))
+            elif isinstance(lltv_records, dict):
+                value = statistic(lltv_records)
+            else:
+                value = statistic(
+                    recorder.records_to_columns(lltv_records, params["n_borrow_agents"])
+                )
+            result_samples.append(
+                Sample(
+                    group=group,
+                    lltv=lltv,
+                    seed=params["seed"],
+                    antithetic=params.get("antithetic", False),
+                    value=value,
+                    control=control,
+                )
+            )
+    return result_samples
+
+
+def _variance_reduction(naive_variance: float, variance: float) -> float:
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return float(np.float64(naive_variance) / np.float64(variance))
+
+
+def _units(
+    group_samples: typing.Sequence[Sample],
+) -> typing.Dict[int, typing.List[Sample]]:
+    # Independent units of a group: the runs of each seed, i.e. the
+    # single run or the antithetic pair
+    units = dict()
+    for sample in group_samples:
+        units.setdefault(sample.seed, list()).append(sample)
+    return units
+
+
+def estimate_group(
+    group_samples: typing.Sequence[Sample], control_variates: bool = True
+) -> Estimate:
+    """
+    Estimate the expectation of a statistic from the runs of one LLTV
+
+    Parameters
+    ----------
+    group_samples: typing.Sequence[Sample]
+        Samples of runs sharing all their parameters but the seed.
+    control_variates: bool, optional
+        Use the Gbm path as control variate, if available.
+
+    Returns
+    -------
+    Estimate
+        Estimate combining the antithetic runs and the control variate.
+    """
+    values = np.array([sample.value for sample in group_samples])
+    n_runs = len(values)
+    naive_variance = values.var(ddof=1) / n_runs if n_runs > 1 else np.nan
+
+    units = list(_units(group_samples).values())
+    y = np.array([np.mean([sample.value for sample in unit]) for unit in units])
+    controls = [sample.control for unit in units for sample in unit]
+    if control_variates and None not in controls and len(units) > 2:
+        x = np.array([np.mean([sample.control for sample in unit]) for unit in units])
+        x_variance = x.var(ddof=1)
+        if x_variance > 0:
+            beta = np.cov(y, x)[0, 1] / x_variance
+            n_steps = group_samples[0].group[2]
+            y = y - beta * (x - control_mean(n_steps))
+
+    variance = y.var(ddof=1) / len(y) if len(y) > 1 else np.nan
+    return Estimate(
+        mean=float(y.mean()),
+        std_error=float(np.sqrt(variance)),
+        n_runs=n_runs,
+        naive_std_error=float(np.sqrt(naive_variance)),
+        variance_reduction=_variance_reduction(naive_variance, variance),
+    )
+
+
+def estimate(
+    result_samples: typing.Sequence[Sample], control_variates: bool = True
+) -> typing.Dict[typing.Tuple, Estimate]:
+    """
+    Estimates of a statistic for each LLTV of a sweep
+
+    Parameters
+    ----------
+    result_samples: typing.Sequence[Sample]
+        Samples of the runs, see :py:func:`samples`.
+    control_variates: bool, optional
+        Use the Gbm path as control variate, if available.
+
+    Returns
+    -------
+    typing.Dict[typing.Tuple, Estimate]
+        Estimate for each group of parameters and LLTV.
+    """
+    groups = dict()
+    for sample in result_samples:
+        groups.setdefault((sample.group, sample.lltv), list()).append(sample)
+    return {
+        key: estimate_group(group_samples, control_variates=control_variates)
+        for key, group_samples in groups.items()
+    }
+
+
+def compare_lltvs(
+    result_samples: typing.Sequence[Sample],
+) -> typing.Dict[typing.Tuple, Estimate]:
+    """
+    Estimates of the differences of a statistic between LLTVs
+
+    Differences between consecutive LLTVs (in increasing order) are
+    estimated from the runs of the same seeds when both LLTVs were run
+    with the same seeds, i.e. with common random numbers, and from
+    independent runs otherwise, without control variate. The naive
+    standard error is the one of the difference of the means of
+    independent runs.
+
+    Parameters
+    ----------
+    result_samples: typing.Sequence[Sample]
+        Samples of the runs, see :py:func:`samples`.
+
+    Returns
+    -------
+    typing.Dict[typing.Tuple, Estimate]
+        Estimate of the difference between the statistic at the higher
+        and the lower LLTV, for each group of parameters and pair of
+        consecutive LLTVs.
+    """
+    groups = dict()
+    for sample in result_samples:
+        groups.setdefault(sample.group, dict()).setdefault(sample.lltv, list()).append(
+            sample
+        )
+
+    differences = dict()
+    for group, lltv_samples in groups.items():
+        lltvs = sorted(lltv_samples)
+        for low, high in zip(lltvs[:-1], lltvs[1:]):
+            low_units, high_units = (
+                {
+                    seed: np.mean([sample.value for sample in unit])
+                    for seed, unit in _units(lltv_samples[lltv]).items()
+                }
+                for lltv in (low, high)
+            )
+            naive_variance = sum(
+                np.var([sample.value for sample in lltv_samples[lltv]], ddof=1)
+                / len(lltv_samples[lltv])
+                for lltv in (low, high)
+            )
+            if low_units.keys() == high_units.keys():
+                d = np.array([high_units[seed] - low_units[seed] for seed in low_units])
+                mean = d.mean()
+                variance = d.var(ddof=1) / len(d)
+            else:
+                low_y, high_y = (
+                    np.array(list(units.values())) for units in (low_units, high_units)
+                )
+                mean = high_y.mean() - low_y.mean()
+                variance = sum(y.var(ddof=1) / len(y) for y in (high_y, low_y))
+            differences[(group, low, high)] = Estimate(
+                mean=float(mean),
+                std_error=float(np.sqrt(variance)),
+                n_runs=len(lltv_samples[low]) + len(lltv_samples[high]),
+                naive_std_error=float(np.sqrt(naive_variance)),
+                variance_reduction=_variance_reduction(naive_variance, variance),
+            )
+    return differences
+
+
+def format_report(
+    estimates: typing.Dict[typing.Tuple, Estimate],
+    differences: typing.Optional[typing.Dict[typing.Tuple, Estimate]] = None,
+) -> str:
+    """
+    Table of the estimates of a sweep and of their variance reduction
+
+    Parameters
+    ----------
+    estimates: typing.Dict[typing.Tuple, Estimate]
+        Estimates returned by :py:func:`estimate`.
+    differences: typing.Dict[typing.Tuple, Estimate], optional
+        Differences returned by :py:func:`compare_lltvs`.
+    """
+    header = (
+        f"{'sigma':>6} {'borrowers':>9} {'lltv':>12} {'runs':>5} {'mean':>12} "
+        f"{'std err':>10} {'naive':>10} {'reduction':>9}"
+    )
+
+    def row(group, lltv, e):
+        sigma, n_borrow_agents, _, _ = group
+        return (
+            f"{sigma:>6.3g} {n_borrow_agents:>9d} {lltv:>12} {e.n_runs:>5d} "
+            f"{e.mean:>12.6g} {e.std_error:>10.4g} {e.naive_std_error:>10.4g} "
+            f"{e.variance_reduction:>9.3g}"
+        )
+
+    lines = [header]
+    lines.extend(
+        row(group, f"{lltv / 1e18:.4g}", e) for (group, lltv), e in estimates.items()
+    )
+    if differences:
+        lines.append("")
+        lines.append(header)
+        lines.extend(
+            row(group, f"{high / 1e18:.4g}-{low / 1e18:.4g}", e)
+            for (group, low, high), e in differences.items()
+        )
+    return "\n".join(lines)
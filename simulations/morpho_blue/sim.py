@@ -1,18 +1,41 @@
+import hashlib
 import json
+import os
+import pickle
+import typing
 from functools import partial
 from pathlib import Path
 
+import numpy as np
 import verbs
 from verbs.utils import ZERO_ADDRESS
 
 from simulations import abi
 from simulations.agents.borrow_agent import BorrowAgent
+from simulations.agents.borrower_population import BorrowerPopulation
 from simulations.agents.liquidation_agent import LiquidationAgent
 from simulations.agents.supply_agent import SupplyAgent
-from simulations.agents.uniswap_agent import DummyUniswapAgent, UniswapAgent
-from simulations.utils.erc20 import mint_and_approve_dai, mint_and_approve_weth
+from simulations.agents.uniswap_agent import (
+    DummyUniswapAgent,
+    UniswapAgent,
+    gbm_paths,
+)
+from simulations.morpho_blue import metrics, recorder
+from simulations.utils import storage
+from simulations.utils.cache import cache_from_binary, cache_to_binary
+from simulations.utils.call_cache import CachedEnv
+from simulations.utils.erc20 import (
+    inject_dai,
+    inject_weth,
+    mint_and_approve_dai,
+    mint_and_approve_weth,
+)
+from simulations.utils.market_mirror import MarketMirror, MirroredEnv
+from simulations.utils.morpho import inject_positions, inject_supply
+from simulations.utils.position_reader import PositionReader
 
 PATH = Path(__file__).parent
+SNAPSHOT_PATH = PATH / "snapshots"
 
 MORPHO_BLUE = "0xBBBBBbbBBb9cC5e90e3b3Af64bdAF62C37EEFFCb"
 ADAPTIVE_CURVE_IRM = "0x870aC11D48B15DB9a138Cf899d20F13F79Ba00BC"
@@ -26,34 +49,341 @@ UNISWAP_WETH_DAI = "0xC2e9F25Be6257c210d7Adf0D4Cd6E3E881ba25f8"
 SWAP_ROUTER = "0xE592427A0AEce92De3Edee1F18E0157C05861564"
 UNISWAP_QUOTER = "0x61fFE014bA17989E743c5F6cB21bF9697530B21e"
 
+UNISWAP_FEE = 3000
 
-def runner(
+# Agent ids (converted to addresses with verbs.utils.int_to_address)
+SUPPLIER_ID = 1
+UNISWAP_AGENT_ID = 10
+BORROWER_ID_OFFSET = 100
+LIQUIDATOR_ID = 1000
+# Ids of the agents other than borrowers, skipped when allocating borrower ids
+RESERVED_IDS = (SUPPLIER_ID, UNISWAP_AGENT_ID, LIQUIDATOR_ID)
+# Liquidators of the other markets of a multi-market simulation have ids
+# above any borrower id
+LIQUIDATOR_ID_OFFSET = 2**32
+
+# Initial token amounts of the agents
+SUPPLIER_WETH = int(1e24)
+SUPPLIER_DAI = int(1e30)
+SUPPLIED_DAI = 10**25
+# Supply is scaled up to cover large numbers of borrowers
+SUPPLIED_DAI_PER_BORROWER = 10**23
+BORROWER_WETH = int(1e24)
+LIQUIDATOR_WETH = int(5e29)
+LIQUIDATOR_DAI = int(5e29)
+UNISWAP_AGENT_WETH = int(1e24)
+UNISWAP_AGENT_DAI = int(1e30)
+
+# Borrower positions
+BORROWER_COLLATERAL = 10
+BORROWER_INITIAL_LTV = 0.75
+
+# External market model
+GBM_MU = 0.0
+GBM_DT = 0.01
+
+# Contracts deployed during the market setup
+SETUP_CONTRACTS = ("UniswapAggregator.json", "MorphoBlueSnippets.json")
+
+# Selectors of the view functions returning immutable values, whose
+# results are cached for the whole simulation
+PERMANENT_SELECTORS = (
+    abi.weth_erc20.decimals.selector,
+    abi.morpho_blue_snippets.getId.selector,
+    abi.uniswap_pool.token0.selector,
+    abi.uniswap_pool.token1.selector,
+)
+
+# Number of blocks between checks of the market mirror against the EVM
+MIRROR_CHECK_EVERY = 100
+
+# File listing the ids of the markets whose columns are written to the
+# subdirectories of the records directory of a multi-market run
+MARKETS_FILE = "markets.json"
+
+# Snapshots of the market setup already loaded by this process
+_SNAPSHOTS = dict()
+# Price paths generated in the current process
+_PRICE_PATHS = dict()
+
+
+def market_lltvs(lltv: typing.Union[int, typing.Sequence[int]]) -> typing.List[int]:
+    """LLTVs of the simulated markets, given one LLTV or a sequence of LLTVs"""
+    if isinstance(lltv, (int, np.integer)):
+        return [int(lltv)]
+    return [int(x) for x in lltv]
+
+
+def borrower_ids(n_borrow_agents: int, market: int = 0) -> np.ndarray:
+    """
+    Ids of the borrowers of a market
+
+    Consecutive ids starting from ``BORROWER_ID_OFFSET``, skipping the
+    ids of the other agents so addresses never collide. The borrowers of
+    the ``market``-th market of a multi-market simulation follow those
+    of the previous markets.
+    """
+    n_ids = n_borrow_agents * (market + 1)
+    ids = np.arange(BORROWER_ID_OFFSET, BORROWER_ID_OFFSET + n_ids + len(RESERVED_IDS))
+    return ids[~np.isin(ids, RESERVED_IDS)][n_borrow_agents * market : n_ids]
+
+
+def borrower_addresses(n_borrow_agents: int, market: int = 0) -> typing.List[bytes]:
+    """Addresses of the borrowers of a market, see :py:func:`borrower_ids`"""
+    return [
+        verbs.utils.int_to_address(int(i))
+        for i in borrower_ids(n_borrow_agents, market)
+    ]
+
+
+def liquidator_id(market: int = 0) -> int:
+    """Id of the liquidator of a market"""
+    return LIQUIDATOR_ID if market == 0 else LIQUIDATOR_ID_OFFSET + market
+
+
+def supplied_dai(n_borrow_agents: int) -> int:
+    """DAI supplied to the market by the supplier"""
+    return max(SUPPLIED_DAI, n_borrow_agents * SUPPLIED_DAI_PER_BORROWER)
+
+
+# Hashes of files already computed by this process, by path, size and
+# modification time
+_FILE_HASHES = dict()
+
+
+def file_hash(path: typing.Union[str, os.PathLike]) -> str:
+    """Hash of the content of a file, e.g. of a fork cache"""
+    stat = os.stat(path)
+    key = (str(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _FILE_HASHES:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        _FILE_HASHES[key] = digest.hexdigest()
+    return _FILE_HASHES[key]
+
+
+def cache_path() -> Path:
+    """
+    Path of the cache of the forked EVM, the binary cache ``cache.bin``
+    if it exists, otherwise the JSON cache ``cache.json``
+    """
+    path = PATH / "cache.bin"
+    if not path.exists():
+        path = PATH / "cache.json"
+    return path
+
+
+def load_cache() -> verbs.types.Cache:
+    """
+    Load the cache of the forked EVM from disk
+
+    Reads the binary cache ``cache.bin`` if it exists, otherwise
+    falls back to the JSON cache ``cache.json``.
+    """
+    path = cache_path()
+    if path.suffix == ".bin":
+        return cache_from_binary(str(path))
+
+    with open(path, "r") as f:
+        cache_json = json.load(f)
+
+    return verbs.utils.cache_from_json(cache_json)
+
+
+def extend_cache(
+    cache: verbs.types.Cache,
+    n_borrow_agents: int,
+    lltv: typing.Union[int, typing.Sequence[int]],
+) -> verbs.types.Cache:
+    """
+    Extend the cache with the storage of new markets and new agents
+
+    The cache only contains the storage fetched when it was generated
+    (i.e. for the LLTV and number of borrowers used then). The markets
+    created in the simulation and the accounts of the agents do not exist
+    at the forked block, so their storage is zero, and it is added to the
+    cache to be able to run with any LLTVs and number of borrowers.
+    """
+    weth_address = verbs.utils.hex_to_bytes(WETH)
+    dai_address = verbs.utils.hex_to_bytes(DAI)
+    morpho_blue_address = verbs.utils.hex_to_bytes(MORPHO_BLUE)
+    swap_router_address = verbs.utils.hex_to_bytes(SWAP_ROUTER)
+    owner_address = verbs.utils.hex_to_bytes(OWNER)
+
+    # The oracle is the first contract deployed by the owner in the setup
+    owner_nonce = next(x[1][1] for x in cache[2] if x[0] == owner_address)
+    uniswap_aggregator_address = storage.create_address(owner_address, owner_nonce)
+
+    slots = list()
+    for market, market_lltv in enumerate(market_lltvs(lltv)):
+        slots.extend(
+            _market_slots(
+                market_lltv,
+                uniswap_aggregator_address,
+                [verbs.utils.int_to_address(SUPPLIER_ID)]
+                + borrower_addresses(n_borrow_agents, market),
+            )
+        )
+        if market > 0:
+            # Token balances and allowances of the liquidators of the
+            # other markets
+            liquidator_address = verbs.utils.int_to_address(liquidator_id(market))
+            for spender in [morpho_blue_address, swap_router_address]:
+                slots += [
+                    (
+                        weth_address,
+                        storage.nested_mapping_slot(
+                            liquidator_address, spender, storage.WETH_ALLOWANCE_SLOT
+                        ),
+                    ),
+                    (
+                        dai_address,
+                        storage.nested_mapping_slot(
+                            liquidator_address, spender, storage.DAI_ALLOWANCE_SLOT
+                        ),
+                    ),
+                ]
+            slots += [
+                (
+                    weth_address,
+                    storage.mapping_slot(
+                        liquidator_address, storage.WETH_BALANCE_OF_SLOT
+                    ),
+                ),
+                (
+                    dai_address,
+                    storage.mapping_slot(
+                        liquidator_address, storage.DAI_BALANCE_OF_SLOT
+                    ),
+                ),
+            ]
+
+    return storage.zero_fill_cache(cache, slots)
+
+
+def _market_slots(
+    lltv: int, uniswap_aggregator_address: bytes, users: typing.List[bytes]
+) -> typing.List[typing.Tuple[bytes, int]]:
+    """Storage slots of a market and of its users, see :py:func:`extend_cache`"""
+    weth_address = verbs.utils.hex_to_bytes(WETH)
+    dai_address = verbs.utils.hex_to_bytes(DAI)
+    morpho_blue_address = verbs.utils.hex_to_bytes(MORPHO_BLUE)
+    adaptive_curve_irm_address = verbs.utils.hex_to_bytes(ADAPTIVE_CURVE_IRM)
+
+    market_id = storage.morpho_market_id(
+        (
+            dai_address,
+            weth_address,
+            uniswap_aggregator_address,
+            adaptive_curve_irm_address,
+            lltv,
+        )
+    )
+
+    slots = [
+        (
+            morpho_blue_address,
+            storage.mapping_slot(lltv, storage.MORPHO_IS_LLTV_ENABLED_SLOT),
+        ),
+        (
+            adaptive_curve_irm_address,
+            storage.mapping_slot(market_id, storage.IRM_RATE_AT_TARGET_SLOT),
+        ),
+    ]
+    slots.extend(
+        (morpho_blue_address, slot) for slot in storage.morpho_market_slots(market_id)
+    )
+
+    for user in users:
+        slots.extend(
+            (morpho_blue_address, slot)
+            for slot in storage.morpho_position_slots(market_id, user)
+        )
+        slots += [
+            (
+                weth_address,
+                storage.mapping_slot(user, storage.WETH_BALANCE_OF_SLOT),
+            ),
+            (
+                weth_address,
+                storage.nested_mapping_slot(
+                    user, morpho_blue_address, storage.WETH_ALLOWANCE_SLOT
+                ),
+            ),
+            (
+                dai_address,
+                storage.mapping_slot(user, storage.DAI_BALANCE_OF_SLOT),
+            ),
+            (
+                dai_address,
+                storage.nested_mapping_slot(
+                    user, morpho_blue_address, storage.DAI_ALLOWANCE_SLOT
+                ),
+            ),
+        ]
+
+    return slots
+
+
+def get_market_params(deployment: typing.Dict[str, bytes], lltv: int) -> typing.Tuple:
+    """Market params of the simulated market"""
+    return (
+        verbs.utils.hex_to_bytes(DAI),
+        verbs.utils.hex_to_bytes(WETH),
+        deployment["uniswap_aggregator"],
+        verbs.utils.hex_to_bytes(ADAPTIVE_CURVE_IRM),
+        lltv,
+    )
+
+
+def market_tag(deployment: typing.Dict[str, bytes], lltv: int) -> str:
+    """Id of the simulated market with a given LLTV, as a hex string"""
+    return "0x" + storage.morpho_market_id(get_market_params(deployment, lltv)).hex()
+
+
+def setup_market(
     env,
-    seed: int,
-    n_steps: int,
     n_borrow_agents: int,
-    sigma: float,
-    lltv: int,
-    init_cache: bool = False,
-):
+    lltv: typing.Union[int, typing.Sequence[int]],
+    fund_agents: bool = True,
+) -> typing.Dict[str, bytes]:
+    """
+    Bootstrap the Morpho Blue market and fund the agent accounts
+
+    Deploys the oracle and the snippets contracts, creates the market,
+    and creates the accounts of the agents of the simulation. If
+    ``fund_agents`` is ``True`` it then mints and approves the tokens of
+    every agent and supplies liquidity to the market with
+    :py:func:`fund_agents_transactions`. The resulting EVM state only
+    depends on the cache, the LLTV, the number of borrowers and the
+    contract bytecodes, so it can be snapshotted and reused across
+    simulation runs.
+
+    If ``lltv`` is a sequence, one market is created for each LLTV, all
+    sharing the same oracle, each with its own borrowers (see
+    :py:func:`borrower_addresses`) and liquidator.
+
+    Returns
+    -------
+    typing.Dict[str, bytes]
+        Addresses of the contracts deployed during the setup.
+    """
 
     # Convert addresses to bytes
     weth_address = verbs.utils.hex_to_bytes(WETH)
     dai_address = verbs.utils.hex_to_bytes(DAI)
-    dai_admin_address = verbs.utils.hex_to_bytes(DAI_ADMIN)
     morpho_blue_address = verbs.utils.hex_to_bytes(MORPHO_BLUE)
     adaptive_curve_irm_address = verbs.utils.hex_to_bytes(ADAPTIVE_CURVE_IRM)
     owner_address = verbs.utils.hex_to_bytes(OWNER)
-    swap_router_address = verbs.utils.hex_to_bytes(SWAP_ROUTER)
     uniswap_weth_dai_address = verbs.utils.hex_to_bytes(UNISWAP_WETH_DAI)
-    quoter_address = verbs.utils.hex_to_bytes(UNISWAP_QUOTER)
 
     # --------------------------------------------------
     # Morpho Blue
     # 1. Create Uniswap oracle
     # 2. Approve the LLTV
     # 3. Create a new market with ETH/DAI/LLTV/Oracle
-    # 4. Supply liquidity to the market
     # -------------------------------------------------
 
     owner = abi.morpho_blue.owner.call(env, ZERO_ADDRESS, morpho_blue_address, [])[0][0]
@@ -74,50 +404,112 @@ def runner(
         ],
     )
 
-    is_lltv_enabled = abi.morpho_blue.isLltvEnabled.call(
-        env, verbs.utils.hex_to_bytes(owner), morpho_blue_address, [lltv]
-    )[0][0]
-    if not is_lltv_enabled:
-        abi.morpho_blue.enableLltv.execute(
-            sender=owner_address, address=morpho_blue_address, env=env, args=[lltv]
-        )
-
     is_irm_enabled = abi.morpho_blue.isIrmEnabled.call(
         env, owner_address, morpho_blue_address, [adaptive_curve_irm_address]
     )
     assert is_irm_enabled, "IRM has to be enabled"
 
-    # Create market
-    market_params = (
-        dai_address,
-        weth_address,
-        uniswap_aggregator_address,
-        adaptive_curve_irm_address,
-        lltv,
+    lltvs = market_lltvs(lltv)
+    assert len(set(lltvs)) == len(lltvs), "LLTVs of the markets have to be distinct"
+    for market_lltv in lltvs:
+        is_lltv_enabled = abi.morpho_blue.isLltvEnabled.call(
+            env, verbs.utils.hex_to_bytes(owner), morpho_blue_address, [market_lltv]
+        )[0][0]
+        if not is_lltv_enabled:
+            abi.morpho_blue.enableLltv.execute(
+                sender=owner_address,
+                address=morpho_blue_address,
+                env=env,
+                args=[market_lltv],
+            )
+
+        # Create market
+        market_params = (
+            dai_address,
+            weth_address,
+            uniswap_aggregator_address,
+            adaptive_curve_irm_address,
+            market_lltv,
+        )
+
+        abi.morpho_blue.createMarket.execute(
+            sender=verbs.utils.hex_to_bytes(owner),
+            address=morpho_blue_address,
+            env=env,
+            args=[market_params],
+        )
+
+    # ---------------------------------
+    # Morpho Blue snippets https://github.com/morpho-org/morpho-blue-snippets/tree/main
+    # Contract with usefuf functions such as `userHealthFactor`
+    # ---------------------------------
+    with open(f"{PATH}/../abi/MorphoBlueSnippets.json", "r") as f:
+        morpho_blue_snippets_contract = json.load(f)
+
+    morpho_blue_snippets_address = abi.morpho_blue_snippets.constructor.deploy(
+        env,
+        ZERO_ADDRESS,
+        morpho_blue_snippets_contract["bytecode"],
+        [
+            morpho_blue_address,
+        ],
     )
 
-    abi.morpho_blue.createMarket.execute(
-        sender=verbs.utils.hex_to_bytes(owner),
-        address=morpho_blue_address,
-        env=env,
-        args=[market_params],
+    # ---------------------------------
+    # Agent accounts
+    # ---------------------------------
+    SupplyAgent(env, i=SUPPLIER_ID, eth=10**30)
+    for market in range(len(lltvs)):
+        for borrower_address in borrower_addresses(n_borrow_agents, market):
+            env.create_account(borrower_address, int(1e30))
+        env.create_account(verbs.utils.int_to_address(liquidator_id(market)), int(1e30))
+    env.create_account(verbs.utils.int_to_address(UNISWAP_AGENT_ID), int(1e25))
+
+    deployment = dict(
+        uniswap_aggregator=uniswap_aggregator_address,
+        morpho_blue_snippets=morpho_blue_snippets_address,
     )
 
+    if fund_agents:
+        fund_agents_transactions(
+            env, deployment, n_borrow_agents=n_borrow_agents, lltv=lltv
+        )
+
+    return deployment
+
+
+def fund_agents_transactions(
+    env,
+    deployment: typing.Dict[str, bytes],
+    n_borrow_agents: int,
+    lltv: typing.Union[int, typing.Sequence[int]],
+):
+    """
+    Mint and approve the tokens of the agents and supply liquidity
+    to the markets by executing transactions
+    """
+    weth_address = verbs.utils.hex_to_bytes(WETH)
+    dai_address = verbs.utils.hex_to_bytes(DAI)
+    dai_admin_address = verbs.utils.hex_to_bytes(DAI_ADMIN)
+    morpho_blue_address = verbs.utils.hex_to_bytes(MORPHO_BLUE)
+    swap_router_address = verbs.utils.hex_to_bytes(SWAP_ROUTER)
+    lltvs = market_lltvs(lltv)
+
     # ------------------------
     # Liquidity provider agent
     # -----------------------
-    supplier_agent = SupplyAgent(env, i=1, eth=10**30)
+    supplier_address = verbs.utils.int_to_address(SUPPLIER_ID)
 
     # mint and approve tokens for the supplier agent
     # - Mint DAI and WETH
-    # - Approve the Swap Router to use these in their transactions
+    # - Approve Morpho Blue to use these in their transactions
     mint_and_approve_weth(
         env=env,
         weth_abi=abi.weth_erc20,
         weth_address=weth_address,
-        recipient=supplier_agent.address,
+        recipient=supplier_address,
         contract_approved_address=morpho_blue_address,
-        amount=int(1e24),
+        amount=SUPPLIER_WETH,
     )
 
     mint_and_approve_dai(
@@ -125,82 +517,386 @@ def runner(
         dai_abi=abi.dai,
         dai_address=dai_address,
         dai_admin_address=dai_admin_address,
-        recipient=supplier_agent.address,
+        recipient=supplier_address,
         contract_approved_address=morpho_blue_address,
-        amount=int(1e30),
+        amount=SUPPLIER_DAI,
     )
 
-    # supplier supplies some DAI
-    abi.morpho_blue.supply.execute(
-        sender=supplier_agent.address,
-        address=morpho_blue_address,
+    # supplier supplies some DAI to each market
+    for market_lltv in lltvs:
+        abi.morpho_blue.supply.execute(
+            sender=supplier_address,
+            address=morpho_blue_address,
+            env=env,
+            args=[
+                get_market_params(deployment, market_lltv),
+                supplied_dai(n_borrow_agents),
+                0,
+                supplier_address,
+                b"",
+            ],
+        )
+
+    for market in range(len(lltvs)):
+        # ----------------
+        # Borrowers
+        # ----------------
+        # - Mint WETH
+        # - Approve Morpho Blue to use their collateral
+        for borrower_address in borrower_addresses(n_borrow_agents, market):
+            mint_and_approve_weth(
+                env=env,
+                weth_abi=abi.weth_erc20,
+                weth_address=weth_address,
+                contract_approved_address=morpho_blue_address,
+                recipient=borrower_address,
+                amount=BORROWER_WETH,
+            )
+
+        # ----------------
+        # Liquidation agent
+        # ----------------
+        # - Mint DAI and WETH
+        # - Approve Morpho Blue and Swap router to use their tokens
+        liquidator_address = verbs.utils.int_to_address(liquidator_id(market))
+        for contract_approved_address in [morpho_blue_address, swap_router_address]:
+            mint_and_approve_dai(
+                env=env,
+                dai_abi=abi.dai,
+                dai_address=dai_address,
+                contract_approved_address=contract_approved_address,
+                dai_admin_address=dai_admin_address,
+                recipient=liquidator_address,
+                amount=LIQUIDATOR_DAI,
+            )
+            mint_and_approve_weth(
+                env=env,
+                weth_abi=abi.weth_erc20,
+                weth_address=weth_address,
+                recipient=liquidator_address,
+                contract_approved_address=contract_approved_address,
+                amount=LIQUIDATOR_WETH,
+            )
+
+    # ---------------
+    # Uniswap agent
+    # ---------------
+    # - Mint DAI and WETH
+    # - Approve the Swap Router to use these in their transactions
+    uniswap_agent_address = verbs.utils.int_to_address(UNISWAP_AGENT_ID)
+    mint_and_approve_weth(
         env=env,
-        args=[
-            market_params,
-            10**25,
-            0,
-            supplier_agent.address,
-            b"",
-        ],
+        weth_abi=abi.weth_erc20,
+        weth_address=weth_address,
+        recipient=uniswap_agent_address,
+        contract_approved_address=swap_router_address,
+        amount=UNISWAP_AGENT_WETH,
+    )
+    mint_and_approve_dai(
+        env=env,
+        dai_abi=abi.dai,
+        dai_address=dai_address,
+        contract_approved_address=swap_router_address,
+        dai_admin_address=dai_admin_address,
+        recipient=uniswap_agent_address,
+        amount=UNISWAP_AGENT_DAI,
     )
 
-    # ---------------------------------
-    # Morpho Blue snippets https://github.com/morpho-org/morpho-blue-snippets/tree/main
-    # Contract with usefuf functions such as `userHealthFactor`
-    # ---------------------------------
-    with open(f"{PATH}/../abi/MorphoBlueSnippets.json", "r") as f:
-        morpho_blue_snippets_contract = json.load(f)
 
-    morpho_blue_snippets_address = abi.morpho_blue_snippets.constructor.deploy(
-        env,
-        ZERO_ADDRESS,
-        morpho_blue_snippets_contract["bytecode"],
-        [
+def fund_agents_storage(
+    state: storage.SnapshotState,
+    deployment: typing.Dict[str, bytes],
+    n_borrow_agents: int,
+    lltv: typing.Union[int, typing.Sequence[int]],
+):
+    """
+    Storage equivalent of :py:func:`fund_agents_transactions`
+
+    Writes the token balances and allowances of the agents and the
+    supplied liquidity directly into a snapshot of the environment.
+    """
+    weth_address = verbs.utils.hex_to_bytes(WETH)
+    dai_address = verbs.utils.hex_to_bytes(DAI)
+    morpho_blue_address = verbs.utils.hex_to_bytes(MORPHO_BLUE)
+    swap_router_address = verbs.utils.hex_to_bytes(SWAP_ROUTER)
+    supplier_address = verbs.utils.int_to_address(SUPPLIER_ID)
+    uniswap_agent_address = verbs.utils.int_to_address(UNISWAP_AGENT_ID)
+    lltvs = market_lltvs(lltv)
+
+    inject_weth(
+        state, weth_address, morpho_blue_address, [supplier_address], SUPPLIER_WETH
+    )
+    inject_dai(
+        state, dai_address, morpho_blue_address, [supplier_address], SUPPLIER_DAI
+    )
+    for market_lltv in lltvs:
+        inject_supply(
+            state,
             morpho_blue_address,
-        ],
+            get_market_params(deployment, market_lltv),
+            supplier_address,
+            supplied_dai(n_borrow_agents),
+        )
+
+    for market in range(len(lltvs)):
+        inject_weth(
+            state,
+            weth_address,
+            morpho_blue_address,
+            borrower_addresses(n_borrow_agents, market),
+            BORROWER_WETH,
+        )
+
+        liquidator_address = verbs.utils.int_to_address(liquidator_id(market))
+        for contract_approved_address in [morpho_blue_address, swap_router_address]:
+            inject_dai(
+                state,
+                dai_address,
+                contract_approved_address,
+                [liquidator_address],
+                LIQUIDATOR_DAI,
+            )
+            inject_weth(
+                state,
+                weth_address,
+                contract_approved_address,
+                [liquidator_address],
+                LIQUIDATOR_WETH,
+            )
+
+    inject_weth(
+        state,
+        weth_address,
+        swap_router_address,
+        [uniswap_agent_address],
+        UNISWAP_AGENT_WETH,
+    )
+    inject_dai(
+        state,
+        dai_address,
+        swap_router_address,
+        [uniswap_agent_address],
+        UNISWAP_AGENT_DAI,
     )
 
-    # ----------------
-    # Borrower
-    # ----------------
-    borrow_agent = [
-        BorrowAgent(
-            env=env,
-            i=100 + i,
-            morpho_blue_abi=abi.morpho_blue,
-            morpho_blue_snippets_abi=abi.morpho_blue_snippets,
-            morpho_blue_address=morpho_blue_address,
-            morpho_blue_snippets_address=morpho_blue_snippets_address,
-            mintable_erc20_abi=abi.weth_erc20,
-            oracle_abi=abi.uniswap_aggregator,
-            token_a_address=weth_address,
-            token_b_address=dai_address,
-            oracle_address=uniswap_aggregator_address,
-            irm_address=adaptive_curve_irm_address,
-            lltv=lltv,
-            activation_rate=0.8,
-            initial_ltv=0.75,
+
+def initial_positions(
+    env, deployment: typing.Dict[str, bytes], n_borrow_agents: int
+) -> typing.Tuple[typing.List[int], typing.List[int]]:
+    """
+    Collateral and borrowed assets of pre-opened borrower positions
+
+    Borrowers open their positions like :py:class:`BorrowAgent` does, at
+    ``u * BORROWER_INITIAL_LTV`` of the current oracle price, where ``u``
+    is spread evenly over ``[0.9, 1.0]`` across the borrowers.
+    """
+    price_collateral = (
+        abi.uniswap_aggregator.price.call(
+            env, ZERO_ADDRESS, deployment["uniswap_aggregator"], []
+        )[0][0]
+        / 10**36
+    )
+    collateral = [BORROWER_COLLATERAL * 10**18] * n_borrow_agents
+    borrow_assets = [
+        int(
+            u * price_collateral * BORROWER_COLLATERAL * BORROWER_INITIAL_LTV * 10**18
         )
-        for i in range(n_borrow_agents)
+        for u in np.linspace(0.9, 1.0, n_borrow_agents)
     ]
-    for i in range(n_borrow_agents):
-        mint_and_approve_weth(
+    return collateral, borrow_assets
+
+
+def open_positions_transactions(
+    env,
+    deployment: typing.Dict[str, bytes],
+    lltv: int,
+    collateral: typing.List[int],
+    borrow_assets: typing.List[int],
+    market: int = 0,
+):
+    """Open the borrower positions of a market by executing transactions"""
+    morpho_blue_address = verbs.utils.hex_to_bytes(MORPHO_BLUE)
+    market_params = get_market_params(deployment, lltv)
+
+    for borrower_address, collateral_assets, assets in zip(
+        borrower_addresses(len(collateral), market), collateral, borrow_assets
+    ):
+        abi.morpho_blue.supplyCollateral.execute(
+            sender=borrower_address,
+            address=morpho_blue_address,
+            env=env,
+            args=[market_params, collateral_assets, borrower_address, b""],
+        )
+        abi.morpho_blue.borrow.execute(
+            sender=borrower_address,
+            address=morpho_blue_address,
             env=env,
-            weth_abi=abi.weth_erc20,
-            weth_address=weth_address,
-            contract_approved_address=morpho_blue_address,
-            recipient=borrow_agent[i].address,
-            amount=int(1e24),
+            args=[market_params, assets, 0, borrower_address, borrower_address],
         )
 
+
+def open_positions_storage(
+    state: storage.SnapshotState,
+    deployment: typing.Dict[str, bytes],
+    lltv: int,
+    collateral: typing.List[int],
+    borrow_assets: typing.List[int],
+    market: int = 0,
+):
+    """Storage equivalent of :py:func:`open_positions_transactions`"""
+    inject_positions(
+        state,
+        verbs.utils.hex_to_bytes(MORPHO_BLUE),
+        get_market_params(deployment, lltv),
+        borrower_addresses(len(collateral), market),
+        collateral,
+        borrow_assets,
+    )
+
+
+def init_agents(
+    env,
+    deployment: typing.Dict[str, bytes],
+    n_steps: int,
+    n_borrow_agents: int,
+    sigma: float,
+    lltv: typing.Union[int, typing.Sequence[int]],
+    init_cache: bool = False,
+    open_positions: bool = False,
+    price_path: typing.Optional[np.ndarray] = None,
+    population: bool = False,
+    position_readers: typing.Optional[typing.Sequence[PositionReader]] = None,
+) -> typing.List:
+    """
+    Initialise the simulation agents on top of a market set up
+    with :py:func:`setup_market`. If ``open_positions`` is ``True``
+    the borrowers start with their positions already opened. If
+    ``price_path`` is provided the external market follows it (see
+    :py:func:`gbm_price_path`) instead of a Gbm. If ``population`` is
+    ``True`` the borrowers are simulated by a single
+    :py:class:`BorrowerPopulation` agent instead of one
+    :py:class:`BorrowAgent` each. If ``position_readers`` are provided
+    (e.g. market mirrors, one per market) agents read the borrower
+    positions from them.
+
+    Agents are the Uniswap agent, followed by the borrowers and the
+    liquidator of each market (see :py:func:`market_agents`).
+    """
+    lltvs = market_lltvs(lltv)
+    if position_readers is None:
+        position_readers = [None] * len(lltvs)
+
+    agents = list()
+    for market, (market_lltv, position_reader) in enumerate(
+        zip(lltvs, position_readers)
+    ):
+        agents.extend(
+            init_market_agents(
+                env,
+                deployment,
+                n_borrow_agents=n_borrow_agents,
+                lltv=market_lltv,
+                market=market,
+                open_positions=open_positions,
+                population=population,
+                position_reader=position_reader,
+            )
+        )
+    uniswap_agent = init_uniswap_agent(
+        env, n_steps=n_steps, sigma=sigma, init_cache=init_cache, price_path=price_path
+    )
+    return [uniswap_agent] + agents
+
+
+def market_agents(
+    agents: typing.List, n_markets: int
+) -> typing.List[typing.Tuple[typing.List, typing.List]]:
+    """
+    Borrowers and liquidator of each market
+
+    Parameters
+    ----------
+    agents: typing.List
+        Agents returned by :py:func:`init_agents`.
+    n_markets: int
+        Number of markets.
+
+    Returns
+    -------
+    typing.List[typing.Tuple[typing.List, typing.List]]
+        Borrower agents, and the liquidator (in a list), of each market.
+    """
+    size = (len(agents) - 1) // n_markets
+    groups = [agents[1 + k * size : 1 + (k + 1) * size] for k in range(n_markets)]
+    return [(group[:-1], group[-1:]) for group in groups]
+
+
+def init_market_agents(
+    env,
+    deployment: typing.Dict[str, bytes],
+    n_borrow_agents: int,
+    lltv: int,
+    market: int = 0,
+    open_positions: bool = False,
+    population: bool = False,
+    position_reader: typing.Optional[PositionReader] = None,
+) -> typing.List:
+    """Borrowers and liquidator of a market, see :py:func:`init_agents`"""
+
+    # Convert addresses to bytes
+    weth_address = verbs.utils.hex_to_bytes(WETH)
+    dai_address = verbs.utils.hex_to_bytes(DAI)
+    morpho_blue_address = verbs.utils.hex_to_bytes(MORPHO_BLUE)
+    adaptive_curve_irm_address = verbs.utils.hex_to_bytes(ADAPTIVE_CURVE_IRM)
+    swap_router_address = verbs.utils.hex_to_bytes(SWAP_ROUTER)
+    uniswap_weth_dai_address = verbs.utils.hex_to_bytes(UNISWAP_WETH_DAI)
+    quoter_address = verbs.utils.hex_to_bytes(UNISWAP_QUOTER)
+    uniswap_aggregator_address = deployment["uniswap_aggregator"]
+    morpho_blue_snippets_address = deployment["morpho_blue_snippets"]
+
     # ----------------
-    # Liquidation agent
+    # Borrower
     # ----------------
-    fee = 3000
+    borrower_kwargs = dict(
+        morpho_blue_abi=abi.morpho_blue,
+        morpho_blue_snippets_abi=abi.morpho_blue_snippets,
+        morpho_blue_address=morpho_blue_address,
+        morpho_blue_snippets_address=morpho_blue_snippets_address,
+        mintable_erc20_abi=abi.weth_erc20,
+        oracle_abi=abi.uniswap_aggregator,
+        token_a_address=weth_address,
+        token_b_address=dai_address,
+        oracle_address=uniswap_aggregator_address,
+        irm_address=adaptive_curve_irm_address,
+        lltv=lltv,
+        activation_rate=0.8,
+        initial_ltv=BORROWER_INITIAL_LTV,
+        collateral_amount=BORROWER_COLLATERAL,
+        has_position=open_positions,
+        position_reader=position_reader,
+    )
+    if population:
+        borrow_agent = [
+            BorrowerPopulation(
+                env=env,
+                addresses=borrower_addresses(n_borrow_agents, market),
+                **borrower_kwargs,
+            )
+        ]
+        borrow_address = borrow_agent[0].addresses
+    else:
+        borrow_agent = [
+            BorrowAgent(env=env, i=int(i), **borrower_kwargs)
+            for i in borrower_ids(n_borrow_agents, market)
+        ]
+        borrow_address = [agent.address for agent in borrow_agent]
 
+    # ----------------
+    # Liquidation agent
+    # ----------------
     liquidation_agent = LiquidationAgent(
         env=env,
-        i=1000,
+        i=liquidator_id(market),
         morpho_blue_abi=abi.morpho_blue,
         mintable_erc20_abi=abi.weth_erc20,
         oracle_abi=abi.uniswap_aggregator,
@@ -212,56 +908,34 @@ def runner(
         token_b_address=dai_address,
         irm_address=adaptive_curve_irm_address,
         lltv=lltv,
-        borrow_address=[agent.address for agent in borrow_agent],
+        borrow_address=borrow_address,
         quoter_address=quoter_address,
         quoter_abi=abi.quoter,
         swap_router_abi=abi.swap_router,
         swap_router_address=swap_router_address,
-        uniswap_fee=fee,
+        uniswap_fee=UNISWAP_FEE,
         uniswap_pool_abi=abi.uniswap_pool,
         uniswap_pool_address=uniswap_weth_dai_address,
         hf_threshold=0.99,
+        position_reader=position_reader,
     )
 
-    # mint and approve tokens for the liquidator agent
-    # - Mint DAI and WETH
-    # - Approve Morpho Blue and Swap router to use their tokens
-    mint_and_approve_dai(
-        env=env,
-        dai_abi=abi.dai,
-        dai_address=dai_address,
-        contract_approved_address=morpho_blue_address,
-        dai_admin_address=dai_admin_address,
-        recipient=liquidation_agent.address,
-        amount=int(5e29),
-    )
-    mint_and_approve_weth(
-        env=env,
-        weth_abi=abi.weth_erc20,
-        weth_address=weth_address,
-        recipient=liquidation_agent.address,
-        contract_approved_address=morpho_blue_address,
-        amount=int(5e29),
-    )
+    return borrow_agent + [liquidation_agent]
 
-    mint_and_approve_dai(
-        env=env,
-        dai_abi=abi.dai,
-        dai_address=dai_address,
-        contract_approved_address=swap_router_address,
-        dai_admin_address=dai_admin_address,
-        recipient=liquidation_agent.address,
-        amount=int(5e29),
-    )
 
-    mint_and_approve_weth(
-        env=env,
-        weth_abi=abi.weth_erc20,
-        weth_address=weth_address,
-        recipient=liquidation_agent.address,
-        contract_approved_address=swap_router_address,
-        amount=int(5e29),
-    )
+def init_uniswap_agent(
+    env,
+    n_steps: int,
+    sigma: float,
+    init_cache: bool = False,
+    price_path: typing.Optional[np.ndarray] = None,
+):
+    """External market agent, see :py:func:`init_agents`"""
+    swap_router_address = verbs.utils.hex_to_bytes(SWAP_ROUTER)
+    uniswap_weth_dai_address = verbs.utils.hex_to_bytes(UNISWAP_WETH_DAI)
+    quoter_address = verbs.utils.hex_to_bytes(UNISWAP_QUOTER)
+    weth_address = verbs.utils.hex_to_bytes(WETH)
+    dai_address = verbs.utils.hex_to_bytes(DAI)
 
     # ---------------
     # Uniswap agent
@@ -269,12 +943,13 @@ def runner(
     uniswap_agent_type = (
         partial(DummyUniswapAgent, sim_n_steps=n_steps) if init_cache else UniswapAgent
     )
+    uniswap_agent_kwargs = dict() if price_path is None else dict(price_path=price_path)
     uniswap_agent = uniswap_agent_type(
         env=env,
-        dt=0.01,
-        fee=fee,
-        i=10,
-        mu=0.0,
+        dt=GBM_DT,
+        fee=UNISWAP_FEE,
+        i=UNISWAP_AGENT_ID,
+        mu=GBM_MU,
         sigma=sigma,
         swap_router_abi=abi.swap_router,
         swap_router_address=swap_router_address,
@@ -284,37 +959,467 @@ def runner(
         token_b_address=dai_address,
         uniswap_pool_abi=abi.uniswap_pool,
         uniswap_pool_address=uniswap_weth_dai_address,
+        **uniswap_agent_kwargs,
     )
 
-    # mint and approve tokens for the Uniswap agent
-    # - Mint DAI and WETH
-    # - Approve the Swap Router to use these in their transactions
-    mint_and_approve_weth(
-        env=env,
-        weth_abi=abi.weth_erc20,
-        weth_address=weth_address,
-        recipient=uniswap_agent.address,
-        contract_approved_address=swap_router_address,
-        amount=int(1e24),
+    return uniswap_agent
+
+
+def runner(
+    env,
+    seed: int,
+    n_steps: int,
+    n_borrow_agents: int,
+    sigma: float,
+    lltv: typing.Union[int, typing.Sequence[int]],
+    init_cache: bool = False,
+    deployment: typing.Optional[typing.Dict[str, bytes]] = None,
+    open_positions: bool = False,
+    records_path: typing.Optional[str] = None,
+    record_policies: typing.Optional[typing.Dict[str, recorder.RecordPolicy]] = None,
+    cache_calls: bool = True,
+    price_path: typing.Optional[np.ndarray] = None,
+    population: bool = False,
+    mirror_market: bool = True,
+    summary: bool = False,
+):
+    """
+    Run the simulation
+
+    If ``deployment`` is provided, ``env`` is assumed to already
+    contain the market set up by :py:func:`setup_market` (e.g. it was
+    initialised from a setup snapshot) and the setup is skipped.
+    If ``open_positions`` is ``True`` borrowers start the simulation
+    with their positions already opened.
+
+    If ``records_path`` is provided, agent records are written to
+    typed columns in this directory as the simulation runs (see
+    :py:mod:`simulations.morpho_blue.recorder`) and the returned
+    results are the memory-mapped columns, otherwise the results are
+    the records returned by ``verbs.sim.Sim.run``. What is recorded
+    for the ``"uniswap"``, ``"borrowers"`` and ``"liquidator"`` groups
+    can be set with ``record_policies`` (see :py:func:`record_policies`).
+
+    If ``cache_calls`` is ``True`` the results of view calls are cached
+    and reused until the state changes, the returned environment is then
+    a :py:class:`simulations.utils.call_cache.CachedEnv` whose ``stats``
+    method reports the number of calls avoided.
+
+    If ``price_path`` is provided the external market follows this
+    pre-generated path (see :py:func:`gbm_price_path`).
+
+    If ``population`` is ``True`` the borrowers are simulated by a
+    single array-backed agent, which scales to large numbers of
+    borrowers, the ``"borrowers"`` records are unchanged.
+
+    If ``mirror_market`` is ``True`` the borrower positions are kept in a
+    local mirror of the market updated after each block (see
+    :py:class:`simulations.utils.market_mirror.MarketMirror`) read by the
+    agents instead of the EVM, and checked against the EVM every
+    ``MIRROR_CHECK_EVERY`` blocks.
+
+    If ``lltv`` is a sequence of LLTVs, one market is simulated for each
+    LLTV in the same EVM, with its own borrowers and liquidator, all
+    markets sharing the oracle and the external market. Results are then
+    a dictionary from the id of each market (see :py:func:`market_tag`)
+    to the results of this market, as for a single market (the records
+    of the Uniswap agent, borrowers and liquidator of the market). With
+    ``records_path`` the columns of each market are written to the
+    subdirectory named after its id.
+
+    If ``summary`` is ``True`` no records are kept, risk metrics are
+    aggregated as the simulation runs instead (see
+    :py:class:`simulations.morpho_blue.metrics.RiskAggregator`) and the
+    results are the summary of these metrics (of each market).
+    """
+    assert not (
+        summary and records_path is not None
+    ), "Summaries replace the records of the agents"
+    runner, deployment = init_sim(
+        env,
+        seed,
+        n_steps,
+        n_borrow_agents,
+        sigma,
+        lltv,
+        init_cache=init_cache,
+        deployment=deployment,
+        open_positions=open_positions,
+        cache_calls=cache_calls,
+        price_path=price_path,
+        population=population,
+        mirror_market=mirror_market,
     )
-    mint_and_approve_dai(
-        env=env,
-        dai_abi=abi.dai,
-        dai_address=dai_address,
-        contract_approved_address=swap_router_address,
-        dai_admin_address=dai_admin_address,
-        recipient=uniswap_agent.address,
-        amount=int(1e30),
+    recorders = init_recorders(
+        runner,
+        deployment,
+        lltv,
+        n_steps,
+        records_path=records_path,
+        record_policies=record_policies,
+        summary=summary,
     )
 
     # -------------
     # Run sim
     # -------------
-    agents = [uniswap_agent] + borrow_agent + [liquidation_agent]
-    runner = verbs.sim.Sim(seed, env, agents)
-    results = runner.run(n_steps=n_steps)
+    recorder.run(runner, n_steps=n_steps, recorder=recorders)
+    results = collect_results(
+        recorders, deployment, lltv, records_path=records_path, summary=summary
+    )
+
+    return runner.env, results
 
-    return env, results
+
+def init_sim(
+    env,
+    seed: int,
+    n_steps: int,
+    n_borrow_agents: int,
+    sigma: float,
+    lltv: typing.Union[int, typing.Sequence[int]],
+    init_cache: bool = False,
+    deployment: typing.Optional[typing.Dict[str, bytes]] = None,
+    open_positions: bool = False,
+    cache_calls: bool = True,
+    price_path: typing.Optional[np.ndarray] = None,
+    population: bool = False,
+    mirror_market: bool = True,
+) -> typing.Tuple[verbs.sim.Sim, typing.Dict[str, bytes]]:
+    """
+    Set up the markets and agents of a simulation without running it
+
+    Parameters are those of :py:func:`runner`.
+
+    Returns
+    -------
+    typing.Tuple[verbs.sim.Sim, typing.Dict[str, bytes]]
+        Simulation, with the environment wrapped as described in
+        :py:func:`runner`, and addresses of the contracts deployed
+        during the setup.
+    """
+    lltvs = market_lltvs(lltv)
+
+    if cache_calls:
+        env = CachedEnv(env, permanent_selectors=PERMANENT_SELECTORS)
+
+    if deployment is None:
+        deployment = setup_market(env, n_borrow_agents=n_borrow_agents, lltv=lltvs)
+        if open_positions:
+            collateral, borrow_assets = initial_positions(
+                env, deployment, n_borrow_agents
+            )
+            for market, market_lltv in enumerate(lltvs):
+                open_positions_transactions(
+                    env, deployment, market_lltv, collateral, borrow_assets, market
+                )
+
+    mirrors = None
+    if mirror_market:
+        mirrors = [
+            MarketMirror(
+                env,
+                sender=verbs.utils.int_to_address(liquidator_id(market)),
+                borrowers=borrower_addresses(n_borrow_agents, market),
+                morpho_blue_abi=abi.morpho_blue,
+                morpho_blue_snippets_abi=abi.morpho_blue_snippets,
+                oracle_abi=abi.uniswap_aggregator,
+                morpho_blue_address=verbs.utils.hex_to_bytes(MORPHO_BLUE),
+                morpho_blue_snippets_address=deployment["morpho_blue_snippets"],
+                market_params=get_market_params(deployment, market_lltv),
+                check_every=MIRROR_CHECK_EVERY,
+            )
+            for market, market_lltv in enumerate(lltvs)
+        ]
+        env = MirroredEnv(env, mirrors)
+
+    agents = init_agents(
+        env,
+        deployment,
+        n_steps=n_steps,
+        n_borrow_agents=n_borrow_agents,
+        sigma=sigma,
+        lltv=lltvs,
+        init_cache=init_cache,
+        open_positions=open_positions,
+        price_path=price_path,
+        population=population,
+        position_readers=mirrors,
+    )
+
+    return verbs.sim.Sim(seed, env, agents), deployment
+
+
+def init_recorders(
+    runner: verbs.sim.Sim,
+    deployment: typing.Dict[str, bytes],
+    lltv: typing.Union[int, typing.Sequence[int]],
+    n_steps: int,
+    records_path: typing.Optional[str] = None,
+    record_policies: typing.Optional[typing.Dict[str, recorder.RecordPolicy]] = None,
+    summary: bool = False,
+) -> typing.List:
+    """
+    Recorders of the results of a simulation
+
+    Parameters are those of :py:func:`runner`, ``runner`` being the
+    simulation returned by :py:func:`init_sim`.
+
+    Returns
+    -------
+    typing.List
+        Risk aggregators of each market if ``summary`` is ``True``,
+        columnar recorders of each market if ``records_path`` is
+        provided, otherwise a recorder of the records of all the agents,
+        to be run with :py:func:`simulations.morpho_blue.recorder.run`.
+    """
+    assert not (
+        summary and records_path is not None
+    ), "Summaries replace the records of the agents"
+    agents = runner.agents
+    lltvs = market_lltvs(lltv)
+    multi_market = not isinstance(lltv, (int, np.integer))
+    markets = market_agents(agents, len(lltvs))
+
+    if summary:
+        return [
+            metrics.RiskAggregator(
+                runner.env, liquidator[0], agents[0], abi.morpho_blue
+            )
+            for _, liquidator in markets
+        ]
+    if records_path is None:
+        return [recorder.ListRecorder(agents)]
+
+    tags = [market_tag(deployment, market_lltv) for market_lltv in lltvs]
+    paths = (
+        [os.path.join(records_path, tag) for tag in tags]
+        if multi_market
+        else [records_path]
+    )
+    return [
+        recorder.ColumnarRecorder(
+            path,
+            n_steps=n_steps,
+            groups=dict(uniswap=agents[:1], borrowers=borrowers, liquidator=liquidator),
+            policies=record_policies,
+        )
+        for path, (borrowers, liquidator) in zip(paths, markets)
+    ]
+
+
+def collect_results(
+    recorders: typing.List,
+    deployment: typing.Dict[str, bytes],
+    lltv: typing.Union[int, typing.Sequence[int]],
+    records_path: typing.Optional[str] = None,
+    summary: bool = False,
+):
+    """
+    Results of a simulation run with the recorders of
+    :py:func:`init_recorders`, as returned by :py:func:`runner`
+    """
+    multi_market = not isinstance(lltv, (int, np.integer))
+    tags = [market_tag(deployment, market_lltv) for market_lltv in market_lltvs(lltv)]
+
+    if summary:
+        results = [aggregator.summary() for aggregator in recorders]
+        return dict(zip(tags, results)) if multi_market else results[0]
+    if records_path is None:
+        results = recorders[0].records
+        return market_records(results, tags) if multi_market else results
+
+    if multi_market:
+        with open(os.path.join(records_path, MARKETS_FILE), "w") as f:
+            json.dump(tags, f)
+        return load_market_records(records_path)
+    return recorder.load_records(records_path)
+
+
+def env_seed(seed: int, step: int) -> int:
+    """Seed of the environment continuing a simulation from a step"""
+    return int(np.random.SeedSequence([seed, step]).generate_state(1)[0])
+
+
+def evm_env(runner: verbs.sim.Sim) -> typing.Tuple[typing.Any, typing.Any]:
+    """
+    EVM environment of a simulation and the object holding it, i.e. the
+    innermost wrapper of the environment or the simulation
+    """
+    holder, env = runner, runner.env
+    while isinstance(env, (MirroredEnv, CachedEnv)):
+        holder, env = env, env.env
+    return holder, env
+
+
+class EnvReseeder:
+    """
+    Continue a simulation on a new environment every ``every`` steps
+
+    The random stream ordering the transactions of each block is internal
+    to the EVM and cannot be saved. Checkpointed simulations on an empty
+    environment (see :py:mod:`simulations.morpho_blue.checkpoint`) are
+    then continued at their checkpoint steps on a new environment,
+    initialised from the snapshot of the EVM with a seed derived from the
+    simulation seed and the step, so that they can be resumed from any
+    checkpoint without changing their results.
+
+    Parameters
+    ----------
+    seed: int
+        Simulation seed.
+    n_steps: int
+        Number of steps of the simulation.
+    every: int
+        Number of steps between reseedings.
+    """
+
+    def __init__(self, seed: int, n_steps: int, every: int):
+        assert every > 0, "Reseedings have to be at least one step apart"
+        self.seed = seed
+        self.n_steps = n_steps
+        self.every = every
+
+    def update(self, runner: verbs.sim.Sim, step: int) -> typing.Optional[typing.Tuple]:
+        """
+        Reseed the environment of the simulation after ``step`` steps
+
+        Returns
+        -------
+        typing.Tuple, optional
+            Snapshot of the EVM the new environment was initialised from,
+            ``None`` if the environment was not reseeded at this step.
+        """
+        if step % self.every != 0 or step >= self.n_steps:
+            return None
+        holder, env = evm_env(runner)
+        if not isinstance(env, verbs.envs.EmptyEnv):
+            # Fork environments fetching their state from a remote node
+            return None
+        snapshot = env.export_snapshot()
+        holder.env = verbs.envs.EmptyEnv(env_seed(self.seed, step), snapshot=snapshot)
+        return snapshot
+
+
+def market_records(
+    records: typing.List[typing.List], tags: typing.Sequence[str]
+) -> typing.Dict[str, typing.List[typing.List]]:
+    """
+    Split the records of a multi-market simulation by market
+
+    Parameters
+    ----------
+    records: typing.List[typing.List]
+        Records returned by ``verbs.sim.Sim.run``.
+    tags: typing.Sequence[str]
+        Ids of the markets, see :py:func:`market_tag`.
+
+    Returns
+    -------
+    typing.Dict[str, typing.List[typing.List]]
+        Records of the Uniswap agent, borrowers and liquidator of each
+        market.
+    """
+    size = (len(records[0]) - 1) // len(tags)
+    return {
+        tag: [step[:1] + step[1 + k * size : 1 + (k + 1) * size] for step in records]
+        for k, tag in enumerate(tags)
+    }
+
+
+def load_market_records(records_path: str) -> typing.Dict[str, typing.Dict]:
+    """
+    Load the columns of each market of a multi-market run
+
+    Parameters
+    ----------
+    records_path: str
+        Records directory of the run, see :py:func:`runner`.
+
+    Returns
+    -------
+    typing.Dict[str, typing.Dict]
+        Columns of each market (see
+        :py:func:`simulations.morpho_blue.recorder.load_records`), by
+        market id in the order of the LLTVs of the run.
+    """
+    with open(os.path.join(records_path, MARKETS_FILE), "r") as f:
+        tags = json.load(f)
+    return {tag: recorder.load_records(os.path.join(records_path, tag)) for tag in tags}
+
+
+def gbm_price_path(
+    seed: int, sigma: float, n_steps: int, antithetic: bool = False
+) -> np.ndarray:
+    """
+    Pre-generated price path of the external market
+
+    Paths are generated with a random stream derived from ``seed``,
+    independent of the simulation random generator, and cached in the
+    current process, so simulations with the same seed and volatility
+    (e.g. for different LLTVs) share the same path.
+
+    Parameters
+    ----------
+    seed: int
+        Simulation seed.
+    sigma: float
+        Volatility of the external market.
+    n_steps: int
+        Number of steps of the simulation.
+    antithetic: bool, optional
+        If ``True`` returns the antithetic path of the path of the seed,
+        i.e. driven by the opposite innovations.
+
+    Returns
+    -------
+    np.ndarray
+        Price relative to the initial price at each step.
+    """
+    key = (seed, sigma, n_steps, antithetic)
+    if key not in _PRICE_PATHS:
+        rng = np.random.default_rng(np.random.SeedSequence(seed).spawn(1)[0])
+        _PRICE_PATHS[key] = gbm_paths(
+            rng,
+            mu=GBM_MU,
+            sigma=sigma,
+            dt=GBM_DT,
+            n_steps=n_steps,
+            antithetic=antithetic,
+        )[0]
+    return _PRICE_PATHS[key]
+
+
+def record_policies(
+    every: int = 1, max_health_factor: typing.Optional[float] = None
+) -> typing.Dict[str, recorder.RecordPolicy]:
+    """
+    Record policies of the simulation agents
+
+    Parameters
+    ----------
+    every: int, optional
+        Number of steps between records.
+    max_health_factor: float, optional
+        If provided, borrowers are only recorded when their health
+        factor is below this value, when they submit transactions or
+        after a liquidation.
+
+    Returns
+    -------
+    typing.Dict[str, recorder.RecordPolicy]
+        Policies of the agent groups recorded by :py:func:`runner`.
+    """
+    return dict(
+        uniswap=recorder.RecordPolicy(every=every),
+        borrowers=recorder.RecordPolicy(
+            every=every,
+            on_change=max_health_factor is not None,
+            change_selectors=(abi.morpho_blue.liquidate.selector,),
+            max_health_factor=max_health_factor,
+        ),
+        liquidator=recorder.RecordPolicy(every=every, on_change=True),
+    )
 
 
 def init_cache(
@@ -345,21 +1450,237 @@ def init_cache(
     cache = env.export_cache()
     with open(f"{PATH}/cache.json", "w") as f:
         json.dump(verbs.utils.cache_to_json(cache), f)
+    cache_to_binary(cache, f"{PATH}/cache.bin")
 
     return cache
 
 
+def snapshot_key(
+    block_number: int,
+    n_borrow_agents: int,
+    lltv: typing.Union[int, typing.Sequence[int]],
+    inject_state: bool = False,
+    open_positions: bool = False,
+) -> str:
+    """
+    Key identifying a setup snapshot
+
+    The key is given by the forked block, the market parameters, the
+    setup options and a hash of the bytecode of the contracts deployed
+    during the setup, of the cache file (see :py:func:`cache_path`) and
+    of the ids and amounts of the agents set up.
+    """
+    setup_hash = hashlib.sha256()
+    for contract in SETUP_CONTRACTS:
+        with open(f"{PATH}/../abi/{contract}", "r") as f:
+            setup_hash.update(json.load(f)["bytecode"].encode())
+    cache_file = cache_path()
+    if cache_file.exists():
+        setup_hash.update(file_hash(cache_file).encode())
+    setup_constants = dict(
+        supplier_id=SUPPLIER_ID,
+        uniswap_agent_id=UNISWAP_AGENT_ID,
+        borrower_id_offset=BORROWER_ID_OFFSET,
+        liquidator_id=LIQUIDATOR_ID,
+        liquidator_id_offset=LIQUIDATOR_ID_OFFSET,
+        supplier_weth=SUPPLIER_WETH,
+        supplier_dai=SUPPLIER_DAI,
+        supplied_dai=SUPPLIED_DAI,
+        supplied_dai_per_borrower=SUPPLIED_DAI_PER_BORROWER,
+        borrower_weth=BORROWER_WETH,
+        liquidator_weth=LIQUIDATOR_WETH,
+        liquidator_dai=LIQUIDATOR_DAI,
+        uniswap_agent_weth=UNISWAP_AGENT_WETH,
+        uniswap_agent_dai=UNISWAP_AGENT_DAI,
+        borrower_collateral=BORROWER_COLLATERAL,
+        borrower_initial_ltv=BORROWER_INITIAL_LTV,
+    )
+    setup_hash.update(json.dumps(setup_constants, sort_keys=True).encode())
+
+    key = "setup_{}_{}_{}_{}".format(
+        block_number,
+        "-".join(str(x) for x in market_lltvs(lltv)),
+        n_borrow_agents,
+        setup_hash.hexdigest()[:16],
+    )
+    if inject_state:
+        key += "_storage"
+    if open_positions:
+        key += "_open"
+    return key
+
+
+def init_snapshot(
+    cache: verbs.types.Cache,
+    n_borrow_agents: int,
+    lltv: typing.Union[int, typing.Sequence[int]],
+    inject_state: bool = False,
+    open_positions: bool = False,
+) -> typing.Tuple[typing.Tuple, typing.Dict[str, bytes]]:
+    """
+    Run the market setup on top of the cache and snapshot the EVM
+
+    If ``inject_state`` is ``True`` the agents are funded (and their
+    positions opened) by writing into the storage of the snapshot
+    instead of executing transactions.
+
+    Returns
+    -------
+    typing.Tuple[typing.Tuple, typing.Dict[str, bytes]]
+        EVM snapshot after the setup, and addresses of the contracts
+        deployed during the setup.
+    """
+    cache = extend_cache(cache, n_borrow_agents=n_borrow_agents, lltv=lltv)
+    env = verbs.envs.EmptyEnv(0, cache=cache)
+    deployment = setup_market(
+        env, n_borrow_agents=n_borrow_agents, lltv=lltv, fund_agents=not inject_state
+    )
+    if open_positions:
+        collateral, borrow_assets = initial_positions(env, deployment, n_borrow_agents)
+
+    if not inject_state:
+        if open_positions:
+            for market, market_lltv in enumerate(market_lltvs(lltv)):
+                open_positions_transactions(
+                    env, deployment, market_lltv, collateral, borrow_assets, market
+                )
+        return env.export_snapshot(), deployment
+
+    state = storage.SnapshotState(env.export_snapshot())
+    fund_agents_storage(state, deployment, n_borrow_agents=n_borrow_agents, lltv=lltv)
+    if open_positions:
+        for market, market_lltv in enumerate(market_lltvs(lltv)):
+            open_positions_storage(
+                state, deployment, market_lltv, collateral, borrow_assets, market
+            )
+
+    return state.export(), deployment
+
+
+def check_state_injection(
+    cache: verbs.types.Cache,
+    n_borrow_agents: int,
+    lltv: typing.Union[int, typing.Sequence[int]],
+    open_positions: bool = False,
+) -> typing.List[typing.Tuple[bytes, typing.Optional[int]]]:
+    """
+    Compare the setup state written into storage with the state
+    from executing the setup transactions on the same cache
+
+    Returns
+    -------
+    typing.List[typing.Tuple[bytes, typing.Optional[int]]]
+        Addresses and slots whose values differ, empty if the two setups
+        give the same storage and Eth balances.
+    """
+    states = [
+        storage.SnapshotState(
+            init_snapshot(
+                cache,
+                n_borrow_agents=n_borrow_agents,
+                lltv=lltv,
+                inject_state=inject_state,
+                open_positions=open_positions,
+            )[0]
+        )
+        for inject_state in [False, True]
+    ]
+    return states[0].diff(states[1])
+
+
+def load_snapshot(
+    cache: verbs.types.Cache,
+    n_borrow_agents: int,
+    lltv: typing.Union[int, typing.Sequence[int]],
+    inject_state: bool = False,
+    open_positions: bool = False,
+) -> typing.Tuple[typing.Tuple, typing.Dict[str, bytes]]:
+    """
+    Load the setup snapshot for the given parameters
+
+    Snapshots are kept in memory and saved to ``SNAPSHOT_PATH``. If no
+    snapshot exists for the given parameters, the setup is run once
+    and its snapshot is saved for later runs.
+    """
+    setup_options = dict(
+        n_borrow_agents=n_borrow_agents,
+        lltv=lltv,
+        inject_state=inject_state,
+        open_positions=open_positions,
+    )
+    key = snapshot_key(cache[1], **setup_options)
+
+    if key in _SNAPSHOTS:
+        return _SNAPSHOTS[key]
+
+    path = os.path.join(SNAPSHOT_PATH, f"{key}.pkl")
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            snapshot = pickle.load(f)
+    else:
+        snapshot = init_snapshot(cache, **setup_options)
+        os.makedirs(SNAPSHOT_PATH, exist_ok=True)
+        # Write to a temporary file first so concurrent runs never read
+        # a partially written snapshot
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    _SNAPSHOTS[key] = snapshot
+    return snapshot
+
+
 def run_from_cache(
-    seed: int, n_steps: int, n_borrow_agents: int, sigma: float, lltv: int
+    seed: int,
+    n_steps: int,
+    n_borrow_agents: int,
+    sigma: float,
+    lltv: typing.Union[int, typing.Sequence[int]],
+    use_snapshot: bool = True,
+    cache: typing.Optional[verbs.types.Cache] = None,
+    inject_state: bool = False,
+    open_positions: bool = False,
+    records_path: typing.Optional[str] = None,
+    record_policies: typing.Optional[typing.Dict[str, recorder.RecordPolicy]] = None,
+    price_path: typing.Optional[np.ndarray] = None,
+    population: bool = False,
+    summary: bool = False,
 ):
 
-    with open(f"{PATH}/cache.json", "r") as f:
-        cache_json = json.load(f)
+    assert use_snapshot or not inject_state, "State injection requires a snapshot"
 
-    cache = verbs.utils.cache_from_json(cache_json)
+    if cache is None:
+        cache = load_cache()
 
-    env = verbs.envs.EmptyEnv(seed, cache=cache)
+    if use_snapshot:
+        snapshot, deployment = load_snapshot(
+            cache,
+            n_borrow_agents=n_borrow_agents,
+            lltv=lltv,
+            inject_state=inject_state,
+            open_positions=open_positions,
+        )
+        env = verbs.envs.EmptyEnv(seed, snapshot=snapshot)
+    else:
+        deployment = None
+        cache = extend_cache(cache, n_borrow_agents=n_borrow_agents, lltv=lltv)
+        env = verbs.envs.EmptyEnv(seed, cache=cache)
 
-    _, results = runner(env, seed, n_steps, n_borrow_agents, sigma, lltv)
+    _, results = runner(
+        env,
+        seed,
+        n_steps,
+        n_borrow_agents,
+        sigma,
+        lltv,
+        deployment=deployment,
+        open_positions=open_positions,
+        records_path=records_path,
+        record_policies=record_policies,
+        price_path=price_path,
+        population=population,
+        summary=summary,
+    )
 
     return results
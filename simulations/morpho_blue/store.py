@@ -0,0 +1,272 @@
+"""
+Content-addressed store of simulation results
+
+Results of sweep jobs are stored under a key hashing everything they
+depend on: the fork cache, the contract bytecode, the source of the
+simulation code and the parameters of the job. Sweeps look jobs up
+before running them, so overlapping sweeps only run the new jobs and
+interrupted sweeps only run again the jobs that had not completed.
+
+The store is a directory holding an SQLite index of the runs
+(``index.sqlite``), queryable with :py:meth:`ResultStore.query` or any
+SQLite client, and the columns of the records of each run (see
+:py:mod:`simulations.morpho_blue.recorder`) in ``runs/<key>/``. Runs
+returning the summary of their risk metrics (see
+:py:mod:`simulations.morpho_blue.metrics`) only store the summary, in
+the index.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import typing
+from pathlib import Path
+
+import numpy as np
+
+from simulations.morpho_blue import recorder, sim
+
+DEFAULT_PATH = sim.PATH / "results" / "store"
+INDEX_FILE = "index.sqlite"
+RUNS_DIR = "runs"
+
+# Source files of the code the results depend on
+CODE_PATHS = (
+    sim.PATH.parent / "agents",
+    sim.PATH.parent / "utils",
+    sim.PATH,
+)
+ABI_PATH = sim.PATH.parent / "abi"
+
+
+def _files_hash(paths: typing.Iterable[Path], suffixes: typing.Sequence[str]) -> str:
+    digest = hashlib.sha256()
+    for path in paths:
+        files = sorted(path.rglob("*")) if path.is_dir() else [path]
+        for file in files:
+            if file.suffix in suffixes:
+                digest.update(file.name.encode())
+                digest.update(sim.file_hash(file).encode())
+    return digest.hexdigest()
+
+
+def environment_hashes() -> typing.Dict[str, str]:
+    """
+    Hashes of the fork cache, of the contract bytecode and ABIs, and of
+    the source of the simulation code
+    """
+    return dict(
+        cache=sim.file_hash(sim.cache_path()),
+        contracts=_files_hash([ABI_PATH], (".json", ".abi")),
+        code=_files_hash(CODE_PATHS, (".py",)),
+    )
+
+
+def _policies_params(
+    record_policies: typing.Optional[typing.Dict[str, recorder.RecordPolicy]]
+) -> typing.Optional[typing.Dict]:
+    if record_policies is None:
+        return None
+    return {
+        group: {
+            field: [v.hex() if isinstance(v, bytes) else v for v in value]
+            if isinstance(value, (list, tuple))
+            else value
+            for field, value in policy._asdict().items()
+        }
+        for group, policy in sorted(record_policies.items())
+    }
+
+
+def _to_json(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Cannot store {type(value)}")
+
+
+class ResultStore:
+    """
+    Store of the results of sweep jobs
+
+    Parameters
+    ----------
+    path: str, optional
+        Directory of the store, created if needed.
+    """
+
+    def __init__(self, path: typing.Union[str, Path] = DEFAULT_PATH):
+        self.path = Path(path)
+        os.makedirs(self.path / RUNS_DIR, exist_ok=True)
+        self.hashes = environment_hashes()
+        self.connection = sqlite3.connect(self.path / INDEX_FILE)
+        with self.connection:
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS runs (
+                    key TEXT PRIMARY KEY,
+                    created REAL,
+                    seed INTEGER,
+                    sigma REAL,
+                    lltv TEXT,
+                    n_borrow_agents INTEGER,
+                    n_steps INTEGER,
+                    params TEXT,
+                    hashes TEXT,
+                    summary TEXT,
+                    records TEXT
+                )
+                """
+            )
+
+    def key(
+        self,
+        job,
+        record_policies: typing.Optional[
+            typing.Dict[str, recorder.RecordPolicy]
+        ] = None,
+    ) -> str:
+        """
+        Key of the results of a job
+
+        Parameters
+        ----------
+        job: simulations.morpho_blue.sweep.Job
+            Sweep job.
+        record_policies: typing.Dict[str, recorder.RecordPolicy], optional
+            Record policies of the job, if it keeps records.
+        """
+        params = job._asdict()
+        if params["price_series"] is not None:
+            params["price_series"] = sim.file_hash(params["price_series"])
+        content = dict(
+            hashes=self.hashes,
+            params=params,
+            record_policies=None if job.summary else _policies_params(record_policies),
+        )
+        return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+    def records_path(self, key: str) -> str:
+        """Directory the columns of the records of a run are written to"""
+        return str(self.path / RUNS_DIR / key)
+
+    def get(self, key: str):
+        """
+        Stored results of a run, ``None`` if the run is not stored
+
+        Results are the summary of the risk metrics of the run or the
+        directory of the columns of its records, as returned by
+        :py:func:`simulations.morpho_blue.sweep.run_job`.
+        """
+        row = self.connection.execute(
+            "SELECT summary, records FROM runs WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        summary, records = row
+        if records is not None:
+            return str(self.path / records)
+        summary = json.loads(summary)
+        if "n_steps" not in summary:
+            # Summaries of the markets of a multi-market run
+            return {tag: _load_summary(s) for tag, s in summary.items()}
+        return _load_summary(summary)
+
+    def put(self, key: str, job, results):
+        """
+        Store the results of a run
+
+        Parameters
+        ----------
+        key: str
+            Key of the run, see :py:meth:`key`.
+        job: simulations.morpho_blue.sweep.Job
+            Job of the run.
+        results
+            Summary of the run, or directory of its records in the store
+            (see :py:meth:`records_path`).
+        """
+        summary, records = None, None
+        if job.summary:
+            summary = json.dumps(results, default=_to_json)
+        else:
+            records = os.path.relpath(results, self.path)
+        lltv = job.lltv if isinstance(job.lltv, tuple) else (job.lltv,)
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    time.time(),
+                    job.seed,
+                    job.sigma,
+                    "-".join(str(x) for x in lltv),
+                    job.n_borrow_agents,
+                    job.n_steps,
+                    json.dumps(job._asdict()),
+                    json.dumps(self.hashes),
+                    summary,
+                    records,
+                ),
+            )
+
+    def query(self, current: bool = True, **filters) -> typing.List[typing.Dict]:
+        """
+        Runs of the store
+
+        Parameters
+        ----------
+        current: bool, optional
+            Only return the runs of the current cache, contracts and
+            code.
+        **filters
+            Values of the ``seed``, ``sigma``, ``lltv``,
+            ``n_borrow_agents`` or ``n_steps`` of the returned runs.
+
+        Returns
+        -------
+        typing.List[typing.Dict]
+            Key, creation time, job parameters and results of each run,
+            oldest first.
+        """
+        columns = ("seed", "sigma", "lltv", "n_borrow_agents", "n_steps")
+        unknown = set(filters) - set(columns)
+        if unknown:
+            raise ValueError(f"Unknown filters {sorted(unknown)}")
+        conditions, values = list(), list()
+        for column, value in filters.items():
+            if column == "lltv":
+                value = "-".join(
+                    str(x) for x in (value if isinstance(value, tuple) else (value,))
+                )
+            conditions.append(f"{column} = ?")
+            values.append(value)
+        if current:
+            conditions.append("hashes = ?")
+            values.append(json.dumps(self.hashes))
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = self.connection.execute(
+            f"SELECT key, created, params FROM runs {where} ORDER BY created", values
+        ).fetchall()
+        return [
+            dict(
+                key=key,
+                created=created,
+                params=json.loads(params),
+                results=self.get(key),
+            )
+            for key, created, params in rows
+        ]
+
+    def close(self):
+        self.connection.close()
+
+
+def _load_summary(summary: typing.Dict) -> typing.Dict:
+    # Lists of the summary are histograms stored as JSON arrays
+    return {
+        name: np.array(value) if isinstance(value, list) else value
+        for name, value in summary.items()
+    }
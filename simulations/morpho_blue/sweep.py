@@ -0,0 +1,293 @@
+"""
+Parallel scenario sweeps
+
+Runs the simulation over a grid of seeds, volatilities, LLTVs and
+numbers of borrowers, spreading the runs over a pool of worker
+processes. Each worker loads the fork cache once and reuses it (and
+the setup snapshots it loads) for all the jobs it is given.
+"""
+import itertools
+import os
+import typing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+
+import numpy as np
+
+from simulations.morpho_blue import recorder, sim
+from simulations.morpho_blue.store import ResultStore
+from simulations.utils.price_series import PriceReplay, load_prices
+
+# Fork cache loaded once by each worker process
+_CACHE = None
+
+
+class Job(typing.NamedTuple):
+    seed: int
+    sigma: float
+    # LLTV of the market, or LLTVs of the markets simulated together
+    lltv: typing.Union[int, typing.Tuple[int, ...]]
+    n_borrow_agents: int
+    n_steps: int
+    inject_state: bool = False
+    open_positions: bool = False
+    # Simulate the borrowers with a single population agent
+    population: bool = False
+    pregenerate_path: bool = False
+    # Follow the antithetic path of the pre-generated path of the seed
+    antithetic: bool = False
+    # Window of a historical price series replayed by the external market
+    price_series: typing.Optional[str] = None
+    price_window: typing.Optional[typing.Tuple[int, int]] = None
+    price_every: int = 1
+    # Return the summary of the risk metrics instead of the records
+    summary: bool = False
+
+
+def derive_seeds(base_seed: int, n_seeds: int) -> typing.List[int]:
+    """
+    Derive independent simulation seeds from a single base seed
+
+    Seeds only depend on ``base_seed`` and their position, so a sweep is
+    reproducible for any number of workers.
+    """
+    seed_sequences = np.random.SeedSequence(base_seed).spawn(n_seeds)
+    return [int(s.generate_state(1)[0]) for s in seed_sequences]
+
+
+def make_grid(
+    seeds: typing.Sequence[int],
+    sigmas: typing.Sequence[float],
+    lltvs: typing.Sequence[int],
+    n_borrow_agents: typing.Sequence[int],
+    n_steps: int,
+    inject_state: bool = False,
+    open_positions: bool = False,
+    population: bool = False,
+    pregenerate_path: bool = False,
+    price_series: typing.Optional[str] = None,
+    price_windows: typing.Optional[typing.Sequence[typing.Tuple[int, int]]] = None,
+    price_every: int = 1,
+    multi_market: bool = False,
+    common_random_numbers: bool = True,
+    antithetic: bool = False,
+    summary: bool = False,
+) -> typing.List[Job]:
+    """
+    Cartesian product of the sweep parameters
+
+    If ``price_series`` is provided, the external market replays each of
+    the ``price_windows`` of this series (see
+    :py:func:`simulations.utils.price_series.replay_windows`). If
+    ``multi_market`` is ``True`` all the ``lltvs`` are simulated as
+    markets of the same run instead of separate runs.
+
+    With ``common_random_numbers`` the runs of all the LLTVs use the same
+    seeds, i.e. the same external market innovations and borrower
+    activation draws, so differences between LLTVs are estimated with a
+    lower variance. Otherwise independent seeds are derived for each
+    LLTV. With ``antithetic`` each seed is also run on the antithetic
+    path of its pre-generated path (see
+    :py:func:`simulations.morpho_blue.sim.gbm_price_path`), the two runs
+    being consecutive jobs. With ``summary`` runs only return the
+    summary of their risk metrics (see
+    :py:mod:`simulations.morpho_blue.metrics`).
+    """
+    assert not antithetic or (
+        pregenerate_path and price_series is None
+    ), "Antithetic runs require pre-generated Gbm paths"
+    if price_windows is None:
+        price_windows = [None]
+    if multi_market:
+        lltvs = [tuple(lltvs)]
+    jobs = list()
+    for n, (k, lltv), sigma, price_window, seed in itertools.product(
+        n_borrow_agents, enumerate(lltvs), sigmas, price_windows, seeds
+    ):
+        if not common_random_numbers:
+            seed = int(np.random.SeedSequence([seed, k]).generate_state(1)[0])
+        jobs.extend(
+            Job(
+                seed=seed,
+                sigma=sigma,
+                lltv=lltv,
+                n_borrow_agents=n,
+                n_steps=n_steps,
+                inject_state=inject_state,
+                open_positions=open_positions,
+                population=population,
+                pregenerate_path=pregenerate_path,
+                antithetic=path_antithetic,
+                price_series=price_series,
+                price_window=price_window,
+                price_every=price_every,
+                summary=summary,
+            )
+            for path_antithetic in ([False, True] if antithetic else [False])
+        )
+    return jobs
+
+
+def _init_worker():
+    global _CACHE
+    _CACHE = sim.load_cache()
+
+
+def job_price_path(job: Job) -> typing.Optional[typing.Sequence[float]]:
+    """Price path followed by the external market of a job, if any"""
+    if job.price_series is not None:
+        start, end = job.price_window or (0, None)
+        return PriceReplay(
+            load_prices(job.price_series), start=start, end=end, every=job.price_every
+        )
+    if job.pregenerate_path:
+        return sim.gbm_price_path(
+            job.seed, job.sigma, job.n_steps, antithetic=job.antithetic
+        )
+    return None
+
+
+def run_job(
+    job: Job,
+    records_path: typing.Optional[str] = None,
+    record_policies: typing.Optional[typing.Dict[str, recorder.RecordPolicy]] = None,
+) -> typing.Union[typing.List[typing.List], str]:
+    """
+    Run a single simulation of the sweep in the current process
+
+    If ``records_path`` is provided the records are written to this
+    directory by the columnar recorder, following ``record_policies``,
+    and the path is returned.
+    """
+    if _CACHE is None:
+        _init_worker()
+
+    price_path = job_price_path(job)
+
+    records = sim.run_from_cache(
+        seed=job.seed,
+        n_steps=job.n_steps,
+        n_borrow_agents=job.n_borrow_agents,
+        sigma=job.sigma,
+        lltv=job.lltv,
+        cache=_CACHE,
+        inject_state=job.inject_state,
+        open_positions=job.open_positions,
+        population=job.population,
+        records_path=records_path,
+        record_policies=record_policies,
+        price_path=price_path,
+        summary=job.summary,
+    )
+
+    return records if records_path is None else records_path
+
+
+def _run_chunk(
+    job_runner: typing.Callable,
+    jobs: typing.List[Job],
+    records_paths: typing.List[typing.Optional[str]],
+) -> typing.List:
+    # Run a chunk of jobs in a worker process
+    return [job_runner(job, path) for job, path in zip(jobs, records_paths)]
+
+
+def run_sweep(
+    jobs: typing.List[Job],
+    n_workers: typing.Optional[int] = None,
+    chunksize: typing.Optional[int] = None,
+    records_path: typing.Optional[str] = None,
+    record_policies: typing.Optional[typing.Dict[str, recorder.RecordPolicy]] = None,
+    store: typing.Optional[ResultStore] = None,
+) -> typing.List[typing.Dict]:
+    """
+    Run a list of simulation jobs over a pool of worker processes
+
+    Parameters
+    ----------
+    jobs: typing.List[Job]
+        Simulations to run, e.g. generated with :py:func:`make_grid`.
+    n_workers: int, optional
+        Number of worker processes, defaults to the number of CPUs. With
+        a single worker jobs are run in the current process.
+    chunksize: int, optional
+        Number of jobs sent to a worker at once, their results are
+        returned (and stored) once the whole chunk completes. Defaults to
+        splitting the jobs into roughly four chunks per worker.
+    records_path: str, optional
+        If provided, the records of each job are written by the columnar
+        recorder to the directory ``<records_path>/<job index>`` instead
+        of being returned.
+    record_policies: typing.Dict[str, recorder.RecordPolicy], optional
+        Record policies of the agent groups used with ``records_path``,
+        see :py:func:`simulations.morpho_blue.sim.record_policies`.
+    store: simulations.morpho_blue.store.ResultStore, optional
+        Store of results. Jobs already in the store are not run, and the
+        results of the other jobs are stored as their chunks complete, in
+        any order (records being written to the store), so an interrupted
+        sweep only runs again the jobs of the chunks that did not
+        complete.
+
+    Returns
+    -------
+    typing.List[typing.Dict]
+        One entry per job, in the same order as ``jobs``, containing the
+        job ``"params"`` and the simulation ``"records"`` (or the
+        directory of the records if ``records_path`` is provided).
+    """
+    assert (
+        store is None or records_path is None
+    ), "Records of stored runs are written to the store"
+    if store is None:
+        keys = [None] * len(jobs)
+        records = [None] * len(jobs)
+    else:
+        keys = [store.key(job, record_policies) for job in jobs]
+        records = [store.get(key) for key in keys]
+    pending = [i for i, r in enumerate(records) if r is None]
+
+    if store is not None:
+        job_records_paths = [
+            None if jobs[i].summary else store.records_path(keys[i]) for i in pending
+        ]
+    elif records_path is None:
+        job_records_paths = [None] * len(pending)
+    else:
+        job_records_paths = [os.path.join(records_path, f"{i:06d}") for i in pending]
+
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    n_workers = max(1, min(n_workers, len(pending)))
+
+    def complete(indices, results):
+        for i, r in zip(indices, results):
+            if store is not None:
+                store.put(keys[i], jobs[i], r)
+            records[i] = r
+
+    job_runner = partial(run_job, record_policies=record_policies)
+    if n_workers == 1:
+        for i, path in zip(pending, job_records_paths):
+            complete([i], [job_runner(jobs[i], path)])
+    else:
+        if chunksize is None:
+            chunksize = max(1, len(pending) // (4 * n_workers))
+        with ProcessPoolExecutor(
+            max_workers=n_workers, initializer=_init_worker
+        ) as executor:
+            futures = dict()
+            for k in range(0, len(pending), chunksize):
+                indices = pending[k : k + chunksize]
+                future = executor.submit(
+                    _run_chunk,
+                    job_runner,
+                    [jobs[i] for i in indices],
+                    job_records_paths[k : k + chunksize],
+                )
+                futures[future] = indices
+            # Results are stored as the chunks complete, and kept in the
+            # order of the jobs
+            for future in as_completed(futures):
+                complete(futures[future], future.result())
+
+    return [dict(params=job._asdict(), records=r) for job, r in zip(jobs, records)]
@@ -0,0 +1,144 @@
+"""
+Binary fork cache format
+
+Compact alternative to the JSON cache exported with
+``verbs.utils.cache_to_json``. Values are stored as raw bytes in fixed
+size records, so the file is decoded with ``struct`` without any hex or
+JSON parsing. The layout is
+
+* Header: magic, timestamp, block number, number of accounts, number of
+  storage slots and size of the code section.
+* Account records: address, balance, nonce, code hash and offset and
+  length of the account code in the code section.
+* Storage records: contract address, slot and value.
+* Code section: contract bytecodes.
+
+All integers of the layout are little-endian.
+"""
+import argparse
+import json
+import mmap
+import struct
+
+import verbs
+
+MAGIC = b"VERBSC01"
+HEADER = struct.Struct("<8sQQIIQ")
+# address, balance, nonce, code hash, code offset, code length
+ACCOUNT = struct.Struct("<20s32sQ32sQQ")
+# address, slot, value
+STORAGE = struct.Struct("<20s32s32s")
+
+
+def cache_to_binary(cache: verbs.types.Cache, path: str):
+    """
+    Write a cache to the binary format
+
+    Parameters
+    ----------
+    cache: verbs.types.Cache
+        Cache generated using ``ForkEnv.export_cache``.
+    path: str
+        Path of the binary cache file.
+    """
+    timestamp, block_number, accounts, storage = cache
+
+    code = bytearray()
+    account_records = bytearray()
+    for address, (balance, nonce, code_hash, account_code) in accounts:
+        account_records += ACCOUNT.pack(
+            address, balance, nonce, code_hash, len(code), len(account_code)
+        )
+        code += account_code
+
+    storage_records = bytearray()
+    for address, slot, value in storage:
+        storage_records += STORAGE.pack(address, slot, value)
+
+    with open(path, "wb") as f:
+        f.write(
+            HEADER.pack(
+                MAGIC, timestamp, block_number, len(accounts), len(storage), len(code)
+            )
+        )
+        f.write(account_records)
+        f.write(storage_records)
+        f.write(code)
+
+
+def cache_from_binary(path: str) -> verbs.types.Cache:
+    """
+    Read a cache from the binary format
+
+    The file is memory-mapped while it is decoded, the returned cache
+    holds copies of the values and each process reading the cache keeps
+    its own copy.
+
+    Parameters
+    ----------
+    path: str
+        Path of the binary cache file.
+
+    Returns
+    -------
+    verbs.types.Cache
+        Cache in the format required to initialise a simulation environment.
+    """
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            (
+                magic,
+                timestamp,
+                block_number,
+                n_accounts,
+                n_storage,
+                _code_size,
+            ) = HEADER.unpack_from(buffer, 0)
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not a binary cache file")
+
+            accounts_offset = HEADER.size
+            storage_offset = accounts_offset + n_accounts * ACCOUNT.size
+            code_offset = storage_offset + n_storage * STORAGE.size
+
+            accounts = list()
+            for (
+                address,
+                balance,
+                nonce,
+                code_hash,
+                offset,
+                length,
+            ) in ACCOUNT.iter_unpack(buffer[accounts_offset:storage_offset]):
+                start = code_offset + offset
+                accounts.append(
+                    (
+                        address,
+                        (balance, nonce, code_hash, buffer[start : start + length]),
+                    )
+                )
+
+            storage = list(STORAGE.iter_unpack(buffer[storage_offset:code_offset]))
+
+    return (timestamp, block_number, accounts, storage)
+
+
+def convert_json_cache(json_path: str, path: str):
+    """
+    Convert a JSON cache (written with ``verbs.utils.cache_to_json``)
+    to the binary format
+    """
+    with open(json_path, "r") as f:
+        cache_json = json.load(f)
+
+    cache_to_binary(verbs.utils.cache_from_json(cache_json), path)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(prog="Convert a JSON cache to the binary format")
+    parser.add_argument("json_path", type=str, help="Path of the JSON cache")
+    parser.add_argument("path", type=str, help="Path of the binary cache")
+    args = parser.parse_args()
+
+    convert_json_cache(args.json_path, args.path)
@@ -0,0 +1,127 @@
+"""
+Memoization of read-only calls to a simulation environment
+
+Agents make many identical view calls within a step (e.g. every
+borrower reads the oracle price both when updating and when being
+recorded). The contract state only changes when a block is processed
+or a transaction is executed directly, so between these, call results
+can be reused by all the agents. Results of calls to functions of
+immutable values (e.g. token decimals) are kept for the whole
+simulation.
+"""
+import typing
+
+import numpy as np
+
+
+class CachedEnv:
+    """
+    Simulation environment wrapper memoizing call results
+
+    Results of ``env.call`` are cached by contract address, calldata
+    (i.e. function selector and arguments) and value, and shared between
+    senders, so should only be used for calls whose results do not
+    depend on the caller. The cache is cleared when the state of the
+    environment changes, i.e. when a block is processed, a transaction
+    executed, a contract deployed or an account created.
+
+    Since it wraps ``env.call``, all the ``call`` methods of the
+    ``verbs.abi`` functions use the cache. Other attributes are those
+    of the wrapped environment.
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+       env = CachedEnv(
+           verbs.envs.EmptyEnv(seed, snapshot=snapshot),
+           permanent_selectors=[abi.weth_erc20.decimals.selector],
+       )
+       sim = verbs.sim.Sim(seed, env, agents)
+
+    Parameters
+    ----------
+    env
+        Simulation environment.
+    permanent_selectors: typing.Iterable[bytes], optional
+        Selectors of the functions returning immutable values, their
+        results are never cleared from the cache.
+    """
+
+    def __init__(self, env, permanent_selectors: typing.Iterable[bytes] = ()):
+        self.env = env
+        self.permanent_selectors = set(permanent_selectors)
+        self.cache = dict()
+        self.permanent_cache = dict()
+
+        self.hits = 0
+        self.permanent_hits = 0
+        self.misses = 0
+        # Calls avoided at each step
+        self.step_hits = [0]
+
+    def __getattr__(self, name: str):
+        return getattr(self.env, name)
+
+    def call(self, sender: bytes, address: bytes, encoded_args: bytes, value: int):
+        """Call a contract, returning the cached result if available"""
+        key = (address, encoded_args, value)
+        permanent = encoded_args[:4] in self.permanent_selectors
+        cache = self.permanent_cache if permanent else self.cache
+
+        result = cache.get(key)
+        if result is None:
+            self.misses += 1
+            result = self.env.call(sender, address, encoded_args, value)
+            cache[key] = result
+        else:
+            self.hits += 1
+            self.permanent_hits += permanent
+            self.step_hits[-1] += 1
+
+        return result
+
+    def clear(self):
+        """Clear the results of the calls to mutable values"""
+        self.cache = dict()
+
+    def execute(self, *args):
+        result = self.env.execute(*args)
+        self.clear()
+        return result
+
+    def deploy_contract(self, *args):
+        address = self.env.deploy_contract(*args)
+        self.clear()
+        return address
+
+    def create_account(self, *args):
+        self.env.create_account(*args)
+        self.clear()
+
+    def process_block(self):
+        self.env.process_block()
+        self.clear()
+        self.step_hits.append(0)
+
+    def stats(self) -> typing.Dict[str, float]:
+        """
+        Cache statistics
+
+        Returns
+        -------
+        typing.Dict[str, float]
+            Number of calls made to the environment (``"misses"``), number
+            of calls avoided (``"hits"``, of which ``"permanent_hits"``
+            from immutable values), hit rate and mean number of calls
+            avoided per step.
+        """
+        n_calls = self.hits + self.misses
+        return dict(
+            hits=self.hits,
+            permanent_hits=self.permanent_hits,
+            misses=self.misses,
+            hit_rate=self.hits / n_calls if n_calls else 0.0,
+            hits_per_step=float(np.mean(self.step_hits)),
+        )
@@ -0,0 +1,273 @@
+"""
+Calldata templates and fixed-layout decoders
+
+Agents call the same functions at each step with mostly the same
+arguments (e.g. the market params, the addresses of the tokens), which
+``verbs.abi`` encodes and decodes again through eth_abi every time.
+Instead a :py:class:`CalldataTemplate` encodes the selector and the
+constant arguments once, the arguments changing between calls (amounts,
+borrower addresses) being left as placeholders whose 32-byte words are
+patched into a reusable buffer. Calls and transactions built from a
+template are identical to the ones of ``verbs.abi``.
+
+Results and events made of static values only (e.g. ``slot0``,
+``position`` or the ``Liquidate`` event) are decoded by a
+:py:class:`StaticDecoder`, reading each value directly from its word.
+
+.. code-block:: python
+
+   borrow = CalldataTemplate(
+       abi.morpho_blue.borrow, [market_params, UINT, 0, ADDRESS, ADDRESS]
+   )
+   tx = borrow.transaction(sender, morpho_address, amount, borrower, borrower)
+"""
+import typing
+
+from eth_abi.exceptions import ValueOutOfBounds
+
+WORD = 32
+
+
+class Placeholder(typing.NamedTuple):
+    """Argument of a template set at each call"""
+
+    # Value encoded in the template, and value locating its word
+    zero: typing.Any
+    probe: typing.Any
+
+
+# ``uint256`` and ``address`` arguments
+UINT = Placeholder(0, 1)
+ADDRESS = Placeholder(bytes(20), bytes(19) + b"\x01")
+
+
+def _fill(args, probe: typing.Optional[int], counter: typing.List[int]):
+    # Replace the placeholders of (nested) arguments by their zero value,
+    # and the placeholder number ``probe`` by its probe value
+    if isinstance(args, Placeholder):
+        counter[0] += 1
+        return args.probe if counter[0] - 1 == probe else args.zero
+    if isinstance(args, (list, tuple)):
+        return type(args)(_fill(arg, probe, counter) for arg in args)
+    return args
+
+
+def _count(args) -> int:
+    if isinstance(args, Placeholder):
+        return 1
+    if isinstance(args, (list, tuple)):
+        return sum(_count(arg) for arg in args)
+    return 0
+
+
+class CalldataTemplate:
+    """
+    Calldata of a function with constant and variable arguments
+
+    Parameters
+    ----------
+    function: verbs.abi.Function
+        Function called.
+    args: typing.List
+        Arguments of the function, with :py:data:`UINT` or
+        :py:data:`ADDRESS` placeholders (possibly inside tuples) for the
+        arguments given at each call, in order. Placeholders have to be
+        encoded in a single word at a position not depending on their
+        value, i.e. static values.
+    """
+
+    def __init__(self, function, args: typing.List):
+        self.function = function
+        self.calldata = function.encode(_fill(args, None, [0]))
+        self.buffer = bytearray(self.calldata)
+        # Offsets of the words of the placeholders in the calldata
+        self.offsets = list()
+        for k in range(_count(args)):
+            probe = function.encode(_fill(args, k, [0]))
+            assert len(probe) == len(self.calldata), "Placeholders have to be static"
+            calldata = self.calldata
+            changed = [
+                offset
+                for offset in range(4, len(probe), WORD)
+                if probe[offset : offset + WORD] != calldata[offset : offset + WORD]
+            ]
+            assert len(changed) == 1, "Placeholders have to be encoded in one word"
+            self.offsets.append(changed[0])
+        self.decoder = StaticDecoder.for_types(function.outputs)
+
+    def encode(self, *values) -> bytes:
+        """
+        Calldata of the function, selector included
+
+        Parameters
+        ----------
+        *values
+            Values of the placeholders, integers or addresses.
+
+        Raises
+        ------
+        ValueOutOfBounds
+            If an integer is negative or does not fit in a word, as
+            raised by eth_abi.
+        """
+        if not values:
+            return self.calldata
+        assert len(values) == len(self.offsets), "Wrong number of arguments"
+        buffer = self.buffer
+        for offset, value in zip(self.offsets, values):
+            if isinstance(value, bytes):
+                buffer[offset : offset + WORD] = value.rjust(WORD, b"\x00")
+            else:
+                try:
+                    buffer[offset : offset + WORD] = int(value).to_bytes(WORD, "big")
+                except OverflowError:
+                    raise ValueOutOfBounds(f"{value} is not a uint256")
+        return bytes(buffer)
+
+    def decode(self, output: bytes) -> typing.Tuple:
+        """Decode the values returned by the function"""
+        if self.decoder is None:
+            return self.function.decode(output)
+        return self.decoder.decode(output)
+
+    def transaction(
+        self,
+        sender: bytes,
+        address: bytes,
+        *values,
+        value: int = 0,
+        checked: bool = True,
+    ) -> typing.Tuple:
+        """
+        Transaction calling the function, as returned by
+        ``verbs.abi.Function.transaction``
+        """
+        return (sender, address, self.encode(*values), value, checked)
+
+    def call(self, env, sender: bytes, address: bytes, *values) -> typing.Tuple:
+        """
+        Call the function without committing changes, as
+        ``verbs.abi.Function.call``
+        """
+        result, logs, gas = env.call(sender, address, self.encode(*values), 0)
+        return self.decode(result), logs, gas
+
+
+def _decode_uint(word: bytes):
+    return int.from_bytes(word, "big")
+
+
+def _decode_int(word: bytes):
+    return int.from_bytes(word, "big", signed=True)
+
+
+def _decode_bool(word: bytes):
+    return word[-1] != 0
+
+
+def _decode_address(word: bytes):
+    # Lowercase hex string, as eth_abi
+    return "0x" + word[12:].hex()
+
+
+def _value_decoder(abi_type: str) -> typing.Optional[typing.Callable]:
+    if abi_type.startswith("uint"):
+        return _decode_uint
+    if abi_type.startswith("int"):
+        return _decode_int
+    if abi_type == "bool":
+        return _decode_bool
+    if abi_type == "address":
+        return _decode_address
+    if abi_type.startswith("bytes") and abi_type != "bytes":
+        size = int(abi_type[len("bytes") :])
+        return lambda word: bytes(word[:size])
+    return None
+
+
+class StaticDecoder:
+    """
+    Decoder of a sequence of static values, one word each
+
+    Decodes to the same values as eth_abi, without validating the
+    padding of the words.
+
+    Parameters
+    ----------
+    types: typing.Sequence[str]
+        ABI types of the values, unsigned or signed integers, booleans,
+        addresses or fixed-size byte strings.
+    """
+
+    def __init__(self, types: typing.Sequence[str]):
+        self.types = list(types)
+        self.decoders = [_value_decoder(t) for t in types]
+        assert all(d is not None for d in self.decoders), "Values have to be static"
+        self.size = WORD * len(types)
+
+    @classmethod
+    def for_types(cls, types: typing.Sequence[str]) -> typing.Optional["StaticDecoder"]:
+        """Decoder of the types, ``None`` if some of them are not supported"""
+        if all(_value_decoder(t) is not None for t in types):
+            return cls(types)
+        return None
+
+    def decode(self, data: bytes) -> typing.Tuple:
+        """Decode the values from returned or event data"""
+        data = bytes(data)
+        assert len(data) >= self.size, "Data too short"
+        return tuple(
+            decoder(data[i * WORD : (i + 1) * WORD])
+            for i, decoder in enumerate(self.decoders)
+        )
+
+
+def argument_offset(inputs: typing.Sequence[str], i: int) -> int:
+    """
+    Offset in the encoded arguments (after the selector) of the word of
+    a static argument
+
+    Parameters
+    ----------
+    inputs: typing.Sequence[str]
+        ABI types of the arguments, e.g. ``verbs.abi.Function.inputs``.
+    i: int
+        Index of the argument, preceded by static values, tuples of
+        static values, or dynamic values (one offset word each).
+    """
+    return WORD * sum(_head_words(t) for t in inputs[:i])
+
+
+def _head_words(abi_type: str) -> int:
+    if abi_type.endswith("[]") or abi_type in ("bytes", "string"):
+        return 1
+    if abi_type.startswith("("):
+        components = _split_tuple(abi_type[1:-1])
+        if any(_is_dynamic(c) for c in components):
+            return 1
+        return sum(_head_words(c) for c in components)
+    assert not abi_type.endswith("]"), f"Fixed-size array {abi_type} not supported"
+    return 1
+
+
+def _is_dynamic(abi_type: str) -> bool:
+    if abi_type.endswith("[]") or abi_type in ("bytes", "string"):
+        return True
+    if abi_type.startswith("("):
+        return any(_is_dynamic(c) for c in _split_tuple(abi_type[1:-1]))
+    return False
+
+
+def _split_tuple(components: str) -> typing.List[str]:
+    # Split the components of a tuple type at its top-level commas
+    parts, depth, start = list(), 0, 0
+    for k, char in enumerate(components):
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "," and depth == 0:
+            parts.append(components[start:k])
+            start = k + 1
+    parts.append(components[start:])
+    return parts
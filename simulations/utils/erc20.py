@@ -1,3 +1,8 @@
+import typing
+
+from simulations.utils import storage
+
+
 def mint_and_approve_dai(
     env,
     dai_abi,
@@ -45,3 +50,150 @@ def mint_and_approve_weth(
         env=env,
         args=[contract_approved_address, amount],
     )
+
+
+def inject_dai(
+    state,
+    dai_address: bytes,
+    contract_approved_address: bytes,
+    recipients: typing.List[bytes],
+    amount: int,
+):
+    """
+    Storage equivalent of :py:func:`mint_and_approve_dai` for many recipients
+
+    Parameters
+    ----------
+    state: simulations.utils.storage.SnapshotState
+        Snapshot state that is updated.
+    dai_address: bytes
+        Address of the DAI contract.
+    contract_approved_address: bytes
+        Address approved to spend the tokens of the recipients.
+    recipients: typing.List[bytes]
+        Addresses receiving the tokens.
+    amount: int
+        Amount of tokens minted for each recipient.
+    """
+    for recipient in recipients:
+        balance_slot = storage.mapping_slot(recipient, storage.DAI_BALANCE_OF_SLOT)
+        state.set_storage(
+            dai_address,
+            balance_slot,
+            state.get_storage(dai_address, balance_slot) + amount,
+        )
+        state.set_storage(
+            dai_address,
+            storage.nested_mapping_slot(
+                recipient, contract_approved_address, storage.DAI_ALLOWANCE_SLOT
+            ),
+            amount,
+        )
+
+    state.set_storage(
+        dai_address,
+        storage.DAI_TOTAL_SUPPLY_SLOT,
+        state.get_storage(dai_address, storage.DAI_TOTAL_SUPPLY_SLOT)
+        + amount * len(recipients),
+    )
+
+
+def inject_weth(
+    state,
+    weth_address: bytes,
+    contract_approved_address: bytes,
+    recipients: typing.List[bytes],
+    amount: int,
+):
+    """
+    Storage equivalent of :py:func:`mint_and_approve_weth` for many recipients
+
+    The deposited Eth is moved from the recipients to the WETH contract.
+
+    Parameters
+    ----------
+    state: simulations.utils.storage.SnapshotState
+        Snapshot state that is updated.
+    weth_address: bytes
+        Address of the WETH contract.
+    contract_approved_address: bytes
+        Address approved to spend the tokens of the recipients.
+    recipients: typing.List[bytes]
+        Addresses receiving the tokens.
+    amount: int
+        Amount of tokens deposited for each recipient.
+    """
+    for recipient in recipients:
+        state.set_balance(recipient, state.get_balance(recipient) - amount)
+        balance_slot = storage.mapping_slot(recipient, storage.WETH_BALANCE_OF_SLOT)
+        state.set_storage(
+            weth_address,
+            balance_slot,
+            state.get_storage(weth_address, balance_slot) + amount,
+        )
+        state.set_storage(
+            weth_address,
+            storage.nested_mapping_slot(
+                recipient, contract_approved_address, storage.WETH_ALLOWANCE_SLOT
+            ),
+            amount,
+        )
+
+    state.set_balance(
+        weth_address, state.get_balance(weth_address) + amount * len(recipients)
+    )
+
+
+def inject_transfer(
+    state,
+    token_address: bytes,
+    layout,
+    sender: bytes,
+    recipient: bytes,
+    amount: int,
+    spender: typing.Optional[bytes] = None,
+):
+    """
+    Storage equivalent of an ERC20 ``transfer`` (or ``transferFrom``
+    if ``spender`` is provided)
+
+    Follows WETH9 and DAI, where the allowance is not decreased
+    if it is the maximum uint256.
+
+    Parameters
+    ----------
+    state: simulations.utils.storage.SnapshotState
+        Snapshot state that is updated.
+    token_address: bytes
+        Address of the token contract.
+    layout: simulations.utils.storage.TokenLayout
+        Storage layout of the token.
+    sender: bytes
+        Address the tokens are transferred from.
+    recipient: bytes
+        Address the tokens are transferred to.
+    amount: int
+        Amount of tokens transferred.
+    spender: bytes, optional
+        Address spending the tokens of ``sender``.
+    """
+    sender_slot = storage.mapping_slot(sender, layout.balance_of_slot)
+    sender_balance = state.get_storage(token_address, sender_slot)
+    assert sender_balance >= amount, "Insufficient balance"
+    state.set_storage(token_address, sender_slot, sender_balance - amount)
+
+    recipient_slot = storage.mapping_slot(recipient, layout.balance_of_slot)
+    state.set_storage(
+        token_address,
+        recipient_slot,
+        state.get_storage(token_address, recipient_slot) + amount,
+    )
+
+    if spender is not None and spender != sender:
+        allowance_slot = storage.nested_mapping_slot(
+            sender, spender, layout.allowance_slot
+        )
+        allowance = state.get_storage(token_address, allowance_slot)
+        if allowance != 2**256 - 1:
+            assert allowance >= amount, "Insufficient allowance"
+            state.set_storage(token_address, allowance_slot, allowance - amount)
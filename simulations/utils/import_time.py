@@ -0,0 +1,104 @@
+"""
+Import time budget of the simulation path
+
+Worker processes of a sweep and short command line runs import the
+simulation modules before running anything, so their imports are kept
+to what the simulation uses: ABIs are loaded on first access,
+plotting and analysis modules are only imported when used, and SciPy
+only when an exact Uniswap trade is solved for. Import times are
+measured in fresh interpreters, from the command line with
+
+.. code-block:: bash
+
+   python -m simulations.utils.import_time --budget 1.0
+
+which fails if importing the simulation path takes longer than the
+budget or imports one of the excluded packages.
+"""
+import argparse
+import json
+import subprocess
+import sys
+import typing
+
+# Module imported by the worker processes of a sweep
+SIMULATION_MODULE = "simulations.morpho_blue.sweep"
+# Packages the simulation path should not import
+EXCLUDED_PACKAGES = ("matplotlib", "scipy")
+
+_MEASURE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+print(json.dumps([time.perf_counter() - start, sorted(sys.modules)]))
+"""
+
+
+class ImportTime(typing.NamedTuple):
+    # Shortest import time over the repeats, in seconds
+    seconds: float
+    # Modules loaded after the import
+    modules: typing.List[str]
+
+
+def measure(module: str = SIMULATION_MODULE, repeat: int = 5) -> ImportTime:
+    """
+    Time the import of a module in fresh interpreters
+
+    Parameters
+    ----------
+    module: str, optional
+        Name of the imported module.
+    repeat: int, optional
+        Number of interpreters the import is timed in.
+    """
+    assert repeat > 0, "Import has to be timed at least once"
+    times = list()
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", _MEASURE.format(module=module)],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        seconds, modules = json.loads(output.splitlines()[-1])
+        times.append(seconds)
+    return ImportTime(min(times), modules)
+
+
+def excluded_imports(
+    modules: typing.Sequence[str],
+    excluded: typing.Sequence[str] = EXCLUDED_PACKAGES,
+) -> typing.List[str]:
+    """Packages of ``excluded`` whose modules were imported"""
+    return [
+        package
+        for package in excluded
+        if any(m == package or m.startswith(f"{package}.") for m in modules)
+    ]
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(prog="Check the import time of the simulation")
+    parser.add_argument(
+        "module", type=str, nargs="?", default=SIMULATION_MODULE, help="Module timed"
+    )
+    parser.add_argument(
+        "--budget", type=float, default=1.0, help="Maximum import time (seconds)"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="Number of interpreters timed"
+    )
+    args = parser.parse_args()
+
+    result = measure(args.module, repeat=args.repeat)
+    excluded = excluded_imports(result.modules)
+    print(
+        f"import {args.module}: {result.seconds:.3f}s "
+        f"(budget {args.budget:.3f}s), {len(result.modules)} modules"
+    )
+    if excluded:
+        sys.exit(f"Excluded packages imported: {', '.join(excluded)}")
+    if result.seconds > args.budget:
+        sys.exit("Import time over budget")
@@ -0,0 +1,160 @@
+"""
+Index of borrowers by liquidation price
+
+With a fixed collateral, the health factor of a position only falls
+below a threshold when the oracle price falls below a price given by
+the position debt, collateral and the LLTV of the market. Borrowers are
+kept in a max-heap keyed by this price, so at each step only the
+positions whose price has been crossed by the oracle price are looked
+at, instead of computing the health factor of every borrower.
+
+Debt accrues interest, so keys are computed with debt slightly
+overestimated (by a relative tolerance) and are all recomputed when
+accrued interest exceeds it. Positions are re-keyed when they change,
+following a :py:class:`simulations.utils.market_mirror.MarketMirror`.
+"""
+import heapq
+
+import numpy as np
+
+from simulations.utils.market_mirror import MarketMirror
+from simulations.utils.morpho import (
+    ORACLE_PRICE_SCALE,
+    VIRTUAL_ASSETS,
+    VIRTUAL_SHARES,
+    WAD,
+)
+
+
+class LiquidationPriceIndex:
+    """
+    Max-heap of the borrowers of a market mirror by liquidation price
+
+    The key of a borrower is the oracle price (scaled by ``1e36``) below
+    which its health factor is below ``hf_threshold``. Keys are upper
+    bounds, so the positions returned by :py:meth:`crossed` include all
+    the positions below the threshold, but can include some above it.
+
+    Parameters
+    ----------
+    mirror: MarketMirror
+        Mirror of the positions of the market.
+    hf_threshold: float
+        Health factor threshold.
+    tolerance: float, optional
+        Relative growth of the debt per borrow share (i.e. accrued
+        interest) after which all the keys are recomputed.
+    """
+
+    def __init__(
+        self, mirror: MarketMirror, hf_threshold: float, tolerance: float = 1e-3
+    ):
+        self.mirror = mirror
+        self.hf_threshold = hf_threshold
+        self.tolerance = tolerance
+        self.lltv = mirror.reader.market_params[4]
+
+        self.keys = np.full(len(mirror.borrowers), -np.inf)
+        # Heap of (-key, borrower index), entries whose key differs from
+        # the current key of their borrower are stale and skipped
+        self.heap = list()
+        # Debt per borrow share used to compute the keys
+        self.share_value = None
+        self.cursor = 0
+
+        # Number of times all the keys were recomputed
+        self.n_rebuilds = 0
+
+    def _keys(self, index: np.ndarray) -> np.ndarray:
+        # Price below which collateral * price * lltv < hf_threshold * debt
+        shares = self.mirror.borrow_shares[index].astype(np.float64)
+        debt = shares * self.share_value
+        collateral = self.mirror.collateral[index].astype(np.float64)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            keys = (
+                self.hf_threshold
+                * debt
+                * float(ORACLE_PRICE_SCALE * WAD)
+                / (collateral * self.lltv)
+            )
+        keys[debt == 0] = -np.inf
+        return keys
+
+    def _rebuild(self, share_value: float):
+        self.share_value = share_value * (1 + self.tolerance)
+        _, self.cursor = self.mirror.changes_since(self.cursor)
+        self.keys = self._keys(np.arange(len(self.keys)))
+        self.heap = [
+            (-key, i) for i, key in enumerate(self.keys.tolist()) if key > -np.inf
+        ]
+        heapq.heapify(self.heap)
+        self.n_rebuilds += 1
+
+    def update(self, total_borrow_assets: int):
+        """
+        Re-key the changed positions, or all the positions if accrued
+        interest exceeds the tolerance
+
+        Parameters
+        ----------
+        total_borrow_assets: int
+            Total borrow of the market, with interest accrued.
+        """
+        share_value = (total_borrow_assets + VIRTUAL_ASSETS) / (
+            self.mirror.total_borrow_shares + VIRTUAL_SHARES
+        )
+        # Keys stay upper bounds until interest uses half of the tolerance
+        if (
+            self.share_value is None
+            or share_value * (1 + self.tolerance / 2) > self.share_value
+        ):
+            self._rebuild(share_value)
+            return
+
+        index, self.cursor = self.mirror.changes_since(self.cursor)
+        if len(index) == 0:
+            return
+        keys = self._keys(index)
+        changed = keys != self.keys[index]
+        self.keys[index[changed]] = keys[changed]
+        for i, key in zip(index[changed].tolist(), keys[changed].tolist()):
+            if key > -np.inf:
+                heapq.heappush(self.heap, (-key, i))
+
+        # Drop the stale entries once they make up most of the heap
+        if len(self.heap) > 2 * len(self.keys):
+            self.heap = [
+                (neg_key, i) for neg_key, i in self.heap if -neg_key == self.keys[i]
+            ]
+            heapq.heapify(self.heap)
+
+    def crossed(self, price: int) -> np.ndarray:
+        """
+        Borrowers whose liquidation price is above the oracle price
+
+        Only the entries of the heap above the price are visited.
+
+        Parameters
+        ----------
+        price: int
+            Oracle price (scaled by ``1e36``).
+
+        Returns
+        -------
+        np.ndarray
+            Sorted indices (in the mirror) of the borrowers.
+        """
+        price = float(price)
+        crossed = set()
+        stack = [0]
+        while stack:
+            j = stack.pop()
+            if j >= len(self.heap):
+                continue
+            neg_key, i = self.heap[j]
+            if -neg_key <= price:
+                continue
+            if self.keys[i] == -neg_key:
+                crossed.add(i)
+            stack.extend((2 * j + 1, 2 * j + 2))
+        return np.array(sorted(crossed), dtype=np.int64)
@@ -0,0 +1,243 @@
+"""
+Local mirror of the borrow positions of a Morpho Blue market
+
+Borrow shares and collateral of positions only change through the
+transactions of the agents, so instead of re-reading all the positions
+from the EVM at each step they are kept in local arrays, updated after
+each block. The blocks are followed from their events: blocks without
+any event from Morpho Blue leave the mirror unchanged, otherwise only
+the positions targeted by the Morpho Blue transactions submitted during
+the step are re-read (with a single ``extSloads`` call).
+
+Events only expose the data of the logs (indexed topics such as the
+market id or the borrower are not available), so they cannot be
+attributed to positions, the submitted transactions are used for this.
+
+Debt and health factors of any number of positions are computed from
+the mirror with the share math of Morpho Blue, from the accrued total
+borrow of the market and the oracle price, i.e. in two calls.
+"""
+import typing
+
+import numpy as np
+
+from simulations.utils.calldata import WORD, argument_offset
+from simulations.utils.position_reader import PositionReader, Positions
+
+
+class MarketMirror:
+    """
+    Mirror of the borrow positions of a list of borrowers
+
+    Can be used in place of a
+    :py:class:`simulations.utils.position_reader.PositionReader` by the
+    agents, and has to be attached to the simulation environment with
+    :py:class:`MirroredEnv` to follow its blocks.
+
+    Parameters
+    ----------
+    env
+        Simulation environment.
+    sender: bytes
+        Address of the caller of the view calls of the mirror.
+    borrowers: typing.Sequence[bytes]
+        Addresses of the mirrored borrowers.
+    morpho_blue_abi
+        Morpho Blue ABI.
+    morpho_blue_snippets_abi
+        Morpho Blue snippets ABI.
+    oracle_abi
+        Oracle ABI.
+    morpho_blue_address: bytes
+        Address of Morpho Blue.
+    morpho_blue_snippets_address: bytes
+        Address of the snippets contract.
+    market_params: typing.Tuple
+        Market params (loan token, collateral token, oracle, irm, lltv).
+    check_every: int, optional
+        Number of blocks between checks of the mirror against the
+        storage of the EVM, no checks if ``0``.
+    """
+
+    def __init__(
+        self,
+        env,
+        sender: bytes,
+        borrowers: typing.Sequence[bytes],
+        morpho_blue_abi,
+        morpho_blue_snippets_abi,
+        oracle_abi,
+        morpho_blue_address: bytes,
+        morpho_blue_snippets_address: bytes,
+        market_params: typing.Tuple,
+        check_every: int = 0,
+    ):
+        self.sender = sender
+        self.borrowers = list(borrowers)
+        self.index = {borrower: i for i, borrower in enumerate(self.borrowers)}
+        self.morpho_blue_address = morpho_blue_address
+        self.check_every = check_every
+        self.reader = PositionReader(
+            morpho_blue_abi=morpho_blue_abi,
+            morpho_blue_snippets_abi=morpho_blue_snippets_abi,
+            oracle_abi=oracle_abi,
+            morpho_blue_address=morpho_blue_address,
+            morpho_blue_snippets_address=morpho_blue_snippets_address,
+            market_params=market_params,
+        )
+
+        # Morpho Blue functions changing borrow positions, with the offset
+        # of the word of the position owner in their calldata
+        self.position_functions = {
+            function.selector: 4 + argument_offset(function.inputs, i)
+            for function, i in [
+                (morpho_blue_abi.supplyCollateral, 2),
+                (morpho_blue_abi.withdrawCollateral, 2),
+                (morpho_blue_abi.borrow, 3),
+                (morpho_blue_abi.repay, 3),
+                (morpho_blue_abi.liquidate, 1),
+            ]
+        }
+
+        (
+            self.total_borrow_shares,
+            self.borrow_shares,
+            self.collateral,
+        ) = self.reader.read_storage(env, sender, self.borrowers)
+        # Indices of the positions targeted by the submitted transactions
+        self.touched = set()
+        # Indices of the positions re-read at each block that changed
+        # the market, followed by the consumers of the mirror
+        self.changes = list()
+
+        # Number of blocks followed, and of positions re-read
+        self.n_blocks = 0
+        self.n_refreshed = 0
+
+    def observe(self, transactions: typing.Sequence[typing.Tuple]):
+        """Collect the positions targeted by submitted transactions"""
+        for _sender, address, encoded_args, _value, _checked in transactions:
+            if address != self.morpho_blue_address:
+                continue
+            offset = self.position_functions.get(encoded_args[:4])
+            if offset is None:
+                continue
+            owner = bytes(encoded_args[offset + 12 : offset + WORD])
+            position = self.index.get(owner)
+            if position is not None:
+                self.touched.add(position)
+
+    def sync(self, env):
+        """Update the mirror after a block was processed"""
+        self.n_blocks += 1
+        changed = any(
+            address == self.morpho_blue_address
+            for event in env.get_last_events()
+            for address, _ in event[1]
+        )
+        if changed:
+            index = np.fromiter(self.touched, dtype=np.int64, count=len(self.touched))
+            (
+                self.total_borrow_shares,
+                self.borrow_shares[index],
+                self.collateral[index],
+            ) = self.reader.read_storage(
+                env, self.sender, [self.borrowers[i] for i in index]
+            )
+            self.n_refreshed += len(index)
+            self.changes.append(index)
+        self.touched = set()
+
+        if self.check_every and self.n_blocks % self.check_every == 0:
+            self.check(env)
+
+    def check(self, env):
+        """Check the mirror against the storage of the EVM"""
+        total_borrow_shares, borrow_shares, collateral = self.reader.read_storage(
+            env, self.sender, self.borrowers
+        )
+        assert (
+            total_borrow_shares == self.total_borrow_shares
+            and np.array_equal(borrow_shares, self.borrow_shares)
+            and np.array_equal(collateral, self.collateral)
+        ), f"Market mirror out of sync with the EVM after {self.n_blocks} blocks"
+
+    def changes_since(self, cursor: int) -> typing.Tuple[np.ndarray, int]:
+        """
+        Positions re-read since a point of the history of the mirror
+
+        Parameters
+        ----------
+        cursor: int
+            Cursor returned by the previous call, ``0`` to get all the
+            positions re-read since the mirror was created.
+
+        Returns
+        -------
+        typing.Tuple[np.ndarray, int]
+            Indices of the re-read positions (some may be unchanged), and
+            cursor of the current point of the history.
+        """
+        changes = self.changes[cursor:]
+        if not changes:
+            return np.zeros(0, dtype=np.int64), len(self.changes)
+        return np.unique(np.concatenate(changes)), len(self.changes)
+
+    def market_state(self, env, sender: bytes) -> typing.Tuple[int, int]:
+        """Total borrow of the market, with interest accrued, and oracle price"""
+        return self.reader.market_state(env, sender)
+
+    def read(self, env, sender: bytes, borrowers: typing.Sequence[bytes]) -> Positions:
+        """
+        Positions of mirrored borrowers
+
+        Same as :py:meth:`simulations.utils.position_reader.PositionReader.read`,
+        but only the accrued total borrow and oracle price are read.
+        """
+        index = [self.index[borrower] for borrower in borrowers]
+        return self.reader.positions(
+            env,
+            sender,
+            self.total_borrow_shares,
+            self.borrow_shares[index],
+            self.collateral[index],
+        )
+
+
+class MirroredEnv:
+    """
+    Simulation environment wrapper updating market mirrors
+
+    Submitted transactions are passed to the mirrors, which are synced
+    after each processed block. Other attributes are those of the
+    wrapped environment.
+
+    Parameters
+    ----------
+    env
+        Simulation environment.
+    mirrors: typing.Sequence[MarketMirror]
+        Mirrors following the environment.
+    """
+
+    def __init__(self, env, mirrors: typing.Sequence[MarketMirror]):
+        self.env = env
+        self.mirrors = list(mirrors)
+
+    def __getattr__(self, name: str):
+        return getattr(self.env, name)
+
+    def submit_transaction(self, transaction: typing.Tuple):
+        for mirror in self.mirrors:
+            mirror.observe([transaction])
+        self.env.submit_transaction(transaction)
+
+    def submit_transactions(self, transactions: typing.List[typing.Tuple]):
+        for mirror in self.mirrors:
+            mirror.observe(transactions)
+        self.env.submit_transactions(transactions)
+
+    def process_block(self):
+        self.env.process_block()
+        for mirror in self.mirrors:
+            mirror.sync(self.env)
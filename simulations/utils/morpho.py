@@ -0,0 +1,287 @@
+"""
+Morpho Blue share and liquidation math, and storage injection
+
+Share conversions follow ``SharesMathLib`` of Morpho Blue, and work on
+Python integers as well as object arrays of Python integers. The
+injection functions write supply and borrow positions directly into
+an environment snapshot, following the state changes of the
+corresponding Morpho Blue functions.
+"""
+import typing
+
+import numpy as np
+
+from simulations.utils import storage
+from simulations.utils.erc20 import inject_transfer
+
+VIRTUAL_SHARES = 10**6
+VIRTUAL_ASSETS = 1
+
+WAD = 10**18
+ORACLE_PRICE_SCALE = 10**36
+MAX_LIQUIDATION_INCENTIVE_FACTOR = 115 * 10**16
+LIQUIDATION_CURSOR = 3 * 10**17
+
+UINT128_MASK = 2**128 - 1
+
+
+def to_shares_down(assets: int, total_assets: int, total_shares: int) -> int:
+    return assets * (total_shares + VIRTUAL_SHARES) // (total_assets + VIRTUAL_ASSETS)
+
+
+def to_shares_up(assets: int, total_assets: int, total_shares: int) -> int:
+    return -(
+        -assets * (total_shares + VIRTUAL_SHARES) // (total_assets + VIRTUAL_ASSETS)
+    )
+
+
+def to_assets_down(shares: int, total_assets: int, total_shares: int) -> int:
+    return shares * (total_assets + VIRTUAL_ASSETS) // (total_shares + VIRTUAL_SHARES)
+
+
+def to_assets_up(shares: int, total_assets: int, total_shares: int) -> int:
+    return -(
+        -shares * (total_assets + VIRTUAL_ASSETS) // (total_shares + VIRTUAL_SHARES)
+    )
+
+
+def liquidation_incentive_factor(lltv: int) -> int:
+    """Liquidation incentive factor of a market (scaled by ``1e18``)"""
+    return min(
+        MAX_LIQUIDATION_INCENTIVE_FACTOR,
+        WAD * WAD // (WAD - LIQUIDATION_CURSOR * (WAD - lltv) // WAD),
+    )
+
+
+def liquidate(
+    borrow_shares: np.ndarray,
+    collateral: np.ndarray,
+    seized_assets: np.ndarray,
+    total_borrow_assets: int,
+    total_borrow_shares: int,
+    price: int,
+    lltv: int,
+) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """
+    Outcome of ``liquidate`` calls seizing given collateral assets
+
+    Follows ``Morpho.liquidate`` for a batch of positions, interest
+    being already accrued, i.e. with the market totals returned by
+    ``marketTotalBorrow``. Transfers of the repaid assets are not
+    checked.
+
+    Parameters
+    ----------
+    borrow_shares: np.ndarray
+        Borrow shares of the positions (object array of integers).
+    collateral: np.ndarray
+        Collateral of the positions (object array of integers).
+    seized_assets: np.ndarray
+        Collateral assets seized from each position (object array of
+        integers).
+    total_borrow_assets: int
+        Total borrow of the market, with interest accrued.
+    total_borrow_shares: int
+        Total borrow shares of the market.
+    price: int
+        Oracle price (scaled by ``1e36``).
+    lltv: int
+        LLTV of the market.
+
+    Returns
+    -------
+    typing.Tuple[np.ndarray, np.ndarray]
+        Loan assets repaid by each liquidation, and whether each
+        liquidation goes through, i.e. the position is unhealthy and
+        the seized assets are valid.
+    """
+    # Morpho._isHealthy
+    borrowed = to_assets_up(borrow_shares, total_borrow_assets, total_borrow_shares)
+    max_borrow = collateral * price // ORACLE_PRICE_SCALE * lltv // WAD
+    unhealthy = np.asarray(max_borrow < borrowed, dtype=bool)
+
+    factor = liquidation_incentive_factor(lltv)
+    seized_assets_quoted = -(-seized_assets * price // ORACLE_PRICE_SCALE)
+    repaid_shares = to_shares_up(
+        -(-seized_assets_quoted * WAD // factor),
+        total_borrow_assets,
+        total_borrow_shares,
+    )
+    repaid_assets = to_assets_up(
+        repaid_shares, total_borrow_assets, total_borrow_shares
+    )
+
+    valid = np.asarray(
+        (seized_assets > 0)
+        & (seized_assets <= collateral)
+        & (repaid_shares <= borrow_shares),
+        dtype=bool,
+    )
+    return repaid_assets, unhealthy & valid
+
+
+def _get_pair(state, address: bytes, slot: int) -> typing.Tuple[int, int]:
+    value = state.get_storage(address, slot)
+    return value & UINT128_MASK, value >> 128
+
+
+def _set_pair(state, address: bytes, slot: int, low: int, high: int):
+    assert low <= UINT128_MASK and high <= UINT128_MASK, "uint128 overflow"
+    state.set_storage(address, slot, low | (high << 128))
+
+
+def inject_supply(
+    state,
+    morpho_blue_address: bytes,
+    market_params: typing.Tuple,
+    supplier: bytes,
+    assets: int,
+    loan_token_layout: storage.TokenLayout = storage.DAI_LAYOUT,
+):
+    """
+    Storage equivalent of ``supply`` of loan assets to a market
+
+    Interest is assumed to be already accrued, i.e. this is used
+    in the block the market was created.
+
+    Parameters
+    ----------
+    state: simulations.utils.storage.SnapshotState
+        Snapshot state that is updated.
+    morpho_blue_address: bytes
+        Address of Morpho Blue.
+    market_params: typing.Tuple
+        Market params (loan token, collateral token, oracle, irm, lltv).
+    supplier: bytes
+        Address of the supplier, that must have approved Morpho Blue.
+    assets: int
+        Amount of loan assets supplied.
+    loan_token_layout: simulations.utils.storage.TokenLayout, optional
+        Storage layout of the loan token, default DAI.
+    """
+    market_id = storage.morpho_market_id(market_params)
+    market_slot = storage.morpho_market_slots(market_id)[0]
+    supply_shares_slot = storage.morpho_position_slots(market_id, supplier)[0]
+
+    total_supply_assets, total_supply_shares = _get_pair(
+        state, morpho_blue_address, market_slot
+    )
+    shares = to_shares_down(assets, total_supply_assets, total_supply_shares)
+
+    state.set_storage(
+        morpho_blue_address,
+        supply_shares_slot,
+        state.get_storage(morpho_blue_address, supply_shares_slot) + shares,
+    )
+    _set_pair(
+        state,
+        morpho_blue_address,
+        market_slot,
+        total_supply_assets + assets,
+        total_supply_shares + shares,
+    )
+
+    inject_transfer(
+        state,
+        market_params[0],
+        loan_token_layout,
+        supplier,
+        morpho_blue_address,
+        assets,
+        spender=morpho_blue_address,
+    )
+
+
+def inject_positions(
+    state,
+    morpho_blue_address: bytes,
+    market_params: typing.Tuple,
+    borrowers: typing.List[bytes],
+    collateral: typing.List[int],
+    borrow_assets: typing.List[int],
+    loan_token_layout: storage.TokenLayout = storage.DAI_LAYOUT,
+    collateral_token_layout: storage.TokenLayout = storage.WETH_LAYOUT,
+):
+    """
+    Storage equivalent of ``supplyCollateral`` followed by ``borrow``
+    for a list of borrowers
+
+    Positions are opened in the order of ``borrowers``, as if each one
+    submitted its two transactions one after the other. Interest is
+    assumed to be already accrued and the health of the positions
+    is not checked.
+
+    Parameters
+    ----------
+    state: simulations.utils.storage.SnapshotState
+        Snapshot state that is updated.
+    morpho_blue_address: bytes
+        Address of Morpho Blue.
+    market_params: typing.Tuple
+        Market params (loan token, collateral token, oracle, irm, lltv).
+    borrowers: typing.List[bytes]
+        Addresses of the borrowers, that must have approved Morpho Blue
+        to use their collateral.
+    collateral: typing.List[int]
+        Collateral assets supplied by each borrower.
+    borrow_assets: typing.List[int]
+        Loan assets borrowed by each borrower.
+    loan_token_layout: simulations.utils.storage.TokenLayout, optional
+        Storage layout of the loan token, default DAI.
+    collateral_token_layout: simulations.utils.storage.TokenLayout, optional
+        Storage layout of the collateral token, default WETH.
+    """
+    loan_token, collateral_token = market_params[0], market_params[1]
+    market_id = storage.morpho_market_id(market_params)
+    market_slots = storage.morpho_market_slots(market_id)
+    total_supply_assets, _ = _get_pair(state, morpho_blue_address, market_slots[0])
+    total_borrow_assets, total_borrow_shares = _get_pair(
+        state, morpho_blue_address, market_slots[1]
+    )
+
+    for borrower, collateral_assets, assets in zip(
+        borrowers, collateral, borrow_assets
+    ):
+        position_slot = storage.morpho_position_slots(market_id, borrower)[1]
+        borrow_shares, position_collateral = _get_pair(
+            state, morpho_blue_address, position_slot
+        )
+
+        inject_transfer(
+            state,
+            collateral_token,
+            collateral_token_layout,
+            borrower,
+            morpho_blue_address,
+            collateral_assets,
+            spender=morpho_blue_address,
+        )
+
+        shares = to_shares_up(assets, total_borrow_assets, total_borrow_shares)
+        total_borrow_assets += assets
+        total_borrow_shares += shares
+        assert total_borrow_assets <= total_supply_assets, "Insufficient liquidity"
+
+        _set_pair(
+            state,
+            morpho_blue_address,
+            position_slot,
+            borrow_shares + shares,
+            position_collateral + collateral_assets,
+        )
+        inject_transfer(
+            state,
+            loan_token,
+            loan_token_layout,
+            morpho_blue_address,
+            borrower,
+            assets,
+        )
+
+    _set_pair(
+        state,
+        morpho_blue_address,
+        market_slots[1],
+        total_borrow_assets,
+        total_borrow_shares,
+    )
@@ -0,0 +1,241 @@
+"""
+Batch reader of Morpho Blue positions
+
+Reading the positions of ``n`` borrowers with the snippets contract
+takes ``n`` calls per function (``userHealthFactor``,
+``borrowAssetsUser``, ...). Instead the raw storage of all the
+positions is read in a single call to ``Morpho.extSloads``, and the
+debt and health factors are computed from it with the integer math of
+Morpho Blue, so results are identical to the snippets. Reading the
+positions of any number of borrowers takes three calls: the storage
+of the positions, the total borrow of the market (with interest
+accrued) and the oracle price.
+"""
+import typing
+
+import numpy as np
+
+from simulations.utils import storage
+from simulations.utils.calldata import WORD, CalldataTemplate
+from simulations.utils.morpho import (
+    ORACLE_PRICE_SCALE,
+    VIRTUAL_ASSETS,
+    VIRTUAL_SHARES,
+    WAD,
+)
+
+# Health factor returned by the snippets for positions without debt
+MAX_HEALTH_FACTOR = 2**256 - 1
+
+
+class Positions(typing.NamedTuple):
+    """
+    Positions of a list of borrowers
+
+    Integer values (in token units) are exact, stored in object arrays
+    of Python integers.
+    """
+
+    borrow_shares: np.ndarray
+    collateral: np.ndarray
+    debt_assets: np.ndarray
+    # Health factors, as returned by ``userHealthFactor`` divided by 1e18
+    health_factor: np.ndarray
+    # Market state the debt and health factors were computed from
+    total_borrow_assets: int
+    total_borrow_shares: int
+    price: int
+
+    def take(self, index: np.ndarray) -> "Positions":
+        """Positions of a subset of the borrowers"""
+        return self._replace(
+            borrow_shares=self.borrow_shares[index],
+            collateral=self.collateral[index],
+            debt_assets=self.debt_assets[index],
+            health_factor=self.health_factor[index],
+        )
+
+
+class PositionReader:
+    """
+    Read the positions of many borrowers of a market at once
+
+    Parameters
+    ----------
+    morpho_blue_abi
+        Morpho Blue ABI.
+    morpho_blue_snippets_abi
+        Morpho Blue snippets ABI.
+    oracle_abi
+        Oracle ABI.
+    morpho_blue_address: bytes
+        Address of Morpho Blue.
+    morpho_blue_snippets_address: bytes
+        Address of the snippets contract.
+    market_params: typing.Tuple
+        Market params (loan token, collateral token, oracle, irm, lltv).
+    """
+
+    def __init__(
+        self,
+        morpho_blue_abi,
+        morpho_blue_snippets_abi,
+        oracle_abi,
+        morpho_blue_address: bytes,
+        morpho_blue_snippets_address: bytes,
+        market_params: typing.Tuple,
+    ):
+        self.morpho_blue_abi = morpho_blue_abi
+        self.morpho_blue_snippets_abi = morpho_blue_snippets_abi
+        self.oracle_abi = oracle_abi
+        self.morpho_blue_address = morpho_blue_address
+        self.morpho_blue_snippets_address = morpho_blue_snippets_address
+        self.market_params = market_params
+        self.market_total_borrow = CalldataTemplate(
+            morpho_blue_snippets_abi.marketTotalBorrow, [market_params]
+        )
+        self.oracle_price = CalldataTemplate(oracle_abi.price, [])
+
+        self.market_id = storage.morpho_market_id(market_params)
+        # Slot of the total borrow assets and shares of the market
+        self.borrow_totals_slot = storage.morpho_market_slots(self.market_id)[1]
+        # Slot of the borrow shares and collateral of each borrower
+        self.position_slots = dict()
+
+    def _position_slot(self, borrower: bytes) -> bytes:
+        slot = self.position_slots.get(borrower)
+        if slot is None:
+            slot = storage.morpho_position_slots(self.market_id, borrower)[1]
+            slot = slot.to_bytes(32, "big")
+            self.position_slots[borrower] = slot
+        return slot
+
+    def read_storage(
+        self, env, sender: bytes, borrowers: typing.Sequence[bytes]
+    ) -> typing.Tuple[int, np.ndarray, np.ndarray]:
+        """
+        Read the raw storage of the positions of borrowers
+
+        Parameters
+        ----------
+        env
+            Simulation environment.
+        sender: bytes
+            Address of the caller.
+        borrowers: typing.Sequence[bytes]
+            Addresses of the borrowers.
+
+        Returns
+        -------
+        typing.Tuple[int, np.ndarray, np.ndarray]
+            Total borrow shares of the market, and borrow shares and
+            collateral of the borrowers.
+        """
+        slots = [self.borrow_totals_slot.to_bytes(32, "big")]
+        slots.extend(self._position_slot(borrower) for borrower in borrowers)
+        # ABI encoding of the bytes32[] argument: offset, length and slots
+        calldata = b"".join(
+            [
+                self.morpho_blue_abi.extSloads.selector,
+                WORD.to_bytes(WORD, "big"),
+                len(slots).to_bytes(WORD, "big"),
+                *slots,
+            ]
+        )
+        result, _, _ = env.call(sender, self.morpho_blue_address, calldata, 0)
+        # bytes32[] output: offset, length and one word per slot, each
+        # word packs two uint128 (borrow shares and collateral)
+        words = np.frombuffer(bytes(result), dtype=">u8")[8:].reshape(-1, 4)
+        words = words.astype(object)
+        low = (words[:, 2] << 64) | words[:, 3]
+        high = (words[:, 0] << 64) | words[:, 1]
+        return int(high[0]), low[1:], high[1:]
+
+    def market_state(self, env, sender: bytes) -> typing.Tuple[int, int]:
+        """Total borrow of the market, with interest accrued, and oracle price"""
+        total_borrow_assets = self.market_total_borrow.call(
+            env, sender, self.morpho_blue_snippets_address
+        )[0][0]
+        oracle_address = self.market_params[2]
+        price = self.oracle_price.call(env, sender, oracle_address)[0][0]
+        return total_borrow_assets, price
+
+    def positions(
+        self,
+        env,
+        sender: bytes,
+        total_borrow_shares: int,
+        borrow_shares: np.ndarray,
+        collateral: np.ndarray,
+    ) -> Positions:
+        """
+        Debt and health factors of positions
+
+        Parameters
+        ----------
+        env
+            Simulation environment.
+        sender: bytes
+            Address of the caller.
+        total_borrow_shares: int
+            Total borrow shares of the market.
+        borrow_shares: np.ndarray
+            Borrow shares of the positions.
+        collateral: np.ndarray
+            Collateral of the positions.
+
+        Returns
+        -------
+        Positions
+            Positions, with their debt (interest accrued until the
+            current block) and health factors.
+        """
+        total_borrow_assets, price = self.market_state(env, sender)
+
+        # SharesMathLib.toAssetsUp
+        debt_assets = -(
+            -borrow_shares
+            * (total_borrow_assets + VIRTUAL_ASSETS)
+            // (total_borrow_shares + VIRTUAL_SHARES)
+        )
+        lltv = self.market_params[4]
+        max_borrow = collateral * price // ORACLE_PRICE_SCALE * lltv // WAD
+        has_debt = debt_assets > 0
+        health_factor = np.full(len(borrow_shares), MAX_HEALTH_FACTOR, dtype=object)
+        health_factor[has_debt] = max_borrow[has_debt] * WAD // debt_assets[has_debt]
+
+        return Positions(
+            borrow_shares=borrow_shares,
+            collateral=collateral,
+            debt_assets=debt_assets,
+            # Exact division of the integers, like the callers of the snippets
+            health_factor=to_float(health_factor, WAD),
+            total_borrow_assets=total_borrow_assets,
+            total_borrow_shares=total_borrow_shares,
+            price=price,
+        )
+
+    def read(self, env, sender: bytes, borrowers: typing.Sequence[bytes]) -> Positions:
+        """
+        Read the positions of borrowers
+
+        Parameters
+        ----------
+        env
+            Simulation environment.
+        sender: bytes
+            Address of the caller.
+        borrowers: typing.Sequence[bytes]
+            Addresses of the borrowers.
+
+        Returns
+        -------
+        Positions
+            Positions of the borrowers, in the order of ``borrowers``.
+        """
+        return self.positions(env, sender, *self.read_storage(env, sender, borrowers))
+
+
+def to_float(values: np.ndarray, scale: int) -> np.ndarray:
+    """Divide exact integer values by a scale, rounding to the nearest float"""
+    return np.array([value / scale for value in values.tolist()], dtype=np.float64)
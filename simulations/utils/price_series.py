@@ -0,0 +1,174 @@
+"""
+Historical price series
+
+Price histories (e.g. ETH/DAI minute bars over several years) are
+stored as a single ``.npy`` array of float64 prices, read back
+memory-mapped so that replaying them uses constant memory, and only the
+pages of the replayed window are read from disk. Series are converted
+from CSV files with :py:func:`csv_to_binary`, or from the command line
+
+.. code-block:: bash
+
+   python -m simulations.utils.price_series prices.csv prices.npy --column close
+"""
+import argparse
+import csv
+import typing
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+# Number of rows converted at once
+CHUNK_SIZE = 1 << 16
+
+
+def csv_to_binary(
+    csv_path: str, path: str, column: typing.Union[str, int] = "close"
+) -> int:
+    """
+    Convert a CSV price series to the binary format
+
+    The CSV file is read twice (to count the rows and then to convert
+    them) in chunks, so files larger than memory can be converted.
+
+    Parameters
+    ----------
+    csv_path: str
+        Path of the CSV file, with a header row and one row per bar,
+        in chronological order.
+    path: str
+        Path of the ``.npy`` binary file.
+    column: str | int, optional
+        Name, or index, of the price column.
+
+    Returns
+    -------
+    int
+        Number of prices.
+    """
+    with open(csv_path, "r", newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        index = column if isinstance(column, int) else header.index(column)
+        n_prices = sum(1 for _ in reader)
+
+    prices = open_memmap(path, mode="w+", dtype=np.float64, shape=(n_prices,))
+    with open(csv_path, "r", newline="") as f:
+        reader = csv.reader(f)
+        next(reader)
+        chunk = list()
+        start = 0
+        for row in reader:
+            chunk.append(float(row[index]))
+            if len(chunk) == CHUNK_SIZE:
+                prices[start : start + len(chunk)] = chunk
+                start += len(chunk)
+                chunk = list()
+        prices[start : start + len(chunk)] = chunk
+    prices.flush()
+
+    return n_prices
+
+
+def load_prices(path: str) -> np.ndarray:
+    """Memory-map a price series written by :py:func:`csv_to_binary`"""
+    return np.load(path, mmap_mode="r")
+
+
+class PriceReplay:
+    """
+    Replay of a window of a price series
+
+    Indexing returns the prices of the window relative to its first
+    price, so it can be used as the path of a
+    :py:class:`simulations.agents.uniswap_agent.PricePath`, the external
+    market then replays the historical returns starting from the
+    current pool price. Prices are read from the (memory-mapped) series
+    as they are requested.
+
+    Parameters
+    ----------
+    prices: np.ndarray
+        Price series, e.g. loaded with :py:func:`load_prices`.
+    start: int, optional
+        Index of the first price of the window.
+    end: int, optional
+        Index after the last price of the window, defaults to the end
+        of the series.
+    every: int, optional
+        Resampling factor, only every ``every`` price is replayed (e.g.
+        60 to replay minute bars as hourly prices).
+    """
+
+    def __init__(
+        self,
+        prices: np.ndarray,
+        start: int = 0,
+        end: typing.Optional[int] = None,
+        every: int = 1,
+    ):
+        self.prices = prices[start:end:every]
+        self.initial_price = float(self.prices[0])
+
+    def __len__(self) -> int:
+        # The first price is the reference of the window
+        return len(self.prices) - 1
+
+    def __getitem__(self, step: int) -> float:
+        if not 0 <= step < len(self):
+            raise IndexError(f"Step {step} is past the end of the replayed window")
+        return self.prices[step + 1] / self.initial_price
+
+
+def replay_windows(
+    n_prices: int,
+    n_steps: int,
+    every: int = 1,
+    start: int = 0,
+    end: typing.Optional[int] = None,
+) -> typing.List[typing.Tuple[int, int]]:
+    """
+    Split a price series into consecutive windows of ``n_steps`` steps
+
+    Windows can be simulated independently, e.g. by the workers of a
+    sweep. Consecutive windows share their boundary price.
+
+    Parameters
+    ----------
+    n_prices: int
+        Number of prices of the series.
+    n_steps: int
+        Number of simulation steps of each window.
+    every: int, optional
+        Resampling factor of the replay.
+    start: int, optional
+        Index of the first price used.
+    end: int, optional
+        Index after the last price used, defaults to the end of the series.
+
+    Returns
+    -------
+    typing.List[typing.Tuple[int, int]]
+        Start and end indices of the windows.
+    """
+    end = n_prices if end is None else min(end, n_prices)
+    length = n_steps * every
+    return [
+        (window_start, window_start + length + 1)
+        for window_start in range(start, end - length, length)
+    ]
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        prog="Convert a CSV price series to the binary format"
+    )
+    parser.add_argument("csv_path", type=str, help="Path of the CSV price series")
+    parser.add_argument("path", type=str, help="Path of the binary (.npy) price series")
+    parser.add_argument(
+        "--column", type=str, default="close", help="Name of the price column"
+    )
+    args = parser.parse_args()
+
+    csv_to_binary(args.csv_path, args.path, column=args.column)
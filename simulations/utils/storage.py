@@ -0,0 +1,245 @@
+"""
+Storage layouts of the contracts used in the simulations
+
+Slot numbers follow the Solidity storage layout of the mainnet
+contracts, values of mappings are stored at
+``keccak256(key . slot)``. These are used to extend a fork cache with
+storage values that were never fetched from the remote node, and to
+write state directly into environment snapshots.
+"""
+import typing
+
+import eth_abi
+import eth_utils
+
+
+class TokenLayout(typing.NamedTuple):
+    balance_of_slot: int
+    allowance_slot: int
+
+
+# WETH9
+WETH_BALANCE_OF_SLOT = 3
+WETH_ALLOWANCE_SLOT = 4
+WETH_LAYOUT = TokenLayout(WETH_BALANCE_OF_SLOT, WETH_ALLOWANCE_SLOT)
+
+# DAI
+DAI_TOTAL_SUPPLY_SLOT = 1
+DAI_BALANCE_OF_SLOT = 2
+DAI_ALLOWANCE_SLOT = 3
+DAI_LAYOUT = TokenLayout(DAI_BALANCE_OF_SLOT, DAI_ALLOWANCE_SLOT)
+
+# Morpho Blue
+MORPHO_POSITION_SLOT = 2
+MORPHO_MARKET_SLOT = 3
+MORPHO_IS_LLTV_ENABLED_SLOT = 5
+MORPHO_ID_TO_MARKET_PARAMS_SLOT = 8
+# Number of slots of the Position, Market and MarketParams structs
+MORPHO_POSITION_SIZE = 2
+MORPHO_MARKET_SIZE = 3
+MORPHO_MARKET_PARAMS_SIZE = 5
+
+# Adaptive curve IRM
+IRM_RATE_AT_TARGET_SLOT = 0
+
+
+def mapping_slot(key: typing.Union[bytes, int], slot: int) -> int:
+    """
+    Slot of the value of a mapping
+
+    Parameters
+    ----------
+    key: bytes | int
+        Mapping key, either an address, a bytes32 or an integer.
+    slot: int
+        Slot of the mapping.
+
+    Returns
+    -------
+    int
+        Storage slot of ``mapping[key]``.
+    """
+    if isinstance(key, int):
+        key = key.to_bytes(32, "big")
+    key = key.rjust(32, b"\x00")
+    return int.from_bytes(eth_utils.keccak(key + slot.to_bytes(32, "big")), "big")
+
+
+def nested_mapping_slot(key_a: bytes, key_b: bytes, slot: int) -> int:
+    """Slot of the value of a nested mapping ``mapping[key_a][key_b]``"""
+    return mapping_slot(key_b, mapping_slot(key_a, slot))
+
+
+def create_address(sender: bytes, nonce: int) -> bytes:
+    """
+    Address of a contract deployed with ``CREATE``
+
+    Parameters
+    ----------
+    sender: bytes
+        Address of the deployer.
+    nonce: int
+        Nonce of the deployer when deploying the contract.
+
+    Returns
+    -------
+    bytes
+        Address of the deployed contract.
+    """
+    if nonce == 0:
+        encoded_nonce = b"\x80"
+    elif nonce < 0x80:
+        encoded_nonce = bytes([nonce])
+    else:
+        nonce_bytes = nonce.to_bytes((nonce.bit_length() + 7) // 8, "big")
+        encoded_nonce = bytes([0x80 + len(nonce_bytes)]) + nonce_bytes
+
+    payload = bytes([0x80 + len(sender)]) + sender + encoded_nonce
+    return eth_utils.keccak(bytes([0xC0 + len(payload)]) + payload)[12:]
+
+
+def morpho_market_id(market_params: typing.Tuple) -> bytes:
+    """Id of a Morpho Blue market, i.e. the hash of its market params"""
+    return eth_utils.keccak(
+        eth_abi.encode(["(address,address,address,address,uint256)"], [market_params])
+    )
+
+
+def morpho_position_slots(market_id: bytes, user: bytes) -> typing.List[int]:
+    """Slots of the position of ``user`` in a market"""
+    base = nested_mapping_slot(market_id, user, MORPHO_POSITION_SLOT)
+    return [base + k for k in range(MORPHO_POSITION_SIZE)]
+
+
+def morpho_market_slots(market_id: bytes) -> typing.List[int]:
+    """Slots of the state and parameters of a market"""
+    market = mapping_slot(market_id, MORPHO_MARKET_SLOT)
+    params = mapping_slot(market_id, MORPHO_ID_TO_MARKET_PARAMS_SLOT)
+    return [market + k for k in range(MORPHO_MARKET_SIZE)] + [
+        params + k for k in range(MORPHO_MARKET_PARAMS_SIZE)
+    ]
+
+
+def zero_fill_cache(
+    cache: typing.Tuple, storage: typing.Iterable[typing.Tuple[bytes, int]]
+) -> typing.Tuple:
+    """
+    Add zero valued storage slots that are missing from a cache
+
+    Simulation environments initialised from a cache fail when reading
+    a slot that is not in the cache. This adds the given
+    ``(contract address, slot)`` pairs with a zero value, leaving the
+    slots already in the cache untouched.
+
+    Parameters
+    ----------
+    cache: verbs.types.Cache
+        Fork cache.
+    storage: typing.Iterable[typing.Tuple[bytes, int]]
+        Contract addresses and storage slots.
+
+    Returns
+    -------
+    verbs.types.Cache
+        Cache extended with the missing slots.
+    """
+    # Storage slots and values of the cache are little-endian 32 bytes
+    cached = {(x[0], x[1]) for x in cache[3]}
+    zero = bytes(32)
+    missing = list()
+    for address, slot in storage:
+        key = (address, slot.to_bytes(32, "little"))
+        if key not in cached:
+            cached.add(key)
+            missing.append((key[0], key[1], zero))
+
+    if not missing:
+        return cache
+
+    return (cache[0], cache[1], cache[2], cache[3] + missing)
+
+
+class SnapshotState:
+    """
+    Read and write the state of an environment snapshot
+
+    Wraps a snapshot exported with ``env.export_snapshot()`` to read and
+    write account balances and storage slots directly, without executing
+    transactions. The updated snapshot can then be used to initialise
+    a new simulation environment.
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+       state = SnapshotState(env.export_snapshot())
+       state.set_storage(token_address, slot, 10**18)
+       env = verbs.envs.EmptyEnv(seed, snapshot=state.export())
+
+    Parameters
+    ----------
+    snapshot: typing.Tuple
+        Snapshot exported from a simulation environment.
+    """
+
+    def __init__(self, snapshot: typing.Tuple):
+        self.block = snapshot[0]
+        self.accounts = {
+            address: [list(info), status, dict(storage)]
+            for address, (info, status, storage) in snapshot[1]
+        }
+        self.tail = snapshot[2:]
+
+    def get_storage(self, address: bytes, slot: int) -> int:
+        """Value of a storage slot, slots not in the snapshot are zero"""
+        value = self.accounts[address][2].get(slot.to_bytes(32, "little"), bytes(32))
+        return int.from_bytes(value, "little")
+
+    def set_storage(self, address: bytes, slot: int, value: int):
+        """Set the value of a storage slot"""
+        self.accounts[address][2][slot.to_bytes(32, "little")] = value.to_bytes(
+            32, "little"
+        )
+
+    def get_balance(self, address: bytes) -> int:
+        """Eth balance of an account (in wei)"""
+        return int.from_bytes(self.accounts[address][0][0], "little")
+
+    def set_balance(self, address: bytes, value: int):
+        """Set the Eth balance of an account (in wei)"""
+        self.accounts[address][0][0] = value.to_bytes(32, "little")
+
+    def diff(
+        self, other: "SnapshotState"
+    ) -> typing.List[typing.Tuple[bytes, typing.Optional[int]]]:
+        """
+        Differences of Eth balances and storage values with another state
+
+        Returns
+        -------
+        typing.List[typing.Tuple[bytes, typing.Optional[int]]]
+            Addresses and slots whose values differ, the slot is ``None``
+            if the Eth balance (or the whole account) differs.
+        """
+        differences = list()
+        for address in set(self.accounts) | set(other.accounts):
+            if address not in self.accounts or address not in other.accounts:
+                differences.append((address, None))
+                continue
+            if self.get_balance(address) != other.get_balance(address):
+                differences.append((address, None))
+            slots = set(self.accounts[address][2]) | set(other.accounts[address][2])
+            for slot in slots:
+                slot = int.from_bytes(slot, "little")
+                if self.get_storage(address, slot) != other.get_storage(address, slot):
+                    differences.append((address, slot))
+        return differences
+
+    def export(self) -> typing.Tuple:
+        """Export the updated snapshot"""
+        accounts = [
+            (address, (tuple(info), status, list(storage.items())))
+            for address, (info, status, storage) in self.accounts.items()
+        ]
+        return (self.block, accounts) + tuple(self.tail)